@@ -0,0 +1,3 @@
+# -*- coding: utf-8 -*-
+""" Offline micro-benchmarks, see `bench.run`
+"""
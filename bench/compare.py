@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+""" Compare two `bench.run` result files.
+
+    python -m bench.compare before.json after.json
+
+Prints the median of every benchmark present in both files and the ratio
+after/before (below 1.0 is faster). Exits non-zero if anything got slower
+than `--threshold`.
+"""
+import argparse
+import json
+import sys
+
+
+_IGNORED = ('min', 'median', 'mean', 'repeat', 'files_per_sec', 'mb_per_sec')
+
+
+def _key(result):
+  return tuple(sorted((k, v) for k, v in result.items() if k not in _IGNORED))
+
+
+def _label(key):
+  d = dict(key)
+  rest = ' '.join('%s=%s' % (k, v) for k, v in key if k != 'name')
+  return '%s %s' % (d['name'], rest)
+
+
+def compare(before, after):
+  """List of (label, before median, after median, ratio)"""
+  old = dict((_key(r), r) for r in before['results'])
+  rows = []
+  for result in after['results']:
+    key = _key(result)
+    if key in old:
+      base = old[key]['median']
+      rows.append((_label(key), base, result['median'],
+                   result['median'] / base if base else float('inf')))
+  return rows
+
+
+parser = argparse.ArgumentParser(description='Compare two benchmark runs.')
+parser.add_argument('before')
+parser.add_argument('after')
+parser.add_argument('--threshold', type=float, default=1.10,
+                    help='Fail if a ratio exceeds this (default 1.10)')
+
+
+if __name__ == '__main__':
+  args = parser.parse_args()
+  with open(args.before) as f:
+    before = json.load(f)
+  with open(args.after) as f:
+    after = json.load(f)
+  slower = 0
+  for label, base, new, ratio in compare(before, after):
+    flag = ''
+    if ratio > args.threshold:
+      flag = '  SLOWER'
+      slower += 1
+    sys.stdout.write('%-60s %10.5fs %10.5fs %6.2fx%s\n' % (
+        label[:60], base, new, ratio, flag))
+  sys.exit(1 if slower else 0)
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+""" Deterministic HTML fixtures for the benchmarks.
+
+Fixtures are generated rather than checked in so the huge ones don't bloat
+the repo; a fixed seed keeps them byte for byte identical between runs and
+commits. `fixtures/` holds a few hand written pages with the kind of markup
+generated pages lack (inline scripts, comments, odd quoting).
+"""
+import glob
+import os
+import random
+
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'fixtures')
+BASE_URL = 'http://bench.example.com/articles/2015/some-page.html'
+
+
+# name: (number of assets, paragraphs of filler text)
+SIZES = (
+    ('small', 10, 20),
+    ('medium', 100, 200),
+    ('large', 1000, 1500),
+    ('huge', 5000, 8000),
+    # mostly assets, little text: galleries, product listings
+    ('asset_heavy', 10000, 100),
+)
+
+_WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+          'eiusmod tempor incididunt ut labore et dolore magna aliqua').split()
+
+
+def _asset_tag(rnd, i):
+  """One asset reference, mixing absolute, scheme-less and relative urls"""
+  host = rnd.choice(('', '//cdn%d.example.net' % rnd.randint(1, 4),
+                     'http://static.example.org'))
+  kind = rnd.random()
+  if kind < 0.15:
+    return '<script src="%s/js/lib-%d.js"></script>' % (host, i)
+  elif kind < 0.30:
+    return '<link rel="stylesheet" href="%s/css/style-%d.css">' % (host, i)
+  elif kind < 0.33:
+    return '<iframe src="%s/embed/%d"></iframe>' % (host, i)
+  elif kind < 0.45:
+    return '<img data-src="%s/lazy/img-%d.png" class="lazy">' % (host, i)
+  return '<img src="%s/img/photo-%d.jpg" alt="photo %d">' % (host, i, i)
+
+
+def _paragraph(rnd):
+  words = [rnd.choice(_WORDS) for _ in range(rnd.randint(30, 90))]
+  return '<p class="body">%s &amp; more.</p>' % ' '.join(words)
+
+
+def generate(num_assets, num_paragraphs, seed=0):
+  """Build a page with `num_assets` asset references spread evenly through
+  `num_paragraphs` paragraphs of text.
+  """
+  rnd = random.Random(seed)
+  head = [_asset_tag(rnd, i) for i in range(min(num_assets, 20) // 2)]
+  body = []
+  remaining = num_assets - len(head)
+  per_paragraph = float(remaining) / max(num_paragraphs, 1)
+  placed = 0
+  for p in range(num_paragraphs):
+    body.append(_paragraph(rnd))
+    while placed < remaining and placed < (p + 1) * per_paragraph:
+      body.append(_asset_tag(rnd, len(head) + placed))
+      placed += 1
+  while placed < remaining:
+    body.append(_asset_tag(rnd, len(head) + placed))
+    placed += 1
+  return ('<!DOCTYPE html>\n<html><head><meta charset="utf-8">'
+          '<title>Bench</title>\n%s\n</head>\n<body>\n%s\n</body></html>\n'
+          % ('\n'.join(head), '\n'.join(body)))
+
+
+def load():
+  """All fixtures as a list of (name, html), smallest first"""
+  corpus = []
+  for path in sorted(glob.glob(os.path.join(FIXTURE_DIR, '*.html'))):
+    with open(path, 'rb') as f:
+      corpus.append((os.path.basename(path)[:-len('.html')], f.read()))
+  for name, num_assets, num_paragraphs in SIZES:
+    corpus.append((name, generate(num_assets, num_paragraphs)))
+  return corpus
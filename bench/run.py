@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+""" Offline micro-benchmarks for parsing, rewriting and storing pages.
+
+Run from the repository root:
+
+    python -m bench.run                      # everything, JSON on stdout
+    python -m bench.run -o before.json -r 10
+    python -m bench.run -k rewrite -f small -f large
+
+Nothing touches the network: pages are built from `bench.corpus` fixtures,
+asset downloads are faked and storage writes go to a temp directory. Compare
+two runs with `python -m bench.compare before.json after.json`.
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+import config
+import page
+from storage.backends import LocalStorage
+
+from . import corpus
+
+
+REWRITERS = ('soup', 'stream')
+CONTENT_TYPES = ('image/png', 'text/css', 'application/javascript',
+                 'text/html; charset=utf-8', '')
+# (file size, number of files) for storage throughput
+STORE_SIZES = ((1024, 2000), (64 * 1024, 200), (1024 * 1024, 20))
+
+BENCHMARKS = []
+
+
+def benchmark(func):
+  BENCHMARKS.append(func)
+  return func
+
+
+def _time(func, repeat, setup=None):
+  """Run `func` `repeat` times, calling `setup` (untimed) before each run.
+  `func` gets whatever `setup` returned.
+  """
+  timings = []
+  for _ in range(repeat):
+    arg = setup() if setup else None
+    start = timeit.default_timer()
+    func(arg)
+    timings.append(timeit.default_timer() - start)
+  return timings
+
+
+def _summary(name, timings, **extra):
+  timings = sorted(timings)
+  result = dict(name=name, repeat=len(timings), min=timings[0],
+                median=timings[len(timings) // 2],
+                mean=sum(timings) / len(timings))
+  result.update(extra)
+  return result
+
+
+def _page(html, rewriter):
+  return page.Page(corpus.BASE_URL, html=html, rewriter=rewriter)
+
+
+@benchmark
+def page_construct(fixture, html, repeat):
+  """Full `Page` construction: parse plus asset discovery"""
+  for rewriter in REWRITERS:
+    timings = _time(lambda _: _page(html, rewriter), repeat)
+    yield _summary('page_construct', timings, fixture=fixture,
+                   rewriter=rewriter, bytes=len(html))
+
+
+@benchmark
+def rewrite_html(fixture, html, repeat):
+  """`Page.rewrite_html` alone, on a freshly parsed document"""
+  for rewriter in REWRITERS:
+    p = _page(html, rewriter)
+    num_assets = len(p.assets)
+    timings = _time(lambda p: p.rewrite_html(), repeat,
+                    setup=lambda: p.parse() or p)
+    yield _summary('rewrite_html', timings, fixture=fixture,
+                   rewriter=rewriter, assets=num_assets)
+
+
+@benchmark
+def rewritten(fixture, html, repeat):
+  """Serializing the rewritten document after every asset got renamed"""
+  for rewriter in REWRITERS:
+    p = _page(html, rewriter)
+    _rename_all(p.assets)
+    timings = _time(lambda _: p.rewritten, repeat)
+    yield _summary('rewritten', timings, fixture=fixture, rewriter=rewriter,
+                   bytes=len(html))
+
+
+def _fake_download(assets):
+  for i, asset in enumerate(assets):
+    asset.hash = hashlib.sha256(asset.asset_url).hexdigest()
+    asset._content_type = CONTENT_TYPES[i % len(CONTENT_TYPES)]
+
+
+def _rename_all(assets):
+  _fake_download(assets)
+  for asset in assets:
+    asset.rename()
+
+
+@benchmark
+def asset_rename(fixture, html, repeat):
+  """`Asset.rename` (extension inference plus node update) over every asset
+  of the page, with a mix of content types and url fallbacks
+  """
+  p = _page(html, 'soup')
+  _fake_download(p.assets)
+  if not p.assets:
+    return
+  timings = _time(lambda assets: [a.rename() for a in assets], repeat,
+                  setup=lambda: p.assets)
+  yield _summary('asset_rename', timings, fixture=fixture,
+                 assets=len(p.assets))
+
+
+def store_file(repeat):
+  """`LocalStorage.store_file` throughput for small, medium and big files"""
+  root = tempfile.mkdtemp(prefix='tessen-bench-')
+  previous = config.settings.filestorage.local.local_path
+  config.update({'filestorage': {'local': {'local_path': root}}})
+  if config.settings.filestorage.local.local_path != root:
+    shutil.rmtree(root)
+    raise RuntimeError('Could not point storage at %s, not benchmarking '
+                       'into %s' % (root, previous))
+  try:
+    for size, count in STORE_SIZES:
+      data = os.urandom(size)
+
+      def store(_):
+        for i in range(count):
+          LocalStorage.store_file('blobs/%d.bin' % i, data)
+
+      timings = _time(store, repeat)
+      best = min(timings)
+      yield _summary('store_file', timings, file_bytes=size, files=count,
+                     files_per_sec=count / best,
+                     mb_per_sec=size * count / best / 1048576.0)
+  finally:
+    config.update({'filestorage': {'local': {'local_path': previous}}})
+    shutil.rmtree(root)
+
+
+def _git_commit():
+  try:
+    return subprocess.check_output(
+        ['git', 'rev-parse', 'HEAD'], stderr=open(os.devnull, 'w')).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def run(repeat=5, names=None, fixtures=None):
+  """Run the selected benchmarks and return the result document"""
+  # Keep benchmarks off the disk cache and out of the working tree
+  config.update({'http_cache': {'enabled': False}})
+  if config.settings.http_cache.enabled:
+    raise RuntimeError('Could not turn the HTTP cache off')
+  results = []
+  for name, html in corpus.load():
+    if fixtures and name not in fixtures:
+      continue
+    for bench in BENCHMARKS:
+      if names and not any(n in bench.__name__ for n in names):
+        continue
+      results.extend(bench(name, html, repeat))
+  if not names or any(n in 'store_file' for n in names):
+    results.extend(store_file(repeat))
+  return dict(commit=_git_commit(), timestamp=time.time(),
+              python=platform.python_version(), platform=platform.platform(),
+              repeat=repeat, results=results)
+
+
+parser = argparse.ArgumentParser(description='Run the offline benchmarks.')
+parser.add_argument('-r', '--repeat', type=int, default=5,
+                    help='Timed runs per benchmark (default 5)')
+parser.add_argument('-k', dest='names', action='append',
+                    help='Only run benchmarks whose name contains this')
+parser.add_argument('-f', dest='fixtures', action='append',
+                    help='Only use this fixture (e.g. small, huge, article)')
+parser.add_argument('-o', '--output', help='Write JSON results to this file')
+
+
+if __name__ == '__main__':
+  args = parser.parse_args()
+  doc = run(args.repeat, args.names, args.fixtures)
+  out = json.dumps(doc, indent=2, sort_keys=True)
+  if args.output:
+    with open(args.output, 'w') as f:
+      f.write(out + '\n')
+  else:
+    sys.stdout.write(out + '\n')
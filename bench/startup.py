@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+""" Measure CLI startup time and check it against a target.
+
+    python -m bench.startup               # median of 10 runs per command
+    python -m bench.startup -r 20 --target-ms 200
+
+Each command runs in a fresh interpreter. Besides wall time, the modules
+`import crawl` leaves loaded are checked against `HEAVY_MODULES`, which a
+plain startup should never import. Exits non-zero if a median is over the
+target or a heavy module got imported.
+
+The settings cache is written before timing (`WARM_UP`), as the first real
+run of `crawl.py` would, so a fresh checkout doesn't time the YAML parser.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import timeit
+
+
+# Startup budget for `crawl.py --help` and `import crawl`
+TARGET_MS = 150
+# Only needed once a page is actually fetched, parsed or stored remotely
+HEAVY_MODULES = ('boto', 'bs4', 'yaml', 'requests', 'requests_cache',
+                 'storage.aws', 'page', 'http_cache')
+COMMANDS = (
+    ('import crawl', ['-c', 'import crawl']),
+    ('crawl.py --help', ['crawl.py', '--help']),
+)
+
+# Untimed, leaves cache/settings.json in place for the timed runs
+WARM_UP = ['-c', 'import config; config.write_cache()']
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _time(args, repeat):
+  timings = []
+  with open(os.devnull, 'w') as devnull:
+    for _ in range(repeat):
+      start = timeit.default_timer()
+      subprocess.check_call([sys.executable] + args, cwd=_ROOT,
+                            stdout=devnull, stderr=devnull)
+      timings.append(timeit.default_timer() - start)
+  return sorted(timings)
+
+
+def heavy_imports():
+  """Heavy modules loaded by `import crawl`"""
+  out = subprocess.check_output(
+      [sys.executable, '-c',
+       'import crawl, json, sys; print(json.dumps(sorted(sys.modules)))'],
+      cwd=_ROOT)
+  loaded = set(json.loads(out))
+  return sorted(m for m in HEAVY_MODULES if m in loaded)
+
+
+def run(repeat=10):
+  """Result document, shaped like `bench.run`'s"""
+  subprocess.check_call([sys.executable] + WARM_UP, cwd=_ROOT)
+  results = []
+  for name, args in COMMANDS:
+    timings = _time(args, repeat)
+    results.append(dict(name='startup', command=name, repeat=repeat,
+                        min=timings[0], median=timings[len(timings) // 2],
+                        mean=sum(timings) / len(timings)))
+  return dict(results=results, heavy_imports=heavy_imports())
+
+
+parser = argparse.ArgumentParser(description='Measure CLI startup time.')
+parser.add_argument('-r', '--repeat', type=int, default=10,
+                    help='Runs per command (default 10)')
+parser.add_argument('--target-ms', type=float, default=TARGET_MS,
+                    help='Fail if a median exceeds this (default %d)'
+                         % TARGET_MS)
+
+
+if __name__ == '__main__':
+  args = parser.parse_args()
+  doc = run(args.repeat)
+  failed = bool(doc['heavy_imports'])
+  for result in doc['results']:
+    over = result['median'] * 1000 > args.target_ms
+    failed = failed or over
+    sys.stdout.write('%-20s median %7.1fms  min %7.1fms%s\n' % (
+        result['command'], result['median'] * 1000, result['min'] * 1000,
+        '  OVER TARGET' if over else ''))
+  if doc['heavy_imports']:
+    sys.stdout.write('Heavy modules imported at startup: %s\n'
+                     % ', '.join(doc['heavy_imports']))
+  sys.exit(1 if failed else 0)
@@ -1,11 +1,25 @@
 # -*- coding: utf-8 -*-
 """Load & manage config data
+
+`settings` is built once from etc/default.yaml merged with
+etc/override.yaml, checked against `SCHEMA` and frozen into read only
+objects (see `lib.frozen_settings`). Long running processes can pick up
+edited files with `reload()`; `update()` applies overrides from code (tests,
+benchmarks). Both swap the new values into the existing `settings` object,
+so `from config import settings` keeps working.
+
+Parsing YAML (and importing the parser) is a noticeable part of a short
+run's startup, so the merged result is cached as JSON in cache/ and reused
+until either file changes. Importing this module only reads that cache;
+command line entry points call `write_cache()` to (re)write it.
 """
+import copy
+import json
 import logging
 import os
-import yaml
+import threading
 
-from lib.accessor_dict import AccessorDict
+from lib.frozen_settings import LiveSettings, OneOf, Optional, freeze, validate
 from lib import utils
 
 
@@ -15,24 +29,210 @@ log = logging.getLogger(__name__)
 basedir = os.path.dirname(os.path.realpath(__file__))
 _default_file = os.path.join(basedir, 'etc', 'default.yaml')
 _override_file = os.path.join(basedir, 'etc', 'override.yaml')
+_cache_file = os.path.join(basedir, 'cache', 'settings.json')
 
 
 test_mode = True
 
 
-G = globals()
-settings = {}
-if os.path.exists(_default_file):
-  with open(_default_file) as f:
-    for key, val in yaml.load(f).iteritems():
-      settings[key] = val
+SCHEMA = {
+    'filestorage': {
+        'use_remote_aws': bool,
+        'backend': Optional(str),
+        'local': {
+            'local_path': str,
+            'hosted_path': str,
+            'shard_depth': int,
+            'shard_width': int,
+        },
+        'compression': {
+            'enabled': bool,
+            'encoding': OneOf('gzip', 'br'),
+            'gzip_level': int,
+            'brotli_quality': int,
+            'min_bytes': int,
+            'keep_original': bool,
+        },
+        'remote_aws': {
+            'access_key': Optional(str),
+            'secret_key': Optional(str),
+            'container': str,
+            'container_cdn_url': Optional(str),
+            'pool_size': int,
+            'pool_max_idle_sec': float,
+            'pool_health_check_sec': float,
+            'multipart_threshold_mb': float,
+            'multipart_chunk_mb': float,
+            'batch_workers': int,
+            'timeout_sec': Optional(float),
+            'retry_attempts': Optional(int),
+            'retry_delay_sec': Optional(float),
+            'index': {
+                'enabled': bool,
+                'path': str,
+                'capacity': int,
+                'error_rate': float,
+                'confirm': OneOf('never', 'missing', 'always'),
+            },
+        },
+    },
+    'pipeline': {
+        'download_workers': int,
+        'upload_workers': int,
+        'chunk_size': int,
+    },
+    'http': {
+        'pool_hosts': int,
+        'per_host_connections': int,
+        'per_host_rate': float,
+        'per_host_burst': int,
+        'connect_timeout_sec': float,
+        'read_timeout_sec': float,
+        'attempts': int,
+        'backoff_base_sec': float,
+        'backoff_max_sec': float,
+        'breaker_failures': int,
+        'breaker_reset_sec': float,
+        'hedge_after_sec': float,
+    },
+    'render': {
+        'workers': int,
+        'max_pages_per_worker': int,
+        'max_rss_mb': float,
+        'timeout_sec': float,
+        'profile': {
+            'block_types': [OneOf('image', 'font', 'media', 'stylesheet',
+                                  'script')],
+            'block_patterns': [str],
+            'deadline_sec': float,
+            'capture_max_kb': float,
+            'capture_total_mb': float,
+        },
+    },
+    'page': {
+        'rewriter': OneOf('soup', 'stream'),
+    },
+    'snapshot': {
+        'legacy_hashmap': bool,
+    },
+    'http_cache': {
+        'enabled': bool,
+        'path': str,
+        'max_bytes': int,
+        'max_entry_mb': float,
+    },
+    'stats': {
+        'enabled': bool,
+    },
+    'service': {
+        'host': str,
+        'port': int,
+        'workers': int,
+        'max_queue': int,
+        'keep_jobs': int,
+    },
+}
+
+
+_lock = threading.Lock()
+_data = {}
+# (mtimes, data) parsed from YAML since the cache was last written
+_uncached = None
+settings = LiveSettings()
+
+
+def _read(path):
+  import yaml
+  if not os.path.exists(path):
+    return {}
+  loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+  with open(path) as f:
+    return yaml.load(f, Loader=loader) or {}
+
+
+def _native(value):
+  """Undo JSON's unicode strings where plain ones will do, as YAML gives"""
+  if isinstance(value, dict):
+    return dict((_native(k), _native(v)) for k, v in value.items())
+  if isinstance(value, list):
+    return [_native(v) for v in value]
+  if isinstance(value, unicode):
+    try:
+      return value.encode('ascii')
+    except UnicodeEncodeError:
+      pass
+  return value
+
+
+def _load_files():
+  global _uncached
+  mtimes = [os.path.getmtime(path) if os.path.exists(path) else None
+            for path in (_default_file, _override_file)]
+  try:
+    with open(_cache_file) as f:
+      cached = json.load(f)
+    if cached['mtimes'] == mtimes:
+      return _native(cached['data'])
+  except (IOError, ValueError, KeyError):
+    pass
+  data = _read(_default_file)
+  override_settings = _read(_override_file)
+  if override_settings:
+    data = utils.dict_deep_merge(data, override_settings)
+  _uncached = (mtimes, data)
+  return data
+
+
+def write_cache():
+  """Cache the settings parsed from YAML by this process as JSON, so the
+  next one can skip the YAML parser. Does nothing if they came from the
+  cache already.
+  """
+  global _uncached
+  with _lock:
+    if _uncached is None:
+      return
+    mtimes, data = _uncached
+    _uncached = None
+  tmp = None
+  try:
+    if not os.path.isdir(os.path.dirname(_cache_file)):
+      os.makedirs(os.path.dirname(_cache_file))
+    tmp = '%s.%d' % (_cache_file, os.getpid())
+    with open(tmp, 'w') as f:
+      json.dump(dict(mtimes=mtimes, data=data), f)
+    os.rename(tmp, _cache_file)
+  except (IOError, OSError, TypeError, ValueError):
+    # Read only checkout, or values JSON can't hold: just parse every time
+    log.debug('Could not cache settings', exc_info=True)
+    if tmp and os.path.exists(tmp):
+      os.unlink(tmp)
+
+
+def _apply(data):
+  global _data
+  validate(data, SCHEMA)
+  settings.replace(freeze(data))
+  _data = data
+
+
+def reload():
+  """Re-read the config files and swap the new values in. Raises
+  `lib.frozen_settings.ConfigError` (and keeps the current settings) if they
+  don't validate.
+  """
+  with _lock:
+    _apply(_load_files())
+  log.info('Settings reloaded')
+
 
-if os.path.exists(_override_file):
-  override_settings = {}
-  with open(_override_file) as f:
-    for key, val in yaml.load(f).iteritems():
-      override_settings[key] = val
-  settings = utils.dict_deep_merge(settings, override_settings)
+def update(values):
+  """Deep merge the nested dict `values` into the current settings, e.g.
+  `update({'http_cache': {'enabled': False}})`. Overrides last until the
+  next `reload`.
+  """
+  with _lock:
+    _apply(utils.dict_deep_merge(copy.deepcopy(_data), values))
 
 
-settings = AccessorDict(settings)
+_apply(_load_files())
@@ -1,25 +1,168 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 """ Like this and like that and like this and uh
+
+Archive one or many pages. URLs can be given on the command line, read from a
+file (one per line, `#` comments allowed) or from stdin with `--file -`:
+
+    ./crawl.py http://example.com
+    ./crawl.py --workers 16 --file urls.txt
+    ./crawl.py --recrawl --file urls.txt
+
+With `--recrawl`, pages archived before are revalidated against their
+previous snapshot: only assets that changed are downloaded and uploaded
+again, and a summary of what changed is reported.
 """
 import argparse
 import logging
-import requests_cache
+import sys
+import threading
+import time
 
-import page
-from storage import store_page
+import config
+from config import settings
+from lib import stats
+from lib.pipeline import Pipeline
+import storage
+from storage import SnapshotDiff, load_snapshot, page_prefix, store_page
 
 
 log = logging.getLogger(__name__)
-requests_cache.install_cache()
-parser = argparse.ArgumentParser(description='Process some integers.')
-parser.add_argument('url', metavar='url', type=str, nargs='+',
-                    help='The URL to crawl and store')
+parser = argparse.ArgumentParser(description='Archive web pages and their '
+                                             'static assets.')
+parser.add_argument('url', metavar='url', type=str, nargs='*',
+                    help='The URL(s) to crawl and store')
+parser.add_argument('-f', '--file', metavar='path',
+                    help='Read URLs from a file, one per line ("-" for stdin)')
+parser.add_argument('-w', '--workers', type=int, default=4,
+                    help='Number of pages processed concurrently')
+parser.add_argument('--storage', metavar='backend',
+                    help='Storage backend to use (%s), overrides the config'
+                         % ', '.join(storage.available_backends()))
+parser.add_argument('--recrawl', action='store_true',
+                    help='Reuse assets unchanged since the previous snapshot '
+                         'of each page')
+parser.add_argument('--stats-json', metavar='path',
+                    help='Write per-stage timings and counters as JSON')
+parser.add_argument('--stats-prom', metavar='path',
+                    help='Write per-stage timings and counters in the '
+                         'Prometheus text format')
+
+
+def iter_urls(urls, url_file=None):
+  """Yield URLs from argv, then from `url_file` (a path, or "-" for stdin).
+  Blank lines and comments are skipped.
+  """
+  for url in urls:
+    yield url
+  if url_file is None:
+    return
+  f = sys.stdin if url_file == '-' else open(url_file)
+  try:
+    for line in f:
+      line = line.strip()
+      if line and not line.startswith('#'):
+        yield line
+  finally:
+    if f is not sys.stdin:
+      f.close()
+
+
+def archive_url(url, recrawl=False):
+  """Render, parse and store a single page under its own key prefix. With
+  `recrawl`, assets unchanged since the page's previous snapshot are reused.
+
+  :returns: (storage key of index.html, number of assets, `SnapshotDiff` or
+    None if there was no previous snapshot to compare with)
+  """
+  prefix = page_prefix(url)
+  previous = load_snapshot(prefix) if recrawl else None
+  diff = SnapshotDiff() if previous is not None else None
+  # Imported on first use, to keep `--help` and startup fast
+  import page
+  html, captured = page.render_page(url)
+  page_ = page.Page(url, html=html, captured=captured)
+  index = store_page(page_, prefix=prefix, previous=previous, diff=diff)
+  if diff is not None:
+    log.info('Recrawled "%s": %s', url, diff)
+  return index, len(page_.assets), diff
+
+
+def crawl(urls, workers=1, recrawl=False):
+  """Archive every URL in `urls` across a pool of `workers` threads. A failed
+  page is logged and counted, it does not stop the run.
+
+  :returns: dict of run statistics
+  """
+  totals = {'pages': 0, 'failed': 0, 'assets': 0}
+  if recrawl:
+    totals['diff'] = dict.fromkeys(SnapshotDiff().to_dict(), 0)
+    totals['diff']['pages'] = 0
+  lock = threading.Lock()
+
+  def work(url):
+    try:
+      _, num_assets, diff = archive_url(url, recrawl)
+    except Exception:
+      log.exception('Failed to archive "%s"', url)
+      with lock:
+        totals['failed'] += 1
+    else:
+      with lock:
+        totals['pages'] += 1
+        totals['assets'] += num_assets
+        if diff is not None:
+          totals['diff']['pages'] += 1
+          for key, value in diff.to_dict().items():
+            totals['diff'][key] += value
+
+  start = time.time()
+  Pipeline([('page', work, workers)]).run(urls)
+  totals['elapsed'] = time.time() - start
+  return totals
+
+
+def report(totals, out=sys.stderr):
+  elapsed = totals['elapsed'] or 1e-9
+  out.write('Archived %d page(s) (%d failed), %d asset(s) in %.1fs: '
+            '%.2f pages/s, %.2f assets/s\n' % (
+                totals['pages'], totals['failed'], totals['assets'],
+                totals['elapsed'], totals['pages'] / elapsed,
+                totals['assets'] / elapsed))
+  diff = totals.get('diff')
+  if diff is not None:
+    out.write('Recrawl: %(pages)d page(s) had a previous snapshot; assets '
+              '%(new)d new, %(changed)d changed, %(unchanged)d unchanged, '
+              '%(not_modified)d not modified, %(removed)d removed; '
+              '%(uploaded)d uploaded, %(downloaded_bytes)d bytes '
+              'downloaded\n' % diff)
+  import http_cache
+  cache = http_cache.get_cache()
+  if cache is not None:
+    c = cache.stats()
+    out.write('HTTP cache: %.1f%% hit rate (%d fresh, %d revalidated, '
+              '%d misses), %d entries, %.1fMB\n' % (
+                  c['hit_rate'] * 100, c['hits'], c['revalidated'],
+                  c['misses'], c['entries'], c['bytes'] / 1048576.0))
 
 
 if __name__ == '__main__':
   logging.basicConfig()
-  url = parser.parse_args().url[0]
-  html = page.get_page_from_webkit(url)
-  page = page.Page(url, html=html)
-  store_page(page)
+  config.write_cache()
+  args = parser.parse_args()
+  if not args.url and not args.file:
+    parser.error('no URLs given')
+  if args.storage:
+    storage.use_backend(args.storage)
+  if settings.stats.enabled or args.stats_json or args.stats_prom:
+    stats.enable()
+  totals = crawl(iter_urls(args.url, args.file), workers=args.workers,
+                 recrawl=args.recrawl)
+  report(totals)
+  if args.stats_json:
+    with open(args.stats_json, 'w') as f:
+      f.write(stats.registry.to_json())
+  if args.stats_prom:
+    with open(args.stats_prom, 'w') as f:
+      f.write(stats.registry.to_prometheus())
+  sys.exit(1 if totals['failed'] else 0)
@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+""" Bounded, revalidating on-disk HTTP cache for asset fetches.
+
+`CachingAdapter` is a `requests` transport adapter that sits in front of the
+network for GET requests:
+
+  * fresh entries (Cache-Control max-age / Expires) are served from disk,
+  * stale entries are revalidated with If-None-Match / If-Modified-Since and
+    served from disk on a 304,
+  * `no-store` responses and bodies above `max_entry_mb` are never cached.
+
+Bodies are spooled straight to disk, and `DiskCache` evicts least recently
+used entries once the cache grows past `http_cache.max_bytes`. Hit rates are
+available from `DiskCache.stats()`, and every response that went through the
+cache carries a `cache_status` attribute.
+"""
+from collections import OrderedDict
+import calendar
+from email.utils import formatdate, parsedate
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+
+from config import settings
+from lib.politeness import PoliteAdapter
+from lib.utils import spool_to_file
+
+
+log = logging.getLogger(__name__)
+# Headers that describe the body as sent over the wire. Cached bodies are
+# stored decoded, so these no longer apply.
+_WIRE_HEADERS = ('content-encoding', 'content-length', 'transfer-encoding')
+# Request headers that make a GET conditional
+CONDITIONAL_HEADERS = ('If-None-Match', 'If-Modified-Since')
+
+
+def _parse_cache_control(value):
+  directives = {}
+  for part in (value or '').split(','):
+    name, _, arg = part.strip().partition('=')
+    if name:
+      directives[name.lower()] = arg.strip('"')
+  return directives
+
+
+def _http_date(value):
+  parsed = parsedate(value) if value else None
+  return calendar.timegm(parsed) if parsed else None
+
+
+class CacheEntry(object):
+  """Metadata of a cached response; the body lives in `body_path`"""
+  def __init__(self, meta, body_path):
+    self.meta = meta
+    self.body_path = body_path
+
+  @property
+  def headers(self):
+    return CaseInsensitiveDict(self.meta['headers'])
+
+  def is_fresh(self, now=None):
+    now = now or time.time()
+    headers = self.headers
+    cc = _parse_cache_control(headers.get('cache-control'))
+    if 'no-cache' in cc:
+      return False
+    age = now - self.meta['stored_at']
+    if 'max-age' in cc:
+      try:
+        return age < int(cc['max-age'])
+      except ValueError:
+        return False
+    expires = _http_date(headers.get('expires'))
+    date = _http_date(headers.get('date')) or self.meta['stored_at']
+    return expires is not None and age < expires - date
+
+  def validators(self):
+    headers = self.headers
+    out = {}
+    if headers.get('etag'):
+      out['If-None-Match'] = headers['etag']
+    if headers.get('last-modified'):
+      out['If-Modified-Since'] = headers['last-modified']
+    return out
+
+
+class DiskCache(object):
+  """URL keyed response store with a byte budget and LRU eviction. The LRU
+  order survives restarts through the mtime of each entry's meta file.
+  """
+  def __init__(self, path, max_bytes, max_entry_bytes):
+    self.path = path
+    self.max_bytes = max_bytes
+    self.max_entry_bytes = max_entry_bytes
+    self._lock = threading.Lock()
+    self._lru = OrderedDict()  # key -> size in bytes
+    self._size = 0
+    self._stats = dict(hits=0, misses=0, revalidated=0, stored=0, evicted=0)
+    if not os.path.isdir(path):
+      os.makedirs(path)
+    self._load()
+
+  def _load(self):
+    found = []
+    for name in os.listdir(self.path):
+      if name.endswith('.meta'):
+        key = name[:-len('.meta')]
+        meta_path, body_path = self._paths(key)
+        try:
+          size = os.path.getsize(meta_path) + os.path.getsize(body_path)
+          found.append((os.path.getmtime(meta_path), key, size))
+        except OSError:
+          continue
+    for _, key, size in sorted(found):
+      self._lru[key] = size
+      self._size += size
+
+  @staticmethod
+  def key_for(url):
+    if isinstance(url, unicode):
+      url = url.encode('utf8')
+    return hashlib.sha1(url).hexdigest()
+
+  def _paths(self, key):
+    base = os.path.join(self.path, key)
+    return base + '.meta', base + '.body'
+
+  def get(self, url):
+    key = self.key_for(url)
+    meta_path, body_path = self._paths(key)
+    with self._lock:
+      if key not in self._lru:
+        return None
+      self._lru[key] = self._lru.pop(key)
+    try:
+      with open(meta_path) as f:
+        meta = json.load(f)
+      os.utime(meta_path, None)
+    except (IOError, OSError, ValueError):
+      self._discard(key)
+      return None
+    return CacheEntry(meta, body_path)
+
+  def put(self, url, status, headers, body_path):
+    """Move the spooled body at `body_path` into the cache"""
+    key = self.key_for(url)
+    meta_path, final_body = self._paths(key)
+    headers = dict((k, v) for k, v in headers.items()
+                   if k.lower() not in _WIRE_HEADERS)
+    meta = dict(url=url, status=status, headers=headers,
+                stored_at=time.time())
+    os.rename(body_path, final_body)
+    self._write_meta(meta_path, meta)
+    size = os.path.getsize(meta_path) + os.path.getsize(final_body)
+    with self._lock:
+      self._size += size - self._lru.pop(key, 0)
+      self._lru[key] = size
+      self._stats['stored'] += 1
+    self._evict()
+    return CacheEntry(meta, final_body)
+
+  def refresh(self, entry, headers):
+    """Merge the headers of a 304 into `entry` and restart its age"""
+    merged = CaseInsensitiveDict(entry.meta['headers'])
+    for k, v in headers.items():
+      if k.lower() not in _WIRE_HEADERS:
+        merged[k] = v
+    entry.meta['headers'] = dict(merged.items())
+    entry.meta['stored_at'] = time.time()
+    self._write_meta(self._paths(self.key_for(entry.meta['url']))[0],
+                     entry.meta)
+
+  def _write_meta(self, meta_path, meta):
+    tmp = '%s.%d.tmp' % (meta_path, threading.current_thread().ident)
+    with open(tmp, 'w') as f:
+      json.dump(meta, f)
+    os.rename(tmp, meta_path)
+
+  def _discard(self, key):
+    with self._lock:
+      self._size -= self._lru.pop(key, 0)
+    for path in self._paths(key):
+      try:
+        os.unlink(path)
+      except OSError:
+        pass
+
+  def _evict(self):
+    while True:
+      with self._lock:
+        if self._size <= self.max_bytes or not self._lru:
+          return
+        key = next(iter(self._lru))
+        self._stats['evicted'] += 1
+      self._discard(key)
+
+  def spool_dir(self):
+    """Temp files are spooled next to the cache so `put` is a rename"""
+    return self.path
+
+  def count(self, stat):
+    with self._lock:
+      self._stats[stat] += 1
+
+  def stats(self):
+    """Counters plus `hit_rate`, the share of lookups answered from disk
+    (fresh hits and successful revalidations)
+    """
+    with self._lock:
+      stats = dict(self._stats, entries=len(self._lru), bytes=self._size)
+    lookups = stats['hits'] + stats['revalidated'] + stats['misses']
+    served = stats['hits'] + stats['revalidated']
+    stats['hit_rate'] = float(served) / lookups if lookups else 0.0
+    return stats
+
+
+class _CachedBody(object):
+  """File backed stand-in for the urllib3 response `requests` expects"""
+  def __init__(self, path):
+    self._file = open(path, 'rb')
+
+  def read(self, amt=None):
+    return self._file.read() if amt is None else self._file.read(amt)
+
+  def close(self):
+    self._file.close()
+
+  release_conn = close
+
+
+class CachingAdapter(PoliteAdapter):
+  """`HTTPAdapter` that answers GETs from a `DiskCache` when it can. Only
+  requests that actually go to the network are throttled.
+  """
+  def __init__(self, cache, **kwargs):
+    self.cache = cache
+    super(CachingAdapter, self).__init__(**kwargs)
+
+  def send(self, request, **kwargs):
+    if request.method != 'GET':
+      return super(CachingAdapter, self).send(request, **kwargs)
+
+    entry = self.cache.get(request.url)
+    # The caller's own validators (e.g. a recrawl's, from the previous
+    # snapshot) win; a 304 to those is about its copy, not ours
+    conditional = any(name in request.headers for name in CONDITIONAL_HEADERS)
+    if entry is not None:
+      if entry.is_fresh():
+        self.cache.count('hits')
+        return self._from_cache(request, entry, 'hit')
+      if not conditional:
+        request.headers.update(entry.validators())
+
+    resp = super(CachingAdapter, self).send(request, **kwargs)
+    if resp.status_code == 304 and entry is not None and not conditional:
+      resp.close()
+      self.cache.refresh(entry, resp.headers)
+      self.cache.count('revalidated')
+      return self._from_cache(request, entry, 'revalidated')
+    self.cache.count('misses')
+    if resp.status_code == 200 and self._cacheable(resp):
+      return self._store(request, resp)
+    return resp
+
+  def _cacheable(self, resp):
+    cc = _parse_cache_control(resp.headers.get('cache-control'))
+    if 'no-store' in cc or 'private' in cc:
+      return False
+    length = resp.headers.get('content-length')
+    if length and length.isdigit() and \
+       int(length) > self.cache.max_entry_bytes:
+      return False
+    # Without freshness info or validators we could never reuse the entry
+    return bool('max-age' in cc or resp.headers.get('expires') or
+                resp.headers.get('etag') or resp.headers.get('last-modified'))
+
+  def _store(self, request, resp):
+    try:
+      path, _, size = spool_to_file(
+          resp.raw.stream(settings.pipeline.chunk_size, decode_content=True),
+          dir=self.cache.spool_dir())
+    finally:
+      resp.close()
+    if size > self.cache.max_entry_bytes:
+      # Only learned the size after the fact, serve it once and drop it
+      entry = CacheEntry(dict(url=request.url, status=resp.status_code,
+                              headers=dict(resp.headers.items())), path)
+      response = self._from_cache(request, entry, 'miss')
+      os.unlink(path)
+      return response
+    entry = self.cache.put(request.url, resp.status_code, resp.headers, path)
+    return self._from_cache(request, entry, 'miss')
+
+  @staticmethod
+  def _from_cache(request, entry, cache_status):
+    """Build a response backed by the cached body. `cache_status` is one of
+    'hit', 'revalidated' (304 from the origin) or 'miss' (just stored).
+    """
+    response = Response()
+    response.status_code = entry.meta['status']
+    response.headers = entry.headers
+    response.headers.setdefault('Date', formatdate(usegmt=True))
+    response.raw = _CachedBody(entry.body_path)
+    response.url = request.url
+    response.request = request
+    response.reason = 'OK'
+    response.encoding = None
+    response.cache_status = cache_status
+    return response
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+  """The process wide `DiskCache`, or None if `http_cache` is disabled"""
+  global _cache
+  opts = settings.http_cache
+  if not opts.enabled:
+    return None
+  if _cache is None:
+    with _cache_lock:
+      if _cache is None:
+        _cache = DiskCache(opts.path, opts.max_bytes,
+                           opts.max_entry_mb * 1024 * 1024)
+  return _cache
@@ -1,73 +1,312 @@
 #!/usr/bin/env phantomjs
 /**
  * Crawl some pages
+ *
+ * Two modes:
+ *  - `phantomjs pageScraper.js <url> [profile]` renders a single page,
+ *    prints the result as JSON and exits.
+ *  - `phantomjs pageScraper.js` (no url) runs as a long lived worker: it reads
+ *    one JSON request (`{"url": "...", "profile": {...}}`) per line on stdin
+ *    and writes one JSON result per line on stdout, until stdin is closed.
+ *
+ * A render profile (JSON, every key optional) trims what gets loaded:
+ *  - `block_types`: resource types not to fetch ("image", "font", "media",
+ *    "stylesheet", "script"), guessed from the Accept header and the url
+ *  - `block_patterns`: regular expressions, requests whose url matches one
+ *    are aborted (ads, analytics...)
+ *  - `deadline_ms`: if the DOM isn't ready after this long, take the
+ *    document as it is (`result.partial` is set)
+ *  - `capture_max_bytes`, `capture_total_bytes`: return the bodies of the
+ *    sub-resources received by the time the DOM is ready (each up to the
+ *    first limit, all together up to the second) in `result.entries`, shaped
+ *    like HAR entries with base64 content. Only same-origin ones are read
+ *    back (the same-origin policy stays on), and those WebKit no longer has
+ *    cached are fetched a second time.
+ * The page itself is never blocked.
  */
 
 (function() {
   // Imports
-  var page = require('webpage').create();
+  var webpage = require('webpage');
   var system = require('system');
 
-
-  // Globals
-  var result = {success: false, args: system.args};
-  var url;
+  // Resource type guessed from the url when the Accept header doesn't say
+  var TYPE_PATTERNS = {
+    image: /\.(png|jpe?g|gif|webp|svg|ico|bmp)([?#]|$)/i,
+    font: /\.(woff2?|ttf|otf|eot)([?#]|$)/i,
+    media: /\.(mp4|webm|ogg|ogv|mp3|wav|m4a|m3u8|mov|flv|avi)([?#]|$)/i,
+    stylesheet: /\.css([?#]|$)/i,
+    script: /\.js([?#]|$)/i
+  };
+  var ACCEPT_TYPES = [
+    [/^image\//, 'image'],
+    [/^(video|audio)\//, 'media'],
+    [/^text\/css/, 'stylesheet']
+  ];
 
 
-  // Runit
-  if (system.args.length === 2){
-    system.stderr.writeLine(system.args); // debug
-    url = system.args[1];
+  function resourceType(requestData) {
+    var accept = '';
+    (requestData.headers || []).forEach(function(header) {
+      if (header.name.toLowerCase() === 'accept') {
+        accept = header.value;
+      }
+    });
+    for (var i = 0; i < ACCEPT_TYPES.length; i++) {
+      if (ACCEPT_TYPES[i][0].test(accept)) {
+        return ACCEPT_TYPES[i][1];
+      }
+    }
+    for (var type in TYPE_PATTERNS) {
+      if (TYPE_PATTERNS[type].test(requestData.url)) {
+        return type;
+      }
+    }
+    return 'other';
   }
 
 
-  function dumpResults(exitCode) {
-    exitCode = typeof exitCode !== 'undefined' ? exitCode : 0;
-    console.log(JSON.stringify(result, null, 4));
-    phantom.exit(exitCode);
+  // Runs inside the page: reads the same-origin `urls` again with
+  // synchronous XHRs, which WebKit answers from its cache when it can (a
+  // miss is a second fetch), and returns their bodies base64 encoded
+  function readBodies(urls, maxBytes, totalBytes) {
+    var bodies = [];
+    var link = document.createElement('a');
+    for (var i = 0; i < urls.length; i++) {
+      link.href = urls[i];
+      if (link.protocol !== location.protocol || link.host !== location.host) {
+        continue;
+      }
+      var xhr = new XMLHttpRequest();
+      try {
+        xhr.open('GET', urls[i], false);
+        // Keep the bytes as they are, one per char
+        xhr.overrideMimeType('text/plain; charset=x-user-defined');
+        xhr.send();
+      } catch (e) {
+        continue;
+      }
+      var text = xhr.responseText || '';
+      if (xhr.status !== 200 || text.length > maxBytes ||
+          text.length > totalBytes) {
+        continue;
+      }
+      totalBytes -= text.length;
+      var binary = '';
+      for (var start = 0; start < text.length; start += 8192) {
+        var codes = [];
+        var end = Math.min(start + 8192, text.length);
+        for (var j = start; j < end; j++) {
+          codes.push(text.charCodeAt(j) & 0xff);
+        }
+        binary += String.fromCharCode.apply(null, codes);
+      }
+      bodies.push({url: urls[i], size: text.length, text: btoa(binary)});
+    }
+    return bodies;
   }
 
 
-  // Register document object listener
-  page.onInitialized = function() {
-    page.evaluate(function() {
-      document.addEventListener('DOMContentLoaded', function() {
-        window.callPhantom('DOMContentLoaded');
-      }, false);
+  // Returns a function telling whether a request should be aborted
+  function blocker(profile) {
+    var types = {};
+    (profile.block_types || []).forEach(function(type) {
+      types[type] = true;
     });
-  };
+    var patterns = (profile.block_patterns || []).map(function(pattern) {
+      return new RegExp(pattern, 'i');
+    });
+    return function(requestData) {
+      if (types[resourceType(requestData)]) {
+        return true;
+      }
+      return patterns.some(function(pattern) {
+        return pattern.test(requestData.url);
+      });
+    };
+  }
+
 
+  function render(url, profile, done) {
+    var page = webpage.create();
+    var result = {success: false, url: url, blocked: 0};
+    var finished = false;
+    var deadline = null;
+    var blocked = blocker(profile || {});
+    var captureMax = (profile && profile.capture_max_bytes) || 0;
+    // Sub-resources received so far, by url
+    var received = {};
+    var capturing = false;
+    // Request id of the main document. The next request after a main frame
+    // navigation or redirect is the document, whatever its url became
+    var mainId = null;
 
-  page.onResourceReceived = function(request) {
-    if (request.url === url) {
-      result.status = request.status;
-      if (request.status >= 300 && request.status < 400) {
-        url = request.redirectURL;
-        result.redirectURL = url;
-        console.log('Redirect!!! New: ' + url);
-      } else if (request.status < 200 || request.status >= 300) {
-        // Fail here
-        dumpResults(1);
+    function finish() {
+      if (finished) {
+        return;
       }
-      // Sucess
-      result.headers = request.headers;
+      finished = true;
+      if (deadline !== null) {
+        clearTimeout(deadline);
+      }
+      page.close();
+      done(result);
     }
-  };
 
+    // HAR-like entries for the received sub-resources
+    function capture() {
+      var urls = Object.keys(received);
+      if (!urls.length) {
+        return [];
+      }
+      capturing = true;
+      var bodies = page.evaluate(readBodies, urls, captureMax,
+                                 profile.capture_total_bytes || 1e15);
+      return (bodies || []).map(function(body) {
+        var response = received[body.url];
+        return {
+          request: {method: 'GET', url: body.url},
+          response: {
+            status: response.status,
+            headers: response.headers,
+            content: {size: body.size, mimeType: response.contentType,
+                      encoding: 'base64', text: body.text}
+          }
+        };
+      });
+    }
+
+    page.onNavigationRequested = function(to, type, willNavigate, main) {
+      if (main && willNavigate) {
+        mainId = null;
+      }
+    };
+
+    page.onResourceRequested = function(requestData, networkRequest) {
+      if (mainId === null) {
+        mainId = requestData.id;
+      } else if (requestData.id !== mainId && blocked(requestData)) {
+        result.blocked++;
+        networkRequest.abort();
+      }
+    };
+
+    // Register document object listener
+    page.onInitialized = function() {
+      page.evaluate(function() {
+        document.addEventListener('DOMContentLoaded', function() {
+          window.callPhantom('DOMContentLoaded');
+        }, false);
+      });
+    };
 
-  page.onCallback = function(data) {
-    if (data === "DOMContentLoaded") {
-      result.html = page.content;
-      dumpResults();
+    page.onResourceReceived = function(request) {
+      if (captureMax && !capturing && request.stage === 'end' &&
+          request.status === 200 && request.id !== mainId &&
+          /^https?:/.test(request.url)) {
+        received[request.url] = request;
+      }
+      if (request.id === mainId) {
+        result.status = request.status;
+        if (request.status >= 300 && request.status < 400) {
+          mainId = null;
+          url = request.redirectURL;
+          result.redirectURL = url;
+          system.stderr.writeLine('Redirect!!! New: ' + url);
+        } else if (request.status < 200 || request.status >= 300) {
+          // Fail here
+          result.error = 'HTTP status ' + request.status;
+          finish();
+          return;
+        }
+        // Sucess
+        result.headers = request.headers;
+      }
+    };
+
+    page.onCallback = function(data) {
+      if (data === "DOMContentLoaded") {
+        result.html = page.content;
+        result.success = true;
+        if (!captureMax) {
+          finish();
+          return;
+        }
+        // Out of the page's callback before evaluating in it again
+        setTimeout(function() {
+          if (!finished) {
+            result.entries = capture();
+            finish();
+          }
+        }, 0);
+      }
+    };
+
+    page.settings.resourceTimeout = 5000; // 5 seconds
+    page.onResourceTimeout = function(r) {
+      system.stderr.writeLine("He's dead: " + JSON.stringify(r));
+      if (r.id === mainId) {
+        result.error = 'Timed out';
+        finish();
+      }
+    };
+
+    if (profile && profile.deadline_ms) {
+      deadline = setTimeout(function() {
+        deadline = null;
+        if (!finished && result.status !== undefined && !result.error) {
+          // Out of time: settle for the DOM as it is
+          result.html = page.content;
+          result.success = true;
+          result.partial = true;
+        } else {
+          result.error = result.error || 'Render deadline exceeded';
+        }
+        finish();
+      }, profile.deadline_ms);
     }
-  };
 
-  page.settings.resourceTimeout = 5000; // 5 seconds
-  page.onResourceTimeout = function(r) {
-    console.log(r);
-    console.log("He's dead");
-    phantom.exit(1);
-  };
+    page.open(url, function(status) {
+      if (status !== 'success' && !finished) {
+        result.error = result.error || 'Failed to load';
+        finish();
+      }
+    });
+  }
 
-  page.open(url);
+
+  function serve() {
+    var line = system.stdin.readLine();
+    if (!line) {
+      // stdin closed, we are done
+      phantom.exit(0);
+      return;
+    }
+    var request;
+    try {
+      request = JSON.parse(line);
+    } catch (e) {
+      request = {url: line};
+    }
+    render(request.url, request.profile, function(result) {
+      system.stdout.writeLine(JSON.stringify(result));
+      system.stdout.flush();
+      // Let the event loop unwind before blocking on stdin again
+      setTimeout(serve, 0);
+    });
+  }
+
+
+  // Runit
+  if (system.args.length === 2 || system.args.length === 3) {
+    system.stderr.writeLine(system.args); // debug
+    var profile = system.args[2] ? JSON.parse(system.args[2]) : {};
+    render(system.args[1], profile, function(result) {
+      result.args = system.args;
+      console.log(JSON.stringify(result, null, 4));
+      phantom.exit(result.success ? 0 : 1);
+    });
+  } else {
+    serve();
+  }
 }());
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+Immutable, attribute-access settings trees, validated against a schema.
+
+`AccessorDict` wraps every nested dict in a new object on each attribute
+access; `freeze` instead turns a nested dict into objects built once, with
+one `__slots__` class per section, so `settings.a.b.c` is a few plain slot
+lookups:
+
+  schema = {'db': {'host': str, 'port': int, 'user': Optional(str)}}
+  data = validate(yaml.load(f), schema)
+  settings = freeze(data)
+  settings.db.port
+
+Values can't be assigned to; build a new tree (see `config.reload`).
+"""
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+class ConfigError(ValueError):
+  pass
+
+
+class Optional(object):
+  """Schema entry for a key that may be missing"""
+  def __init__(self, spec):
+    self.spec = spec
+
+
+class OneOf(object):
+  """Schema entry for a value restricted to `choices`"""
+  def __init__(self, *choices):
+    self.choices = choices
+
+
+class Any(object):
+  """Schema entry accepting anything, e.g. a free form section"""
+
+
+_TYPE_NAMES = {bool: 'a boolean', int: 'an integer', float: 'a number',
+               str: 'a string', list: 'a list', dict: 'a mapping'}
+
+
+def _check(value, spec, path):
+  if isinstance(spec, Optional):
+    spec = spec.spec
+  if spec is Any:
+    return
+  if isinstance(spec, dict):
+    if not isinstance(value, dict):
+      raise ConfigError('%s must be a mapping' % path)
+    validate(value, spec, path)
+  elif isinstance(spec, list):
+    if not isinstance(value, list):
+      raise ConfigError('%s must be a list' % path)
+    for i, item in enumerate(value):
+      _check(item, spec[0], '%s[%d]' % (path, i))
+  elif isinstance(spec, OneOf):
+    if value not in spec.choices:
+      raise ConfigError('%s must be one of %s, not %r' % (
+          path, ', '.join(repr(c) for c in spec.choices), value))
+  else:
+    ok = isinstance(value, spec)
+    if spec is str:
+      ok = isinstance(value, basestring)
+    elif spec is float:
+      ok = isinstance(value, (int, long, float)) and \
+          not isinstance(value, bool)
+    elif spec is int:
+      ok = isinstance(value, (int, long)) and not isinstance(value, bool)
+    if not ok:
+      raise ConfigError('%s must be %s, not %r' % (
+          path, _TYPE_NAMES.get(spec, spec.__name__), value))
+
+
+def validate(data, schema, path='settings'):
+  """Check `data` against `schema`, a nested dict of types, `Optional`s,
+  `OneOf`s, `Any` and `[spec]` (a list of items matching spec). Raises
+  `ConfigError` on the first problem; unknown keys are only logged. Returns
+  `data`.
+  """
+  for key, spec in schema.items():
+    if key not in data or data[key] is None:
+      if isinstance(spec, Optional):
+        continue
+      raise ConfigError('%s.%s is missing' % (path, key))
+    _check(data[key], spec, '%s.%s' % (path, key))
+  for key in data:
+    if key not in schema:
+      log.warn('Unknown setting %s.%s', path, key)
+  return data
+
+
+class FrozenSettings(object):
+  """Base class of the generated section classes. Read like an object
+  (`section.key`) or, for old call sites, like a read only dict.
+  """
+  __slots__ = ()
+
+  def __setattr__(self, attr, val):
+    raise AttributeError('Settings are read only, use config.reload or '
+                         'config.update')
+
+  def __delattr__(self, attr):
+    raise AttributeError('Settings are read only, use config.reload or '
+                         'config.update')
+
+  def __getitem__(self, key):
+    try:
+      return getattr(self, key)
+    except AttributeError:
+      raise KeyError(key)
+
+  def __contains__(self, key):
+    return key in self.keys()
+
+  def __iter__(self):
+    return iter(self.keys())
+
+  def get(self, key, default=None):
+    return getattr(self, key, default)
+
+  def keys(self):
+    return list(self.__slots__)
+
+  def items(self):
+    return [(key, getattr(self, key)) for key in self.keys()]
+
+  def to_dict(self):
+    """Plain nested dict copy of the tree"""
+    return dict((key, _thaw(value)) for key, value in self.items())
+
+  def __repr__(self):
+    return '<%s %r>' % (type(self).__name__, self.to_dict())
+
+
+def _thaw(value):
+  if isinstance(value, FrozenSettings):
+    return value.to_dict()
+  if isinstance(value, tuple):
+    return [_thaw(v) for v in value]
+  return value
+
+
+def freeze(data, name='settings'):
+  """A `FrozenSettings` tree for the nested dict `data`. Lists become
+  tuples, dicts inside them are frozen too.
+  """
+  keys = tuple(sorted(str(k) for k in data))
+  cls = type('Settings_%s' % name.replace('.', '_'), (FrozenSettings,),
+             {'__slots__': keys})
+  obj = cls()
+  for key in keys:
+    object.__setattr__(obj, key, _freeze_value(data[key],
+                                               '%s.%s' % (name, key)))
+  return obj
+
+
+def _freeze_value(value, name):
+  if isinstance(value, dict):
+    return freeze(value, name)
+  if isinstance(value, (list, tuple)):
+    return tuple(_freeze_value(v, name) for v in value)
+  return value
+
+
+class LiveSettings(FrozenSettings):
+  """Root of a settings tree that can be replaced in place, so that modules
+  holding on to it (`from config import settings`) see a reload. Sections
+  below it are `FrozenSettings`; a reader racing a reload may see some
+  sections from before and some from after it, never a half built one.
+  """
+  __slots__ = ('__dict__',)
+
+  def __init__(self, frozen=None):
+    if frozen is not None:
+      self.replace(frozen)
+
+  def replace(self, frozen):
+    """Take over the sections of the `FrozenSettings` tree `frozen`"""
+    new = dict(frozen.items())
+    self.__dict__.update(new)
+    for key in set(self.__dict__) - set(new):
+      del self.__dict__[key]
+
+  def keys(self):
+    return sorted(self.__dict__)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""Small thread based work pipeline.
+
+A `Pipeline` is a list of stages, each with its own pool of worker threads.
+Items flow from one stage to the next through bounded queues, so at most a
+handful of items are in flight per stage regardless of how many are fed in.
+
+    pipeline = Pipeline([('download', download, 8), ('upload', upload, 4)])
+    results = pipeline.run(items)
+
+Results come back in input order, so callers get deterministic output no
+matter how the threads were scheduled.
+"""
+import logging
+import threading
+import Queue
+
+
+log = logging.getLogger(__name__)
+_STOP = object()
+
+
+class PipelineError(Exception):
+  """Raised by `Pipeline.run` when one or more items failed. `errors` maps the
+  input index of every failed item to the exception it raised.
+  """
+  def __init__(self, errors):
+    self.errors = errors
+    first = errors[min(errors)]
+    super(PipelineError, self).__init__(
+        '%d item(s) failed, first error: %r' % (len(errors), first))
+
+
+class Pipeline(object):
+  """Runs items through a list of `(name, func, workers)` stages. Each `func`
+  takes the output of the previous stage and returns the input of the next.
+  """
+  def __init__(self, stages, queue_factor=2):
+    self.stages = [(name, func, max(1, int(workers or 1)))
+                   for name, func, workers in stages]
+    self.queue_factor = queue_factor
+
+  def run(self, items):
+    """Push every item through all stages and return the list of results in
+    input order. `items` may be any iterable and is consumed lazily. Failed
+    items are dropped from later stages; once everything has drained a
+    `PipelineError` is raised if anything failed.
+    """
+    results = {}
+    errors = {}
+    queues = [Queue.Queue(maxsize=workers * self.queue_factor)
+              for _, _, workers in self.stages]
+
+    pools = []
+    for i, (name, func, workers) in enumerate(self.stages):
+      out = queues[i + 1] if i + 1 < len(queues) else None
+      threads = [threading.Thread(target=self._work,
+                                  name='%s-%d' % (name, n),
+                                  args=(name, func, queues[i], out, results,
+                                        errors))
+                 for n in range(workers)]
+      for t in threads:
+        t.daemon = True
+        t.start()
+      pools.append(threads)
+
+    count = 0
+    for idx, item in enumerate(items):
+      queues[0].put((idx, item))
+      count += 1
+
+    # Shut stages down in order, so each one only stops once everything
+    # upstream of it has been handed over.
+    for q, threads in zip(queues, pools):
+      for _ in threads:
+        q.put(_STOP)
+      for t in threads:
+        t.join()
+
+    if errors:
+      raise PipelineError(errors)
+    return [results.get(idx) for idx in range(count)]
+
+  @staticmethod
+  def _work(name, func, inbox, outbox, results, errors):
+    while True:
+      job = inbox.get()
+      if job is _STOP:
+        return
+      idx, value = job
+      try:
+        value = func(value)
+      except Exception as e:
+        log.exception('Stage "%s" failed on item %d', name, idx)
+        errors[idx] = e
+        continue
+      if outbox is None:
+        results[idx] = value
+      else:
+        outbox.put((idx, value))
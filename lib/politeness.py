@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""Per host rate limiting for outgoing HTTP requests.
+
+Every host gets a token bucket: `rate` requests per second on average, with
+bursts of up to `burst` requests. `PoliteAdapter` is a `requests` transport
+adapter that waits for a token before each request it sends to the network,
+and caps the connections open to one host through its connection pool
+(`pool_maxsize` with `pool_block`), so a crawl can run many workers without
+hammering any single origin or CDN.
+
+    throttle = HostThrottle(rate=5, burst=10)
+    adapter = PoliteAdapter(throttle, pool_maxsize=4, pool_block=True)
+    session.mount('http://', adapter)
+"""
+from collections import defaultdict
+import logging
+import threading
+import time
+import timeit
+import urlparse
+
+from requests.adapters import HTTPAdapter
+
+from lib import stats
+
+
+log = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+  """Hands out `rate` tokens per second, holding at most `burst`.
+
+  Tokens are reserved rather than waited for under the lock: `reserve`
+  always takes one, possibly going into debt, and returns how long the
+  caller has to wait before using it. Callers are served in arrival order.
+  """
+  __slots__ = ('rate', 'burst', 'tokens', 'stamp', '_lock')
+
+  def __init__(self, rate, burst):
+    self.rate = float(rate)
+    self.burst = max(1.0, float(burst))
+    self.tokens = self.burst
+    self.stamp = timeit.default_timer()
+    self._lock = threading.Lock()
+
+  def reserve(self):
+    """Take a token, returns the number of seconds to wait before using it
+    """
+    with self._lock:
+      now = timeit.default_timer()
+      self.tokens = min(self.burst,
+                        self.tokens + (now - self.stamp) * self.rate)
+      self.stamp = now
+      self.tokens -= 1
+      if self.tokens >= 0:
+        return 0.0
+      return -self.tokens / self.rate
+
+
+class HostThrottle(object):
+  """One `TokenBucket` per host. A `rate` of 0 disables throttling."""
+  def __init__(self, rate, burst=1):
+    self.rate = rate
+    self.burst = burst
+    self._lock = threading.Lock()
+    self._buckets = defaultdict(self._new_bucket)
+
+  def _new_bucket(self):
+    return TokenBucket(self.rate, self.burst)
+
+  def wait(self, host):
+    """Block until a request to `host` may be sent"""
+    if not self.rate:
+      return
+    with self._lock:
+      bucket = self._buckets[host]
+    delay = bucket.reserve()
+    if delay:
+      stats.observe('throttle_wait_seconds', delay, host=host)
+      time.sleep(delay)
+
+
+class PoliteAdapter(HTTPAdapter):
+  """`HTTPAdapter` that goes through a `HostThrottle` before every request"""
+  def __init__(self, throttle=None, **kwargs):
+    self.throttle = throttle
+    super(PoliteAdapter, self).__init__(**kwargs)
+
+  def send(self, request, **kwargs):
+    if self.throttle is not None:
+      self.throttle.wait(urlparse.urlparse(request.url).netloc)
+    return super(PoliteAdapter, self).send(request, **kwargs)
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""Retries with jittered exponential backoff, per key circuit breakers and
+hedged calls.
+
+    retry(fetch, attempts=3, base_delay=0.5, retry_on=(IOError,))
+
+    breakers = CircuitBreakers(failures=5, reset_sec=60)
+    with breakers.guard('example.com'):
+      ...                       # raises CircuitOpenError while open
+
+    hedged(fetch, after=1.5)    # second try if the first is slow
+"""
+from collections import defaultdict
+import logging
+import random
+import threading
+import time
+import timeit
+import Queue
+
+from lib import stats
+
+
+log = logging.getLogger(__name__)
+
+
+def backoff_delay(attempt, base_delay, max_delay):
+  """Delay before retry number `attempt` (0 based), with "full jitter":
+  between 0 and `base_delay * 2 ** attempt`, capped at `max_delay`
+  """
+  return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+def retry(func, attempts=3, base_delay=0.5, max_delay=30.0,
+          retry_on=(Exception,), should_retry=None, name=None):
+  """Call `func()` until it succeeds, at most `attempts` times. Exceptions in
+  `retry_on` for which `should_retry(exc)` (if given) is true are retried
+  after a jittered backoff; anything else, or the last failure, is raised.
+  """
+  for attempt in range(attempts):
+    try:
+      return func()
+    except retry_on as e:
+      if attempt + 1 >= attempts or (should_retry and not should_retry(e)):
+        raise
+      delay = backoff_delay(attempt, base_delay, max_delay)
+      log.info('%s failed (%r), retrying in %.2fs', name or 'Call', e, delay)
+      stats.incr('retries', call=name or 'call')
+      time.sleep(delay)
+
+
+class CircuitOpenError(Exception):
+  """Raised instead of calling out while a circuit is open"""
+
+
+class _Circuit(object):
+  __slots__ = ('failures', 'opened_at')
+
+  def __init__(self):
+    self.failures = 0
+    self.opened_at = None
+
+
+class CircuitBreakers(object):
+  """One circuit breaker per key (e.g. per host). After `failures`
+  consecutive failures a circuit opens and calls fail fast for `reset_sec`;
+  then a single trial call is let through (half open), which closes the
+  circuit again if it succeeds. `failures` of 0 disables the breakers.
+  """
+  def __init__(self, failures=5, reset_sec=60.0):
+    self.failures = failures
+    self.reset_sec = reset_sec
+    self._lock = threading.Lock()
+    self._circuits = defaultdict(_Circuit)
+
+  def allow(self, key):
+    """Whether a call for `key` may go ahead now"""
+    if not self.failures:
+      return True
+    with self._lock:
+      circuit = self._circuits[key]
+      if circuit.opened_at is None:
+        return True
+      if timeit.default_timer() - circuit.opened_at >= self.reset_sec:
+        # Half open: let this call through, hold the others off
+        circuit.opened_at = timeit.default_timer()
+        return True
+      return False
+
+  def success(self, key):
+    if not self.failures:
+      return
+    with self._lock:
+      circuit = self._circuits.pop(key, None)
+    if circuit is not None and circuit.opened_at is not None:
+      log.info('Circuit for %s closed', key)
+
+  def failure(self, key):
+    if not self.failures:
+      return
+    with self._lock:
+      circuit = self._circuits[key]
+      circuit.failures += 1
+      if circuit.failures >= self.failures:
+        if circuit.opened_at is None:
+          log.warn('Circuit for %s opened after %d failures', key,
+                   circuit.failures)
+          stats.incr('circuit_opened', key=key)
+        circuit.opened_at = timeit.default_timer()
+
+  def guard(self, key):
+    """Context manager: raises `CircuitOpenError` if the circuit for `key` is
+    open, and records the outcome of the block otherwise
+    """
+    return _Guard(self, key)
+
+
+class _Guard(object):
+  __slots__ = ('breakers', 'key')
+
+  def __init__(self, breakers, key):
+    self.breakers = breakers
+    self.key = key
+
+  def __enter__(self):
+    if not self.breakers.allow(self.key):
+      stats.incr('circuit_rejected', key=self.key)
+      raise CircuitOpenError('Circuit for %s is open' % self.key)
+    return self
+
+  def __exit__(self, exc_type, exc, tb):
+    if exc_type is None:
+      self.breakers.success(self.key)
+    else:
+      self.breakers.failure(self.key)
+    return False
+
+
+def hedged(func, after, hedges=1, discard=None):
+  """Call `func()`; if it hasn't returned after `after` seconds, start
+  another call (up to `hedges` extra ones, `after` seconds apart) and return
+  whichever succeeds first. Losing calls run to completion in the
+  background and their results are passed to `discard` (e.g. to delete a
+  temp file). Raises the last error if every call fails.
+  """
+  results = Queue.Queue()
+  state = {'done': False}
+  lock = threading.Lock()
+
+  def call():
+    try:
+      outcome = (True, func())
+    except Exception as e:
+      outcome = (False, e)
+    with lock:
+      winner = outcome[0] and not state['done']
+      if winner:
+        state['done'] = True
+    if outcome[0] and not winner:
+      if discard is not None:
+        discard(outcome[1])
+      return
+    results.put(outcome)
+
+  def start():
+    thread = threading.Thread(target=call)
+    thread.daemon = True
+    thread.start()
+
+  start()
+  started = pending = 1
+  while True:
+    can_hedge = started <= hedges
+    try:
+      ok, value = results.get(timeout=after if can_hedge else None)
+    except Queue.Empty:
+      # Every call so far is still running: hedge
+      stats.incr('hedged_requests')
+      start()
+      started += 1
+      pending += 1
+      continue
+    pending -= 1
+    if ok:
+      return value
+    if not pending:
+      raise value
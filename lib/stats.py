@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+""" Lightweight, process wide timing and counter instrumentation.
+
+    from lib import stats
+
+    with stats.timer('download', host='example.com'):
+      ...
+    stats.incr('download_bytes', 1024, host='example.com')
+
+    @stats.timed('parse')
+    def parse(...):
+      ...
+
+Timers feed latency histograms (`<name>_seconds`) and count failures in
+`<name>_errors`. Everything is keyed by metric name plus labels, and can be
+dumped with `to_json()` or `to_prometheus()` at the end of a run.
+
+Instrumentation is off unless `stats.enable()` is called (or `stats.enabled`
+is set in the config); while off, `timer()` hands back a shared no-op context
+manager and `incr`/`observe` return right away.
+"""
+from bisect import bisect_left
+from functools import wraps
+import json
+import threading
+import timeit
+
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float('inf'))
+PREFIX = 'tessen_'
+
+
+class Histogram(object):
+  __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+  def __init__(self, bounds=LATENCY_BUCKETS):
+    self.bounds = bounds
+    self.counts = [0] * len(bounds)
+    self.sum = 0.0
+    self.count = 0
+
+  def observe(self, value):
+    self.counts[bisect_left(self.bounds, value)] += 1
+    self.sum += value
+    self.count += 1
+
+  def quantile(self, q):
+    """Upper bound of the bucket holding the q-th quantile"""
+    if not self.count:
+      return 0.0
+    rank = q * self.count
+    seen = 0
+    for bound, count in zip(self.bounds, self.counts):
+      seen += count
+      if seen >= rank:
+        return bound
+    return self.bounds[-1]
+
+  def to_dict(self):
+    return dict(count=self.count, sum=self.sum,
+                mean=self.sum / self.count if self.count else 0.0,
+                p50=finite(self.quantile(0.5)),
+                p90=finite(self.quantile(0.9)),
+                p99=finite(self.quantile(0.99)))
+
+
+def finite(value):
+  """`value`, or None if it is infinite (JSON has no Infinity): a quantile
+  past the last finite bucket is only known to be above it
+  """
+  if value in (float('inf'), float('-inf')):
+    return None
+  return value
+
+
+class _NullTimer(object):
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer(object):
+  __slots__ = ('registry', 'name', 'labels', 'start')
+
+  def __init__(self, registry, name, labels):
+    self.registry = registry
+    self.name = name
+    self.labels = labels
+
+  def __enter__(self):
+    self.start = timeit.default_timer()
+    return self
+
+  def __exit__(self, exc_type, exc, tb):
+    elapsed = timeit.default_timer() - self.start
+    self.registry.observe(self.name + '_seconds', elapsed, **self.labels)
+    if exc_type is not None:
+      self.registry.incr(self.name + '_errors', **self.labels)
+    return False
+
+
+class Registry(object):
+  """Thread safe store of counters and histograms"""
+  def __init__(self):
+    self.enabled = False
+    self._lock = threading.Lock()
+    self._counters = {}
+    self._histograms = {}
+
+  @staticmethod
+  def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+  def incr(self, name, value=1, **labels):
+    if not self.enabled:
+      return
+    key = self._key(name, labels)
+    with self._lock:
+      self._counters[key] = self._counters.get(key, 0) + value
+
+  def observe(self, name, value, **labels):
+    if not self.enabled:
+      return
+    key = self._key(name, labels)
+    with self._lock:
+      hist = self._histograms.get(key)
+      if hist is None:
+        hist = self._histograms[key] = Histogram()
+      hist.observe(value)
+
+  def timer(self, name, **labels):
+    if not self.enabled:
+      return _NULL_TIMER
+    return _Timer(self, name, labels)
+
+  def reset(self):
+    with self._lock:
+      self._counters.clear()
+      self._histograms.clear()
+
+  def to_dict(self):
+    """`{"counters": [...], "histograms": [...]}`, each entry carrying its
+    name, labels and value(s)
+    """
+    with self._lock:
+      counters = sorted(self._counters.items())
+      histograms = sorted((k, h.to_dict()) for k, h in
+                          self._histograms.items())
+    return dict(
+        counters=[dict(name=name, labels=dict(labels), value=value)
+                  for (name, labels), value in counters],
+        histograms=[dict(summary, name=name, labels=dict(labels))
+                    for (name, labels), summary in histograms])
+
+  def to_json(self):
+    return json.dumps(self.to_dict(), indent=2, sort_keys=True)
+
+  def to_prometheus(self):
+    """Prometheus text exposition format"""
+    lines = []
+    with self._lock:
+      counters = sorted(self._counters.items())
+      histograms = sorted((k, (h.bounds, list(h.counts), h.sum, h.count))
+                          for k, h in self._histograms.items())
+    typed = set()
+    for (name, labels), value in counters:
+      metric = PREFIX + name + '_total'
+      if metric not in typed:
+        typed.add(metric)
+        lines.append('# TYPE %s counter' % metric)
+      lines.append('%s%s %s' % (metric, _labels(labels), value))
+    for (name, labels), (bounds, counts, total, count) in histograms:
+      metric = PREFIX + name
+      if metric not in typed:
+        typed.add(metric)
+        lines.append('# TYPE %s histogram' % metric)
+      cumulative = 0
+      for bound, n in zip(bounds, counts):
+        cumulative += n
+        le = '+Inf' if bound == float('inf') else repr(bound)
+        lines.append('%s_bucket%s %d' % (
+            metric, _labels(labels + (('le', le),)), cumulative))
+      lines.append('%s_sum%s %r' % (metric, _labels(labels), total))
+      lines.append('%s_count%s %d' % (metric, _labels(labels), count))
+    return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+  if not labels:
+    return ''
+  return '{%s}' % ','.join(
+      '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')
+                   .replace('\n', '\\n'))
+      for k, v in labels)
+
+
+registry = Registry()
+incr = registry.incr
+observe = registry.observe
+timer = registry.timer
+
+
+def enable(on=True):
+  registry.enabled = on
+
+
+def timed(name, **labels):
+  """Decorator timing every call of the wrapped function under `name`"""
+  def decorator(func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+      if not registry.enabled:
+        return func(*args, **kwargs)
+      with _Timer(registry, name, labels):
+        return func(*args, **kwargs)
+    return wrapper
+  return decorator
@@ -6,6 +6,7 @@ from decimal import Decimal
 from urlparse import urlparse
 from uuid import UUID
 import HTMLParser
+import hashlib
 import json
 import os
 import random
@@ -13,8 +14,7 @@ import re
 import string
 import urllib
 import calendar
-
-import requests
+import tempfile
 
 
 _hashtag_re = re.compile(r'\B#(\w{2,100})', re.I | re.U)
@@ -61,6 +61,7 @@ def to_json(obj):
 def ping_url(url, params=None):
   """Do a GET request against a url with optional params. Used predominantly
   for conversion and tracking pixels."""
+  import requests
   requests.get(url, params=params)
 
 
@@ -70,6 +71,29 @@ def apath(*args):
   return os.path.abspath(os.path.join(*args))
 
 
+def spool_to_file(chunks, dir=None):
+  """Write an iterable of byte strings to a new temp file, hashing as it goes,
+  so that only one chunk is ever held in memory. The caller owns (and should
+  delete) the file.
+
+  :returns: (file path, sha256 hexdigest, size in bytes)
+  """
+  digest = hashlib.sha256()
+  size = 0
+  fd, path = tempfile.mkstemp(prefix='tessen-', dir=dir)
+  try:
+    with os.fdopen(fd, 'wb') as f:
+      for chunk in chunks:
+        if chunk:
+          digest.update(chunk)
+          size += len(chunk)
+          f.write(chunk)
+  except Exception:
+    os.unlink(path)
+    raise
+  return path, digest.hexdigest(), size
+
+
 def random_str(length=20):
   _chars = string.letters + string.digits
   return ''.join([random.choice(_chars) for i in range(length)])
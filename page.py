@@ -1,40 +1,105 @@
 # -*- coding: utf-8 -*-
 """ Utilities for parsing HTML pages and rewriting their asset locations
 """
-import bs4
-import hashlib
-import json
+from collections import namedtuple
 import logging
 import mimetypes
 import os
-import subprocess
+import time
 import urlparse
 
-import config as cfg
+from config import settings
+from lib import stats
+from lib.retry import hedged
+from lib.utils import spool_to_file
+import render
+from rewriter import SplitAttr, StreamRewriter
 import session
 
 
 log = logging.getLogger(__name__)
 IMAGE_LOCATION_ATTRS = ('src', 'data-src')
+# Urls with these schemes are inline or not fetchable, leave them alone
+SKIPPED_SCHEMES = ('data:', 'javascript:', 'about:', 'blob:', 'mailto:')
 
 
-# TODO: Get this phantom stuff somewhere else
-PHANTOM_BIN = '/usr/local/bin/phantomjs'
-PHANTOM_SCRIPT = os.path.join(cfg.basedir, 'js-src', 'pageScraper.js')
-PHANTOM_SWITCHES = ['--ssl-protocol=tlsv1', '--ignore-ssl-errors=true']
+# How assets are found in a tag. `kind` is one of
+#  'url':    the first of `attrs` that is present holds a single url
+#  'srcset': every one of `attrs` that is present holds a srcset
+#  'style':  every one of `attrs` that is present holds CSS with url()s
+# `tag` '*' matches every tag.
+AssetRule = namedtuple('AssetRule', 'tag attrs default_extension kind')
 
 
-def get_page_from_webkit(url):
-  """Call the page scraper phantomjs module with given URL.
+ASSET_RULES = [
+    AssetRule('script', ('src',), '.js', 'url'),
+    AssetRule('link', ('href',), '.css', 'url'),
+    AssetRule('iframe', ('src',), '.html', 'url'),
+    AssetRule('img', IMAGE_LOCATION_ATTRS, '.jpeg', 'url'),
+    AssetRule('img', ('srcset', 'data-srcset'), '.jpeg', 'srcset'),
+    AssetRule('source', ('src',), None, 'url'),
+    AssetRule('source', ('srcset',), '.jpeg', 'srcset'),
+    AssetRule('video', ('poster',), '.jpeg', 'url'),
+    AssetRule('object', ('data',), None, 'url'),
+    AssetRule('*', ('style',), None, 'style'),
+]
+
+
+def add_asset_rule(tag, attrs, default_extension=None, kind='url'):
+  """Teach `Page` about another place assets hide, e.g.
+
+      add_asset_rule('div', ('data-background',), '.jpeg')
+
+  Affects pages parsed from then on.
+  """
+  if kind not in ('url', 'srcset', 'style'):
+    raise ValueError('Unknown asset rule kind "%s"' % kind)
+  ASSET_RULES.append(AssetRule(tag, tuple(attrs), default_extension, kind))
+
+
+def _rules_by_tag(rules):
+  """{tag: [rules]}, with the '*' rules folded into every other tag and kept
+  under '*' for tags without rules of their own
+  """
+  by_tag = {}
+  for rule in rules:
+    by_tag.setdefault(rule.tag, []).append(rule)
+  wildcard = by_tag.get('*', [])
+  for tag in by_tag:
+    if tag != '*':
+      by_tag[tag] = by_tag[tag] + wildcard
+  return by_tag
+
+
+def get_page_from_webkit(url, profile=None):
+  """Render the given URL on the shared phantomjs worker pool (see `render`).
+  `profile` picks which requests the renderer blocks and its deadline, it
+  defaults to the `render.profile` settings.
 
   NOTE: this function should probably be deprecated in favor of alternative
   page scrapers.
   """
-  cmd = [PHANTOM_BIN] + PHANTOM_SWITCHES + [PHANTOM_SCRIPT, url]
-  proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-  out, _ = proc.communicate()
-  results = json.loads(out)
-  return results['html'].encode('utf8')
+  return render_page(url, profile)[0]
+
+
+def render_page(url, profile=None):
+  """Like `get_page_from_webkit`, also returning the sub-resources the
+  renderer captured (see `render.captured_responses`), to pass on to `Page`.
+
+  :returns: (html, {url: `render.CapturedResponse`})
+  """
+  host = urlparse.urlparse(url).netloc
+  if profile is None:
+    profile = render.default_profile()
+  with stats.timer('render', host=host):
+    results = render.get_pool().render(url, profile)
+  html = results['html'].encode('utf8')
+  stats.incr('render_bytes', len(html), host=host)
+  stats.incr('render_blocked', results.get('blocked', 0), host=host)
+  if results.get('partial'):
+    log.info('Render deadline hit for %s, using the DOM so far', url)
+    stats.incr('render_partial', host=host)
+  return html, render.captured_responses(results)
 
 
 class Page(object):
@@ -43,26 +108,68 @@ class Page(object):
 
   The `Page` class scans through an HTML document, registering static assets
   under `Page.assets`.
+
+  `rewriter` picks how: 'soup' (default, see `page.rewriter` in the config)
+  builds a BeautifulSoup tree, 'stream' uses the single pass
+  `rewriter.StreamRewriter` and never builds a DOM (`Page.soup` is None).
+
+  `captured` holds responses the renderer already received, by url (see
+  `render_page`). Those matching an asset are kept in `Page.captured`, so
+  the asset is taken from there instead of being downloaded again.
   """
 
-  def __init__(self, page_url, html=None):
+  def __init__(self, page_url, html=None, rewriter=None, captured=None):
     self.url = page_url
     self.parsed = urlparse.urlparse(page_url)
     self.assets = []
-    self.session = session.generate_session()
+    self.session = session.get_session()
     if html is None:
-      self._response = self.session.get(page_url)
+      self._response = session.fetch(page_url, self.session)
       self._html = self._response.content
     else:
       self._response = None
       self._html = html
-    self.soup = bs4.BeautifulSoup(self._html)
-    self.rewrite_html()
+    self._rewriter = rewriter or settings.page.rewriter
+    self._rules = None
+    with stats.timer('parse', rewriter=self._rewriter):
+      self.parse()
+      self.rewrite_html()
+    stats.incr('parse_bytes', len(self._html), rewriter=self._rewriter)
+    stats.incr('assets', len(self.assets))
+    self.captured = {}
+    if captured:
+      self.captured = dict((asset.asset_url, captured[asset.asset_url])
+                           for asset in self.assets
+                           if asset.asset_url in captured)
+      stats.incr('captured_assets', len(self.captured))
+
+  def parse(self):
+    """(Re)parse the raw HTML, dropping any previously registered assets.
+    `rewrite_html` has to run again afterwards.
+    """
+    self.assets = []
+    self.soup = None
+    self._stream = None
+    self._rules = _rules_by_tag(ASSET_RULES)
+    if self._rewriter == 'stream':
+      self._stream = StreamRewriter(self._html, self._wanted_attrs)
+    else:
+      # Imported here so stream rewriting never loads BeautifulSoup
+      import bs4
+      self.soup = bs4.BeautifulSoup(self._html)
+
+  def _rules_for(self, tag):
+    return self._rules.get(tag) or self._rules.get('*', ())
+
+  def _wanted_attrs(self, tag):
+    return [attr for rule in self._rules_for(tag) for attr in rule.attrs]
 
   @property
   def rewritten(self):
     """HTML with asset locations rewritten
     """
+    if self._stream is not None:
+      return self._stream.rewritten()
     return str(self.soup)
 
   @property
@@ -76,7 +183,8 @@ class Page(object):
     scheme-less or relative URL is provided), and creates an `Asset` instance
     and appends to self.assets.
 
-    :param asset: BeautifulSoup node
+    :param asset: BeautifulSoup node (or any node-like object from
+                  `rewriter`)
     :param url_attr: the name of the HTML attribute that holds the asset name
                      location. (e.g., 'href' or 'src'). Allows us to rewrite
                      the url later on
@@ -85,7 +193,9 @@ class Page(object):
     """
     # If the URL is scheme-less or relative, rewrite as fully qualified. This
     # needs to happen here so we can use the parsed url of the base page.
-    asset_url = asset.attrs[url_attr]
+    asset_url = asset.attrs[url_attr].strip()
+    if asset_url.lower().startswith(SKIPPED_SCHEMES):
+      return
     if asset_url.startswith('//'): # Scheme less
       asset_url = ':'.join((self.parsed.scheme, asset_url))
     elif not asset_url.startswith('http'): # Relative
@@ -95,34 +205,47 @@ class Page(object):
     self.assets.append(_asset)
 
   def rewrite_html(self):
-    """ Rewrites asset locations in the HTML, and calls
-    `register_and_rename_asset` on each asset url.
+    """ Finds the assets in the HTML in a single walk over its tags, driven by
+    `ASSET_RULES`, and calls `register_asset` on each asset url.
     """
-    # JS
-    for script in self.soup.find_all('script'):
-      if script.attrs.get('src'):
-        script.attrs['src'] = self.register_asset(script, 'src', '.js')
-
-    # CSS, etc
-    for link in self.soup.find_all('link'):
-      if link.attrs.get('href'):
-        link.attrs['href'] = self.register_asset(link, 'href', '.css')
-
-    # Iframes
-    for iframe in self.soup.find_all('iframe'):
-      if iframe.attrs.get('src'):
-        iframe.attrs['src'] = self.register_asset(iframe, 'src', '.html')
-
-    # Images
-    for img in self.soup.find_all('img'):
-      for attr_name in IMAGE_LOCATION_ATTRS:
-        if attr_name in img.attrs:
-          break
-      else:
-        attr_name = None
-      if attr_name is None:
+    if self._stream is not None:
+      tags = self._stream.tags
+    else:
+      tags = self.soup.find_all(True)
+    for tag in tags:
+      for rule in self._rules_for(tag.name):
+        self._apply_rule(tag, rule)
+
+  def _apply_rule(self, tag, rule):
+    if rule.kind == 'url':
+      for attr_name in rule.attrs:
+        if tag.attrs.get(attr_name):
+          self.register_asset(tag, attr_name, rule.default_extension)
+          return
+      return
+    for attr_name in rule.attrs:
+      if not tag.attrs.get(attr_name):
         continue
-      self.register_asset(img, attr_name, '.jpeg')
+      if rule.kind == 'srcset':
+        split = SplitAttr.from_srcset(tag, attr_name)
+      else:
+        split = SplitAttr.from_style(tag, attr_name)
+      for part in split.parts():
+        self.register_asset(part, attr_name, rule.default_extension)
+
+
+# An asset response: its headers and (path, hash, size) of the spooled body,
+# None for a 304 Not Modified
+_Fetched = namedtuple('_Fetched', 'headers body')
+
+
+def _discard(fetched):
+  """Delete the body of a download that lost a hedged race"""
+  if fetched.body is not None:
+    try:
+      os.unlink(fetched.body[0])
+    except OSError:
+      pass
 
 
 class Asset(object):
@@ -131,39 +254,155 @@ class Asset(object):
 
   We infer the file extension based on Content Type header returned from the
   HTTP request. The Asset object provides a proxy for updating the HTML page.
+
+  Assets are content addressed: once downloaded, `hash` is the sha256 of the
+  response body, so the same file referenced from many pages (or under many
+  different URLs) always ends up with the same `name`.
+
+  Pages can reference thousands of assets, so instances are kept small: the
+  class uses `__slots__`, only the content type of the response is kept, the
+  body is streamed to a temp file (`path`) in `pipeline.chunk_size` chunks
+  and deleted by `release` once stored, and the node reference is dropped
+  once `rewrite` has pointed it at its final url.
+
+  The response's validators (`etag`, `last_modified`) and fetch time are
+  kept for the snapshot manifest, so a later recrawl can ask the server
+  whether the asset changed.
   """
+  __slots__ = ('_asset', '_url_attr', '_content_type', '_file_extension',
+               '_default_file_extension', 'name', 'hash', 'path', 'size',
+               'asset_url', 'etag', 'last_modified', 'fetched_at')
+
   def __init__(self, asset, asset_url, url_attr, default_file_extension=None):
     # Note: even though we can get the asset url from the asset, it is often
     # scheme-less or relative. Therefore, we expect the `asset_url` param to be
     # fully qualified.
     self._asset = asset
     self._url_attr = url_attr
-    self._response = None
+    self._content_type = None
     self._file_extension = None
     self._default_file_extension = default_file_extension
     self.name = None
-    self.hash = hashlib.md5(self._asset[self._url_attr]).hexdigest()
+    self.hash = None
+    self.path = None
+    self.size = None
     self.asset_url = asset_url
+    self.etag = None
+    self.last_modified = None
+    self.fetched_at = None
+
+  @property
+  def content_type(self):
+    """Content type of the response, without parameters"""
+    if self._content_type:
+      return self._content_type.split(';')[0].strip()
+    return None
 
   @property
   def content(self):
-    """ Return the request content (to save to file)
+    """ Return the request content (to save to file). Reads the whole body
+    into memory, prefer storing from `path`.
     """
-    return self._response.content
+    with open(self.path, 'rb') as f:
+      return f.read()
 
-  def download(self, session_):
+  def download(self, session_, chunk_size=None, previous=None):
     """Requests and stores asset. We pass in the session object explicitly here
     in case we need to modify headers/cookies later on in the storage cycle.
+
+    The body is streamed into a temp file and hashed on the fly.
+
+    `previous` is the `storage.manifest.ManifestEntry` of this url from the
+    last snapshot, if any: its validators make the request conditional. If
+    the server answers 304 Not Modified there is no body, `name` (and what
+    else is known) is taken from the previous entry and False is returned;
+    otherwise True.
+
+    Requests time out, are retried and go through the host's circuit
+    breaker (see `session.call_with_retries`); with `http.hedge_after_sec`
+    set, a slow download is raced against a second request.
+    """
+    chunk_size = chunk_size or settings.pipeline.chunk_size
+    host = urlparse.urlparse(self.asset_url).netloc
+    headers = {}
+    if previous is not None:
+      if previous.etag:
+        headers['If-None-Match'] = previous.etag
+      if previous.last_modified:
+        headers['If-Modified-Since'] = previous.last_modified
+    self.release()
+    self.fetched_at = time.time()
+
+    def fetch():
+      return session.call_with_retries(
+          lambda: self._fetch(session_, headers, chunk_size), host)
+    hedge_after = settings.http.hedge_after_sec
+    with stats.timer('download', host=host):
+      if hedge_after:
+        fetched = hedged(fetch, hedge_after, discard=_discard)
+      else:
+        fetched = fetch()
+    if fetched.body is None:
+      self.name = previous.name
+      self.hash = previous.digest
+      self.size = previous.size
+      self._content_type = previous.content_type
+      self.etag = fetched.headers.get('etag', previous.etag)
+      self.last_modified = previous.last_modified
+      stats.incr('download_not_modified', host=host)
+      return False
+    self._content_type = fetched.headers.get('content-type', '')
+    self.etag = fetched.headers.get('etag')
+    self.last_modified = fetched.headers.get('last-modified')
+    self.path, self.hash, self.size = fetched.body
+    stats.incr('download_bytes', self.size, host=host)
+    return True
+
+  def _fetch(self, session_, headers, chunk_size):
+    """One request for the asset, with the body spooled to a temp file.
+    Doesn't touch the asset, so hedged calls can race each other.
+    """
+    response = session.check_status(session_.get(
+        self.asset_url, stream=True, headers=headers or None,
+        timeout=session.timeouts()))
+    try:
+      if response.status_code == 304 and headers:
+        return _Fetched(response.headers, None)
+      return _Fetched(response.headers,
+                      spool_to_file(response.iter_content(chunk_size)))
+    finally:
+      response.close()
+
+  def load_captured(self, response):
+    """Take the body and headers of the asset from a `render.
+    CapturedResponse` instead of downloading it
     """
-    self._response = session_.get(self.asset_url)
+    self.release()
+    self.fetched_at = time.time()
+    self._content_type = response.headers.get('content-type',
+                                              response.content_type or '')
+    self.etag = response.headers.get('etag')
+    self.last_modified = response.headers.get('last-modified')
+    self.path, self.hash, self.size = spool_to_file([response.body])
 
+  def release(self):
+    """Delete the downloaded body, if any"""
+    if self.path is not None:
+      try:
+        os.unlink(self.path)
+      except OSError:
+        pass
+      self.path = None
+
+  @stats.timed('extension')
   def _get_file_extension(self):
     """Determine file extension in the following precedence order:
         (1) inspecting content type header,
         (2) inspecting the file extension in the URL, or
         (3) using the optional default file extension.
     """
-    content_string = self._response.headers.get('content-type', '')
+    content_string = self._content_type or ''
+    file_extension = None
     if content_string:
       # Some sites return "content/type; encoding info". Isolate content type
       content_type = content_string.split(';')[0]
@@ -202,4 +441,15 @@ class Asset(object):
       self.name = ''.join((self.hash, self._file_extension))
     else:
       self.name = self.hash
-    self._asset[self._url_attr] = self.name
+    self.rewrite(self.name, final=False)
+
+  def rewrite(self, url, final=True):
+    """Point the asset node at `url`, e.g. the stored copy of the asset
+    relative to the page. Unless `final` is False the node is forgotten
+    afterwards, so later calls are no-ops.
+    """
+    if self._asset is None:
+      return
+    self._asset[self._url_attr] = url
+    if final:
+      self._asset = None
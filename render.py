@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+""" Headless rendering through a pool of long lived PhantomJS workers.
+
+Starting phantomjs and initialising WebKit costs more than rendering most
+pages, so instead of one process per URL we keep `render.workers` processes
+around, each running `js-src/pageScraper.js` in its line based request /
+response mode. Workers are recycled after `render.max_pages_per_worker`
+renders, once their RSS grows past `render.max_rss_mb`, or when a render
+exceeds `render.timeout_sec`.
+
+Each render takes a profile (`default_profile()` reads `render.profile`):
+requests of blocked resource types or matching blocked url patterns are
+aborted by the worker, since the assets we keep are downloaded again by
+`page.Asset` anyway, and after `deadline_sec` the DOM is taken as it is.
+
+With `capture_max_kb` set, the worker also hands back the same-origin
+sub-resources it received, as HAR-like entries (`captured_responses`
+decodes them), so the assets it already has needn't be downloaded a second
+time. Cross-origin ones (CDNs) and blocked types are downloaded as before.
+
+    html = get_pool().render('http://example.com')['html']
+"""
+import atexit
+import base64
+from collections import namedtuple
+import json
+import logging
+import os
+import subprocess
+import threading
+import Queue
+
+import config as cfg
+from config import settings
+
+
+log = logging.getLogger(__name__)
+
+
+PHANTOM_BIN = '/usr/local/bin/phantomjs'
+PHANTOM_SCRIPT = os.path.join(cfg.basedir, 'js-src', 'pageScraper.js')
+PHANTOM_SWITCHES = ['--ssl-protocol=tlsv1', '--ignore-ssl-errors=true']
+# How long past a profile's deadline the worker gets to answer
+DEADLINE_GRACE_SEC = 5
+
+
+# A sub-resource response captured by the renderer. `headers` has lower
+# case names, `body` is the raw bytes
+CapturedResponse = namedtuple('CapturedResponse',
+                              'url status headers content_type body')
+
+
+class RenderError(Exception):
+  """The page could not be rendered"""
+
+
+class RenderTimeout(RenderError):
+  """The worker did not answer within the render timeout"""
+
+
+class RenderWorker(object):
+  """A single phantomjs process serving render requests over stdin/stdout.
+  Not thread safe, `RenderPool` hands each worker to one caller at a time.
+  """
+  def __init__(self):
+    cmd = [PHANTOM_BIN] + PHANTOM_SWITCHES + [PHANTOM_SCRIPT]
+    self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE, bufsize=1)
+    self.pages = 0
+    self._results = Queue.Queue()
+    reader = threading.Thread(target=self._read, name='render-reader-%d' %
+                              self.proc.pid)
+    reader.daemon = True
+    reader.start()
+
+  def _read(self):
+    for line in iter(self.proc.stdout.readline, ''):
+      # Anything that isn't a JSON result is stray console output
+      if line.startswith('{'):
+        self._results.put(line)
+    self._results.put(None)
+
+  @property
+  def alive(self):
+    return self.proc.poll() is None
+
+  def rss_mb(self):
+    """Resident set size of the worker in MB, or 0 if unknown"""
+    try:
+      with open('/proc/%d/status' % self.proc.pid) as f:
+        for line in f:
+          if line.startswith('VmRSS:'):
+            return int(line.split()[1]) / 1024.0
+    except (IOError, ValueError):
+      pass
+    return 0
+
+  def render(self, url, timeout=None, profile=None):
+    """Render `url` and return the decoded result dict from pageScraper.js
+    """
+    request = {'url': url}
+    if profile:
+      request['profile'] = profile
+    try:
+      self.proc.stdin.write(json.dumps(request) + '\n')
+      self.proc.stdin.flush()
+    except IOError as e:
+      raise RenderError('Render worker died: %s' % e)
+    try:
+      line = self._results.get(timeout=timeout)
+    except Queue.Empty:
+      raise RenderTimeout('Rendering "%s" took more than %ss' % (url, timeout))
+    if line is None:
+      raise RenderError('Render worker exited with code %s' % self.proc.poll())
+    self.pages += 1
+    try:
+      return json.loads(line)
+    except ValueError:
+      raise RenderError('Garbled render result for "%s"' % url)
+
+  def close(self):
+    if self.alive:
+      try:
+        self.proc.stdin.close()
+        self.proc.kill()
+      except (IOError, OSError):
+        pass
+    self.proc.wait()
+
+
+class RenderPool(object):
+  """Shares a bounded set of `RenderWorker`s between threads. Workers are
+  started lazily, so an idle pool costs nothing.
+  """
+  def __init__(self, size=None, max_pages=None, max_rss_mb=None,
+               timeout=None):
+    opts = settings.render
+    self.size = size or opts.workers
+    self.max_pages = max_pages or opts.max_pages_per_worker
+    self.max_rss_mb = max_rss_mb or opts.max_rss_mb
+    self.timeout = timeout or opts.timeout_sec
+    self._idle = Queue.LifoQueue()
+    self._slots = threading.BoundedSemaphore(self.size)
+
+  def _checkout(self):
+    self._slots.acquire()
+    try:
+      return self._idle.get_nowait()
+    except Queue.Empty:
+      pass
+    try:
+      return RenderWorker()
+    except Exception:
+      self._slots.release()
+      raise
+
+  def _checkin(self, worker):
+    try:
+      if worker is None:
+        return
+      if not worker.alive or worker.pages >= self.max_pages:
+        worker.close()
+      elif self.max_rss_mb and worker.rss_mb() > self.max_rss_mb:
+        log.info('Recycling render worker %d, RSS above %sMB',
+                 worker.proc.pid, self.max_rss_mb)
+        worker.close()
+      else:
+        self._idle.put(worker)
+    finally:
+      self._slots.release()
+
+  def render(self, url, profile=None):
+    """Render `url` on the next free worker, with `profile` (see
+    `default_profile`).
+
+    :returns: result dict with at least `html`; `partial` is set if the
+      deadline cut the render short
+    :raises: RenderError
+    """
+    timeout = self.timeout
+    if profile and profile.get('deadline_ms'):
+      timeout = max(timeout,
+                    profile['deadline_ms'] / 1000.0 + DEADLINE_GRACE_SEC)
+    worker = self._checkout()
+    try:
+      result = worker.render(url, timeout=timeout, profile=profile)
+    except RenderError:
+      worker.close()
+      worker = None
+      raise
+    finally:
+      self._checkin(worker)
+    if not result.get('success'):
+      raise RenderError('Failed to render "%s": %s' % (
+          url, result.get('error', 'unknown error')))
+    return result
+
+  def warm(self, count=None):
+    """Start `count` workers (all of them by default) now rather than on
+    first use
+    """
+    workers = []
+    try:
+      for _ in range(min(count or self.size, self.size)):
+        workers.append(self._checkout())
+    finally:
+      for worker in workers:
+        self._checkin(worker)
+
+  def close(self):
+    """Stop every idle worker"""
+    while True:
+      try:
+        self._idle.get_nowait().close()
+      except Queue.Empty:
+        return
+
+
+def default_profile():
+  """The render profile from the `render.profile` settings"""
+  opts = settings.render.profile
+  return {'block_types': list(opts.block_types),
+          'block_patterns': list(opts.block_patterns),
+          'deadline_ms': int(opts.deadline_sec * 1000),
+          'capture_max_bytes': int(opts.capture_max_kb * 1024),
+          'capture_total_bytes': int(opts.capture_total_mb * 1024 * 1024)}
+
+
+def captured_responses(result):
+  """{url: `CapturedResponse`} for the entries of a render result"""
+  responses = {}
+  for entry in result.get('entries') or ():
+    url = entry['request']['url']
+    response = entry['response']
+    content = response.get('content') or {}
+    try:
+      body = base64.b64decode(content.get('text') or '')
+    except (TypeError, ValueError):
+      log.warn('Undecodable capture of %s', url)
+      continue
+    headers = dict((h['name'].lower(), h['value'])
+                   for h in response.get('headers') or ())
+    responses[url] = CapturedResponse(
+        url, response.get('status'), headers, content.get('mimeType'), body)
+  return responses
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+  """The process wide `RenderPool` shared by all render callers"""
+  global _pool
+  if _pool is None:
+    with _pool_lock:
+      if _pool is None:
+        _pool = RenderPool()
+        atexit.register(_pool.close)
+  return _pool
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+""" Helpers for rewriting asset urls inside HTML attributes.
+
+`StreamRewriter` is a lighter alternative to building a BeautifulSoup tree
+for every page: it runs the stdlib `HTMLParser` tokenizer over the document
+once, picks out the start tags carrying attributes we care about and keeps
+everything else as untouched source text. No DOM is built; the rewritten
+document is the original text with only those attribute values swapped out.
+The tags it finds are exposed as `StreamTag`s, which quack like the bits of a
+BeautifulSoup node that `page.Page` and `page.Asset` use (`name`,
+`node.attrs[name]` and `node[name]`), so the rest of the pipeline doesn't
+care which rewriter found an asset.
+
+`SplitAttr` handles attributes that hold several urls (`srcset`, inline
+`style` url()s) on either kind of node: each url becomes a node-like part
+that can be rewritten on its own.
+"""
+from cgi import escape
+import HTMLParser
+import re
+import threading
+
+
+_newline_re = re.compile('\n')
+_separators_re = re.compile(r'[\s,]*')
+_non_space_re = re.compile(r'\S+')
+_descriptor_re = re.compile(r'[^,]*')
+_css_url_re = re.compile(r'''(url\(\s*(['"]?))(.*?)(\2\s*\))''', re.I)
+_meta_charset_re = re.compile(r'''<meta[^>]+charset\s*=\s*["']?([\w.:-]+)''',
+                              re.I)
+
+
+def _decode(html):
+  """(text, encoding) for a byte document: the charset of its `<meta>` if
+  it decodes with it, else UTF-8, else latin-1 (which decodes anything and
+  encodes back to the same bytes)
+  """
+  if isinstance(html, unicode):
+    return html, None
+  m = _meta_charset_re.search(html, 0, 2048)
+  for encoding in ([m.group(1)] if m else []) + ['utf8', 'latin-1']:
+    try:
+      return html.decode(encoding), encoding
+    except (LookupError, UnicodeDecodeError):
+      pass
+
+
+class AttrSlot(object):
+  """A start tag attribute value that can be rewritten after parsing.
+
+  :param attrs: the tag's attributes, as parsed
+  :param name: the attribute name
+  :param raw: original source text of the value, quotes included
+  """
+  __slots__ = ('attrs', 'name', 'raw', '_original')
+
+  def __init__(self, attrs, name, raw):
+    self.attrs = attrs
+    self.name = name
+    self.raw = raw
+    self._original = attrs[name]
+
+  def render(self):
+    value = self.attrs[self.name]
+    if value == self._original:
+      return self.raw
+    if isinstance(value, str):
+      value = value.decode('utf8')
+    return u'"%s"' % escape(value, quote=True)
+
+
+class StreamTag(object):
+  """A start tag found by `StreamRewriter`"""
+  __slots__ = ('name', 'attrs')
+
+  def __init__(self, name, attrs):
+    self.name = name
+    self.attrs = attrs
+
+  def __getitem__(self, key):
+    return self.attrs[key]
+
+  def __setitem__(self, key, value):
+    self.attrs[key] = value
+
+
+class StreamRewriter(HTMLParser.HTMLParser):
+  """Tokenizes `html` once and records every start tag that has one of the
+  attributes returned by `wanted(tag_name)` (a collection of attribute
+  names). Changes made to those attributes through `tags` show up in
+  `rewritten()`.
+
+  A byte document is tokenized as text (see `_decode`), so attribute values
+  are unicode like BeautifulSoup's, and `rewritten()` encodes back to the
+  same charset.
+
+      rewriter = StreamRewriter(html, lambda tag: ('src',))
+      for tag in rewriter.tags:
+        tag['src'] = 'new-name.js'
+      rewriter.rewritten()
+  """
+  def __init__(self, html, wanted):
+    HTMLParser.HTMLParser.__init__(self)
+    html, self.encoding = _decode(html)
+    self._html = html
+    self._wanted = wanted
+    self._line_starts = [0] + [m.end() for m in _newline_re.finditer(html)]
+    self._pieces = []
+    self._last = 0
+    self.tags = []
+    self.feed(html)
+    self.close()
+    self._pieces.append(html[self._last:])
+
+  def rewritten(self):
+    """The source document with every changed attribute substituted"""
+    html = u''.join(p if isinstance(p, basestring) else p.render()
+                    for p in self._pieces)
+    if self.encoding is None:
+      return html
+    # New urls the charset can't hold go in as character references
+    return html.encode(self.encoding, 'xmlcharrefreplace')
+
+  def handle_starttag(self, tag, attrs):
+    wanted = self._wanted(tag)
+    if not wanted:
+      return
+    attrs = dict(attrs)
+    names = set(name for name in wanted if attrs.get(name))
+    if not names:
+      return
+    spans = self._value_spans(names)
+    if not spans:
+      return
+    for start, end, name in sorted(spans.values()):
+      self._pieces.append(self._html[self._last:start])
+      self._pieces.append(AttrSlot(attrs, name, self._html[start:end]))
+      self._last = end
+    self.tags.append(StreamTag(tag, attrs))
+
+  handle_startendtag = handle_starttag
+
+  def _value_spans(self, names):
+    """Absolute source offsets of the values (quotes included) of the
+    attributes in `names`, on the start tag currently being handled.
+    """
+    lineno, offset = self.getpos()
+    tag_start = self._line_starts[lineno - 1] + offset
+    text = self.get_starttag_text()
+    k = HTMLParser.tagfind.match(text, 1).end()
+    spans = {}
+    while k < len(text):
+      m = HTMLParser.attrfind.match(text, k)
+      if not m or m.end() == k:
+        break
+      name = m.group(1).lower()
+      # Like the parser (and a dict of its attrs), the last duplicate wins
+      if name in names and m.group(3):
+        start, end = m.span(3)
+        spans[name] = (tag_start + start, tag_start + end, name)
+      k = m.end()
+    return spans
+
+
+class UrlPart(object):
+  """One url inside a `SplitAttr`. Behaves like a node whose `attr`
+  attribute is just that url.
+  """
+  __slots__ = ('split', 'index')
+
+  def __init__(self, split, index):
+    self.split = split
+    self.index = index
+
+  @property
+  def attrs(self):
+    return {self.split.attr: self.split.pieces[self.index]}
+
+  def __getitem__(self, key):
+    return self.split.pieces[self.index]
+
+  def __setitem__(self, key, value):
+    split = self.split
+    # Urls of one attribute are rewritten by concurrent download workers:
+    # write, join and assign together so no update gets lost
+    with split.lock:
+      split.pieces[self.index] = value
+      split.node[split.attr] = ''.join(split.pieces)
+
+
+class SplitAttr(object):
+  """An attribute value holding several urls, kept as a list of text
+  `pieces` of which those at `url_indexes` are urls.
+  """
+  def __init__(self, node, attr, pieces, url_indexes):
+    self.node = node
+    self.attr = attr
+    self.pieces = pieces
+    self.url_indexes = url_indexes
+    self.lock = threading.Lock()
+
+  @classmethod
+  def from_srcset(cls, node, attr):
+    """Split a `srcset` ("a.jpg 1x, b.jpg 2x") into its candidate urls,
+    following the HTML spec's tokenizing rules (urls may contain commas).
+    """
+    value = node.attrs[attr]
+    pieces, urls = [], []
+    pos = 0
+    while pos < len(value):
+      lead = _separators_re.match(value, pos)
+      pos = lead.end()
+      if pos >= len(value):
+        pieces.append(lead.group())
+        break
+      url = _non_space_re.match(value, pos).group()
+      pos += len(url)
+      tail = ''
+      if url.endswith(','):
+        stripped = url.rstrip(',')
+        tail, url = url[len(stripped):], stripped
+      else:
+        descriptor = _descriptor_re.match(value, pos)
+        tail, pos = descriptor.group(), descriptor.end()
+      pieces.append(lead.group())
+      urls.append(len(pieces))
+      pieces.extend((url, tail))
+    return cls(node, attr, pieces, urls)
+
+  @classmethod
+  def from_style(cls, node, attr):
+    """Split the `url(...)` references out of inline CSS"""
+    value = node.attrs[attr]
+    pieces, urls = [], []
+    pos = 0
+    for m in _css_url_re.finditer(value):
+      pieces.append(value[pos:m.start()] + m.group(1))
+      urls.append(len(pieces))
+      pieces.extend((m.group(3), m.group(4)))
+      pos = m.end()
+    pieces.append(value[pos:])
+    return cls(node, attr, pieces, urls)
+
+  def parts(self):
+    return [UrlPart(self, i) for i in self.url_indexes if self.pieces[i]]
@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Long running archiving service: an HTTP API in front of a job queue.
+
+Where `crawl.py` pays for interpreter start, config parsing, backend
+selection and phantomjs startup on every run, the service does that once
+and keeps `service.workers` page workers, the render pool, the HTTP
+session and the storage backend warm between jobs.
+
+    ./service.py --port 8080
+
+    POST /jobs        {"urls": [...], "recrawl": false}, a JSON list of
+                      URLs, or plain text with one URL per line; 202 with
+                      the job, 413 when it has more URLs than the queue
+                      holds, 503 when the queue is full
+    GET  /jobs/<id>   job status and, per URL, the stored index.html's url
+    GET  /stats       queue depth, busy workers, wait and run latencies
+    GET  /metrics     the same plus the `lib.stats` metrics, Prometheus text
+    GET  /health
+
+A job's URLs are queued individually, so one big job is spread over every
+worker. The last `service.keep_jobs` finished jobs can be looked up.
+"""
+import argparse
+from collections import OrderedDict
+import logging
+import threading
+import time
+import timeit
+import uuid
+import Queue
+
+import flask
+
+import config
+from config import settings
+import crawl
+from lib import stats
+import storage
+
+
+log = logging.getLogger(__name__)
+app = flask.Flask(__name__)
+
+
+class QueueFull(Exception):
+  """The job would push the queue past `service.max_queue` URLs"""
+
+
+class JobTooLarge(Exception):
+  """The job has more URLs than `service.max_queue`, it can never be
+  queued
+  """
+
+
+class Job(object):
+  """A list of URLs to archive and what came of each"""
+  def __init__(self, urls, recrawl=False):
+    self.id = uuid.uuid4().hex
+    self.urls = urls
+    self.recrawl = recrawl
+    self.created_at = time.time()
+    self.started_at = None
+    self.finished_at = None
+    # Per URL result dicts, in the order they finished
+    self.results = []
+
+  @property
+  def status(self):
+    if self.finished_at is not None:
+      return 'done'
+    if self.started_at is not None:
+      return 'running'
+    return 'queued'
+
+  def to_dict(self):
+    failed = sum(1 for r in self.results if r['error'])
+    return dict(id=self.id, status=self.status, recrawl=self.recrawl,
+                urls=len(self.urls), done=len(self.results), failed=failed,
+                created_at=self.created_at, started_at=self.started_at,
+                finished_at=self.finished_at, results=list(self.results))
+
+
+class JobQueue(object):
+  """Runs the URLs of submitted jobs on `workers` long lived threads"""
+  def __init__(self, workers=None, max_queue=None, keep_jobs=None):
+    opts = settings.service
+    self.workers = workers or opts.workers
+    self.max_queue = max_queue or opts.max_queue
+    self.keep_jobs = keep_jobs or opts.keep_jobs
+    self.busy = 0
+    # How long URLs waited in the queue, and how long they took to archive
+    self.wait_latency = stats.Histogram()
+    self.run_latency = stats.Histogram()
+    self._queue = Queue.Queue()
+    self._jobs = OrderedDict()
+    self._lock = threading.Lock()
+    self._threads = []
+
+  def start(self):
+    for i in range(self.workers):
+      thread = threading.Thread(target=self._work, name='job-worker-%d' % i)
+      thread.daemon = True
+      thread.start()
+      self._threads.append(thread)
+
+  def submit(self, urls, recrawl=False):
+    """Queue a new job for `urls`.
+
+    :returns: the `Job`
+    :raises: JobTooLarge, QueueFull
+    """
+    if len(urls) > self.max_queue:
+      raise JobTooLarge('%d URLs, at most %d per job'
+                        % (len(urls), self.max_queue))
+    job = Job(urls, recrawl)
+    with self._lock:
+      if self._queue.qsize() + len(urls) > self.max_queue:
+        raise QueueFull('%d URLs queued already' % self._queue.qsize())
+      self._jobs[job.id] = job
+      self._evict()
+      for url in urls:
+        self._queue.put((job, url, timeit.default_timer()))
+    stats.incr('jobs_submitted')
+    stats.incr('job_urls_submitted', len(urls))
+    return job
+
+  def _evict(self):
+    """Forget the oldest finished jobs past `keep_jobs`"""
+    excess = len(self._jobs) - self.keep_jobs
+    for job_id in list(self._jobs):
+      if excess <= 0:
+        break
+      if self._jobs[job_id].finished_at is not None:
+        del self._jobs[job_id]
+        excess -= 1
+
+  def get(self, job_id):
+    return self._jobs.get(job_id)
+
+  def _work(self):
+    while True:
+      job, url, queued_at = self._queue.get()
+      started = timeit.default_timer()
+      with self._lock:
+        self.busy += 1
+        self.wait_latency.observe(started - queued_at)
+        if job.started_at is None:
+          job.started_at = time.time()
+      stats.observe('job_wait_seconds', started - queued_at)
+      result = self._archive(url, job.recrawl)
+      with self._lock:
+        self.busy -= 1
+        self.run_latency.observe(timeit.default_timer() - started)
+        job.results.append(result)
+        if len(job.results) == len(job.urls):
+          job.finished_at = time.time()
+          stats.incr('jobs_done')
+
+  @staticmethod
+  def _archive(url, recrawl):
+    result = dict(url=url, index=None, assets=0, diff=None, error=None)
+    try:
+      with stats.timer('job_url'):
+        index, num_assets, diff = crawl.archive_url(url, recrawl)
+      result.update(index=storage.get_backend().get_url_for_file(index),
+                    assets=num_assets,
+                    diff=diff.to_dict() if diff is not None else None)
+    except Exception as e:
+      log.exception('Failed to archive "%s"', url)
+      result['error'] = str(e) or e.__class__.__name__
+    return result
+
+  def summary(self):
+    """Queue depth, worker usage, job counts and latencies"""
+    with self._lock:
+      statuses = [job.status for job in self._jobs.values()]
+      doc = dict(queue_depth=self._queue.qsize(), max_queue=self.max_queue,
+                 workers=self.workers, busy=self.busy,
+                 jobs=dict((s, statuses.count(s))
+                           for s in ('queued', 'running', 'done')))
+      for name, hist in (('wait', self.wait_latency),
+                         ('run', self.run_latency)):
+        doc['%s_seconds' % name] = dict(
+            count=hist.count, mean=hist.sum / hist.count if hist.count else 0,
+            p50=stats.finite(hist.quantile(0.5)),
+            p95=stats.finite(hist.quantile(0.95)),
+            p99=stats.finite(hist.quantile(0.99)))
+    return doc
+
+
+jobs = None
+
+
+def warm_up():
+  """Pay the startup costs now instead of on the first job: page parsing
+  modules, the HTTP session, the storage backend and the render workers
+  """
+  import page  # noqa
+  import render
+  import session
+  storage.get_backend()
+  session.get_session()
+  pool = render.get_pool()
+  pool.warm()
+  log.info('Warmed up %d render worker(s)', pool.size)
+
+
+def start(workers=None, warm=True):
+  """Start the job workers (after warming up), returns the WSGI app"""
+  global jobs
+  if warm:
+    warm_up()
+  jobs = JobQueue(workers=workers)
+  jobs.start()
+  return app
+
+
+def _urls_from_request():
+  """(urls, recrawl) from a JSON document or list, or from a plain text
+  body with one URL per line; lists and plain text take `?recrawl=1`
+  """
+  doc = flask.request.get_json(silent=True)
+  recrawl = flask.request.args.get('recrawl') in ('1', 'true')
+  if isinstance(doc, dict):
+    urls = doc.get('urls') or []
+    if isinstance(urls, basestring):
+      urls = [urls]
+    recrawl = bool(doc.get('recrawl'))
+  elif isinstance(doc, list):
+    urls = doc
+  else:
+    urls = flask.request.get_data().decode('utf8', 'replace').splitlines()
+    urls = [u for u in urls if not u.strip().startswith('#')]
+  urls = [u.strip() for u in urls if isinstance(u, basestring)]
+  return [u for u in urls if u], recrawl
+
+
+def _error(status, message):
+  response = flask.jsonify(error=message)
+  response.status_code = status
+  return response
+
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+  urls, recrawl = _urls_from_request()
+  if not urls:
+    return _error(400, 'no URLs given')
+  try:
+    job = jobs.submit(urls, recrawl)
+  except JobTooLarge as e:
+    return _error(413, str(e))
+  except QueueFull as e:
+    response = _error(503, str(e))
+    response.headers['Retry-After'] = '5'
+    return response
+  response = flask.jsonify(job.to_dict())
+  response.status_code = 202
+  response.headers['Location'] = flask.url_for('job_status', job_id=job.id)
+  return response
+
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+  job = jobs.get(job_id)
+  if job is None:
+    return _error(404, 'unknown job %s' % job_id)
+  return flask.jsonify(job.to_dict())
+
+
+@app.route('/stats')
+def queue_stats():
+  return flask.jsonify(jobs.summary())
+
+
+@app.route('/metrics')
+def metrics():
+  doc = jobs.summary()
+  lines = ['%sjob_queue_depth %d' % (stats.PREFIX, doc['queue_depth']),
+           '%sjob_workers_busy %d' % (stats.PREFIX, doc['busy'])]
+  lines.extend('%sjobs{status="%s"} %d' % (stats.PREFIX, status, count)
+               for status, count in sorted(doc['jobs'].items()))
+  body = '\n'.join(lines) + '\n' + stats.registry.to_prometheus()
+  return flask.Response(body, mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/health')
+def health():
+  return flask.jsonify(status='ok',
+                       queue_depth=jobs.summary()['queue_depth'])
+
+
+parser = argparse.ArgumentParser(description='Serve archive jobs over HTTP.')
+parser.add_argument('--host', help='Interface to listen on (default from '
+                                   'the service config section)')
+parser.add_argument('--port', type=int, help='Port to listen on')
+parser.add_argument('-w', '--workers', type=int,
+                    help='Pages archived concurrently')
+parser.add_argument('--storage', metavar='backend',
+                    help='Storage backend to use (%s), overrides the config'
+                         % ', '.join(storage.available_backends()))
+parser.add_argument('--no-warm-up', dest='warm_up', action='store_false',
+                    help="Don't start the renderers before taking jobs")
+
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.INFO)
+  config.write_cache()
+  args = parser.parse_args()
+  if args.storage:
+    storage.use_backend(args.storage)
+  stats.enable()
+  start(args.workers, warm=args.warm_up)
+  app.run(host=args.host or settings.service.host,
+          port=args.port or settings.service.port, threaded=True)
@@ -1,18 +1,80 @@
 # -*- coding: utf-8 -*-
 """ Like this and like that and like this and uh
+
+Pages and assets are fetched through one process wide `requests` session
+(`get_session`), so keep-alive connections are reused across pages. Its
+transport adapter keeps a connection pool per host (up to
+`http.pool_hosts` of them), caps the connections to a single host at
+`http.per_host_connections` (further requests wait for a free one) and
+rate limits each host with a token bucket (`http.per_host_rate` requests
+per second, bursts of `http.per_host_burst`). GETs go through the shared
+on-disk HTTP cache (see `http_cache`) unless `http_cache.enabled` is off.
+
+`fetch` (and `call_with_retries` for requests that also stream the body)
+adds what a single `session.get` lacks: connect/read timeouts
+(`http.connect_timeout_sec`, `http.read_timeout_sec`), up to
+`http.attempts` tries with jittered exponential backoff on connection
+errors, timeouts and 429/5xx answers, and a circuit breaker per host that
+fails fast once a host keeps failing (see `lib.retry`).
 """
 import random
+import threading
+import urlparse
+
 import requests
 
+import http_cache
+from config import settings
+from lib.politeness import HostThrottle, PoliteAdapter
+from lib.retry import CircuitBreakers, retry
+
 
 USER_AGENTS = (
     "Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 "
     "(KHTML, like Gecko) Chrome/39.0.2171.95 Safari/537.36",
 )
+# Answers worth another try: rate limited or a server side hiccup
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+
+# Reentrant: get_session holds it while get_adapter takes it again
+_lock = threading.RLock()
+_adapter = None
+_session = None
+_breakers = None
+
+
+class RetryableStatus(requests.HTTPError):
+  """Raised for a response whose status is in `RETRY_STATUSES`"""
+
+
+TRANSIENT_ERRORS = (requests.ConnectionError, requests.Timeout,
+                    RetryableStatus)
+
+
+def get_adapter():
+  """The process wide transport adapter, created on first use"""
+  global _adapter
+  if _adapter is None:
+    with _lock:
+      if _adapter is None:
+        opts = settings.http
+        kwargs = dict(throttle=HostThrottle(opts.per_host_rate,
+                                            opts.per_host_burst),
+                      pool_connections=opts.pool_hosts,
+                      pool_maxsize=opts.per_host_connections,
+                      pool_block=bool(opts.per_host_connections))
+        cache = http_cache.get_cache()
+        if cache is not None:
+          _adapter = http_cache.CachingAdapter(cache, **kwargs)
+        else:
+          _adapter = PoliteAdapter(**kwargs)
+  return _adapter
 
 
 def generate_session(*args, **kwargs):
-  """Returns session object
+  """Returns a new session object, sharing the process wide connection pools
+  and per host limits.
 
   :returns: requests session object
   """
@@ -20,9 +82,22 @@ def generate_session(*args, **kwargs):
   headers['User-Agent'] = get_user_agent()
   s = requests.Session(*args, **kwargs)
   s.headers = headers
+  adapter = get_adapter()
+  s.mount('http://', adapter)
+  s.mount('https://', adapter)
   return s
 
 
+def get_session():
+  """The process wide session, shared by every page and asset fetch"""
+  global _session
+  if _session is None:
+    with _lock:
+      if _session is None:
+        _session = generate_session()
+  return _session
+
+
 def get_user_agent():
   """ Returns a random user agent string.
 
@@ -30,3 +105,59 @@ def get_user_agent():
   :rtype: str
   """
   return random.choice(USER_AGENTS)
+
+
+def timeouts():
+  """(connect, read) timeouts for `requests`"""
+  return settings.http.connect_timeout_sec, settings.http.read_timeout_sec
+
+
+def get_breakers():
+  """The process wide per host `CircuitBreakers`"""
+  global _breakers
+  if _breakers is None:
+    with _lock:
+      if _breakers is None:
+        _breakers = CircuitBreakers(settings.http.breaker_failures,
+                                    settings.http.breaker_reset_sec)
+  return _breakers
+
+
+def check_status(response):
+  """Close `response` and raise `RetryableStatus` if it is worth retrying"""
+  if response.status_code in RETRY_STATUSES:
+    response.close()
+    raise RetryableStatus('%d for %s' % (response.status_code, response.url),
+                          response=response)
+  return response
+
+
+def call_with_retries(func, host, name='fetch'):
+  """Call `func()`, which makes a request to `host`, behind the host's
+  circuit breaker, retrying `TRANSIENT_ERRORS` with jittered backoff.
+  Raises `lib.retry.CircuitOpenError` without calling if the host's circuit
+  is open.
+  """
+  opts = settings.http
+  breakers = get_breakers()
+
+  def attempt():
+    with breakers.guard(host):
+      return func()
+  return retry(attempt, attempts=opts.attempts,
+               base_delay=opts.backoff_base_sec,
+               max_delay=opts.backoff_max_sec,
+               retry_on=TRANSIENT_ERRORS, name=name)
+
+
+def fetch(url, session_=None, **kwargs):
+  """`session_.get(url, **kwargs)` (the shared session by default) with the
+  configured timeouts, retries and circuit breaker.
+
+  :returns: requests response object
+  """
+  session_ = session_ or get_session()
+  kwargs.setdefault('timeout', timeouts())
+  return call_with_retries(
+      lambda: check_status(session_.get(url, **kwargs)),
+      urlparse.urlparse(url).netloc)
@@ -1,4 +1,7 @@
 # -*- coding: utf-8 -*-
 """ Storage package
 """
-from .helpers import store_page
+from .helpers import load_snapshot, page_prefix, store_page
+from .registry import (available_backends, get_backend, register_backend,
+                       storage, use_backend)
+from .snapshot import SnapshotDiff
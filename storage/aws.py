@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+""" S3 storage backend. Only imported when selected (see `storage.registry`),
+so boto isn't loaded by runs that store locally.
+"""
+from cStringIO import StringIO
+import httplib
+import logging
+import math
+import mimetypes
+import os
+import socket
+import threading
+import urlparse
+
+import boto
+from boto.s3.key import Key
+from boto.exception import S3ResponseError
+import requests
+
+from config import settings
+from lib import stats
+from lib.pipeline import Pipeline
+from lib.retry import retry
+from lib.utils import spool_to_file
+from . import compression
+from .backends import BatchResult, LocalStorage, _duplicates
+from .connections import ConnectionPool
+from .index import get_index
+
+
+RACKSPACE_CONN_TIMEOUT_SEC = 20
+RACKSPACE_NUM_UPLOAD_ATTEMPTS = 4
+RACKSPACE_UPLOAD_DELAY_SEC = 2
+# Failures worth another try; S3 errors only if they are on S3's side
+_TRANSIENT = (socket.error, httplib.HTTPException, S3ResponseError)
+
+
+log = logging.getLogger(__name__)
+
+
+def _is_transient(e):
+  return not isinstance(e, S3ResponseError) or e.status >= 500
+
+
+class RemoteStorageAWS(LocalStorage):
+  """
+  Remote storage to the Rackspace cloud.  Their API docs:
+  http://docs.rackspacecloud.com/api/
+
+  Connections and bucket handles are shared through a bounded, thread safe
+  `ConnectionPool` (see `storage.connections`) sized by the
+  `filestorage.remote_aws.pool_*` settings.
+
+  Keys of the default container are tracked in a local `ExistenceIndex`
+  (see `storage.index`) so `file_exists` rarely needs a round trip.
+
+  Requests time out after `filestorage.remote_aws.timeout_sec` and are
+  retried on connection errors and 5xx answers (`retry_attempts` tries,
+  `retry_delay_sec` base backoff). boto's own retries are turned off. Each
+  try of a single request gets a freshly checked out connection; the parts
+  of a multipart upload are retried one by one on the upload's connection,
+  which boto reopens after a network error.
+  """
+  _pool = None
+  _pool_lock = threading.Lock()
+
+  @staticmethod
+  def resolve_key(file_name):
+    # S3 has no directories to keep small, keys are stored as given
+    return file_name
+
+  logical_key = resolve_key
+
+  @staticmethod
+  def _connect():
+    timeout = settings.filestorage.remote_aws.get('timeout_sec',
+                                                  RACKSPACE_CONN_TIMEOUT_SEC)
+    if not boto.config.has_section('Boto'):
+      boto.config.add_section('Boto')
+    boto.config.set('Boto', 'http_socket_timeout', str(timeout))
+    # Retries are ours (`_retry`), with backoff and a fresh connection;
+    # boto's own would multiply them
+    boto.config.set('Boto', 'num_retries', '0')
+    return boto.connect_s3(settings.filestorage.remote_aws.access_key,
+                           settings.filestorage.remote_aws.secret_key)
+
+  @staticmethod
+  def _connections():
+    """The process wide connection pool, created on first use"""
+    cls = RemoteStorageAWS
+    if cls._pool is None:
+      with cls._pool_lock:
+        if cls._pool is None:
+          opts = settings.filestorage.remote_aws
+          cls._pool = ConnectionPool(
+              cls._connect, max_size=opts.pool_size,
+              max_idle_sec=opts.pool_max_idle_sec,
+              health_check_sec=opts.pool_health_check_sec)
+    return cls._pool
+
+  @staticmethod
+  def _bucket(container=None):
+    """Context manager yielding a pooled handle on `container`"""
+    container = container or settings.filestorage.remote_aws.container
+    return RemoteStorageAWS._connections().bucket(container)
+
+  @staticmethod
+  def _retry(func, name):
+    """Call `func()`, retrying transient failures with jittered backoff"""
+    opts = settings.filestorage.remote_aws
+    return retry(
+        func,
+        attempts=opts.get('retry_attempts', RACKSPACE_NUM_UPLOAD_ATTEMPTS),
+        base_delay=opts.get('retry_delay_sec', RACKSPACE_UPLOAD_DELAY_SEC),
+        retry_on=_TRANSIENT, should_retry=_is_transient, name='s3_' + name)
+
+  @staticmethod
+  def _index(container=None):
+    """The existence index, if enabled and `container` is the one it covers
+    """
+    if container and container != settings.filestorage.remote_aws.container:
+      return None
+    return get_index()
+
+  @staticmethod
+  def build_index(container=None):
+    """Sweep the bucket and rebuild the existence index from scratch"""
+    index = RemoteStorageAWS._index(container)
+    if index is None:
+      return 0
+    return index.rebuild(k.name for k in
+                         RemoteStorageAWS.list_files(container))
+
+  @staticmethod
+  def _indexed(file_names, container=None):
+    index = RemoteStorageAWS._index(container)
+    if index is not None:
+      index.add_many(file_names)
+
+  @staticmethod
+  @stats.timed('store_file', backend='aws')
+  def store_file(file_name, data, container=None):
+    """store a file to AWS, with the name and data provided.
+       ALSO WHAT KIND OF A VARIABLE NAME IS DATA
+    """
+    # guess the mimetype
+    content_type = mimetypes.guess_type(file_name)
+    data, encoding = compression.maybe_compress(file_name, data)
+    headers = {'Content-Encoding': encoding} if encoding else None
+
+    def put():
+      with RemoteStorageAWS._bucket(container) as bucket:
+        k = Key(bucket, file_name)
+        if content_type[0]:
+          k.content_type = content_type[0]
+        k.set_contents_from_string(data, headers=headers)
+    try:
+      RemoteStorageAWS._retry(put, 'store_file')
+    except S3ResponseError:
+      log.error("bad response from S3 on store_file call")
+      raise ValueError("Response not OK")
+    stats.incr('store_bytes', len(data), backend='aws')
+    RemoteStorageAWS._indexed([file_name], container)
+    return RemoteStorageAWS.get_url_for_file(file_name)
+
+  @staticmethod
+  def read_file(file_name, container=None):
+    """return the contents of a file in storage as a string, decompressed if
+    it was stored with a Content-Encoding.
+    """
+    def get():
+      with RemoteStorageAWS._bucket(container) as bucket:
+        k = Key(bucket, file_name)
+        return k.get_contents_as_string(), k.content_encoding
+    try:
+      data, encoding = RemoteStorageAWS._retry(get, 'read_file')
+    except S3ResponseError:
+      log.error("bad response from S3 on read_file call")
+      raise ValueError("Response not OK")
+    return compression.decompress(data, encoding)
+
+  @staticmethod
+  def get_file_object(hosted_path, container=None):
+    """return the contents of a file in storage as file-like obj.
+    """
+    # first replace cdn_url with nothing, so we get the file name
+    file_name = hosted_path.replace(
+        "%s/" % settings.filestorage.remote_aws.container_cdn_url, '')
+    file_name.replace(container, "")
+    return StringIO(RemoteStorageAWS.read_file(file_name, container))
+
+  @staticmethod
+  def file_exists(file_name, container=None):
+    """return whether or not a file exists on remote storage. Answered from
+       the existence index when it is complete, unless the
+       `index.confirm` setting asks for S3 to confirm the answer.
+    """
+    index = RemoteStorageAWS._index(container)
+    if index is not None and index.complete:
+      found = file_name in index
+      confirm = settings.filestorage.remote_aws.index.confirm
+      if confirm == 'never' or (confirm == 'missing' and found):
+        stats.incr('exists_index', result='hit' if found else 'miss')
+        return found
+
+    def head():
+      with RemoteStorageAWS._bucket(container) as bucket:
+        return bool(bucket.get_key(file_name))
+    try:
+      exists = RemoteStorageAWS._retry(head, 'file_exists')
+    except S3ResponseError:
+      log.error("bad response from S3 on file_exists call")
+      # don't reraise here, just return that it doesn't.
+      return False
+    stats.incr('exists_head', result='hit' if exists else 'miss')
+    if index is not None:
+      if exists:
+        index.add(file_name)
+      else:
+        index.discard(file_name)
+    return exists
+
+  @staticmethod
+  def delete_file(file_name, container=None):
+    """delete a file from the container
+    """
+    def delete():
+      with RemoteStorageAWS._bucket(container) as bucket:
+        bucket.delete_key(file_name)
+    try:
+      RemoteStorageAWS._retry(delete, 'delete_file')
+    except S3ResponseError:
+      log.error("bad response from S3 on delete_file call")
+      raise ValueError("Response not OK")
+    index = RemoteStorageAWS._index(container)
+    if index is not None:
+      index.discard(file_name)
+
+  @staticmethod
+  def get_url_for_file(file_name):
+    return '%s%s' % (settings.filestorage.remote_aws.container_cdn_url,
+                     file_name)
+
+  @staticmethod
+  def download_file(remote_file_name, container, local_file_name):
+    """download a file to local_file_name
+    """
+    def get():
+      with RemoteStorageAWS._bucket(container) as bucket:
+        k = Key(bucket, remote_file_name)
+        k.get_contents_to_filename(local_file_name)
+        return k.content_encoding
+    try:
+      encoding = RemoteStorageAWS._retry(get, 'download_file')
+    except S3ResponseError:
+      log.error("bad response from S3 on download_file call")
+      raise ValueError("Response not OK")
+    if encoding:
+      compression.decompress_file(local_file_name, encoding)
+
+  @staticmethod
+  @stats.timed('store_file', backend='aws')
+  def upload_file(local_file_name, cloud_file_name, container):
+    """upload a local file. Files above `multipart_threshold_mb` are sent as
+       a multipart upload, so neither path holds the file in memory.
+       Compressible files are compressed first (see `storage.compression`).
+    """
+    headers = {}
+    content_type = mimetypes.guess_type(cloud_file_name)
+    if content_type[0]:
+      headers['Content-Type'] = content_type[0]
+    path, encoding = compression.maybe_compress_file(cloud_file_name,
+                                                     local_file_name)
+    if encoding:
+      headers['Content-Encoding'] = encoding
+    try:
+      size = RemoteStorageAWS._upload(path, cloud_file_name, container,
+                                      headers)
+    finally:
+      if encoding:
+        os.unlink(path)
+    stats.incr('store_bytes', size, backend='aws')
+    RemoteStorageAWS._indexed([cloud_file_name], container)
+    return RemoteStorageAWS.get_url_for_file(cloud_file_name)
+
+  @staticmethod
+  def _upload(local_file_name, cloud_file_name, container, headers):
+    opts = settings.filestorage.remote_aws
+    size = os.path.getsize(local_file_name)
+    multipart = size > opts.multipart_threshold_mb * 1024 * 1024
+
+    def put():
+      with RemoteStorageAWS._bucket(container) as bucket:
+        if multipart:
+          RemoteStorageAWS._multipart_upload(
+              bucket, local_file_name, cloud_file_name, size,
+              opts.multipart_chunk_mb * 1024 * 1024, headers)
+        else:
+          k = Key(bucket, cloud_file_name)
+          k.set_contents_from_filename(local_file_name, headers=headers)
+    try:
+      if multipart:
+        # Parts are retried one by one, not the whole upload
+        put()
+      else:
+        RemoteStorageAWS._retry(put, 'upload_file')
+    except S3ResponseError:
+      log.error("bad response from S3 on upload_file call")
+      raise ValueError("Response not OK")
+    return size
+
+  @staticmethod
+  def _multipart_upload(bucket, local_file_name, cloud_file_name, size,
+                        part_size, headers):
+    mp = bucket.initiate_multipart_upload(cloud_file_name, headers=headers)
+    try:
+      with open(local_file_name, 'rb') as f:
+        def upload_part(i):
+          f.seek(i * part_size)
+          mp.upload_part_from_file(f, part_num=i + 1,
+                                   size=min(part_size, size - i * part_size))
+        for i in range(int(math.ceil(size / float(part_size)))):
+          RemoteStorageAWS._retry(lambda: upload_part(i), 'upload_part')
+      mp.complete_upload()
+    except Exception:
+      mp.cancel_upload()
+      raise
+
+  @staticmethod
+  def list_files(container=None):
+    """returns a list/generator of files in storage.
+       NOTE: this may screw up a bit if you're adding items to the container as
+       you run this, so don't assume this is a 100 percent complete manifest.
+       The pooled connection is held until the generator is exhausted.
+    """
+    with RemoteStorageAWS._bucket(container) as bucket:
+      for key in bucket.list():
+        yield key
+
+  @staticmethod
+  def _map(func, keys):
+    """Run `func(key)` for every key on `batch_workers` threads, collecting a
+    `BatchResult` per key instead of stopping at the first failure.
+    """
+    def call(key):
+      try:
+        return BatchResult(key, True, func(key), None)
+      except Exception as e:
+        return BatchResult(key, False, None, e)
+    workers = settings.filestorage.remote_aws.batch_workers
+    return Pipeline([('s3-batch', call, workers)]).run(keys)
+
+  @staticmethod
+  @stats.timed('store_many', backend='aws')
+  def store_many(items, container=None):
+    """Store every `(file_name, data)` pair in `items` with parallel PUTs.
+    A name repeated in the batch is only stored once, its later items fail.
+
+    :returns: list of `BatchResult`s, in input order
+    """
+    items = list(items)
+    duplicates = _duplicates(items)
+    stored = RemoteStorageAWS._map(
+        lambda i: RemoteStorageAWS.store_file(items[i][0], items[i][1],
+                                              container),
+        [i for i in range(len(items)) if i not in duplicates])
+    results = dict((r.key, r._replace(key=items[r.key][0])) for r in stored)
+    results.update(duplicates)
+    return [results[i] for i in range(len(items))]
+
+  @staticmethod
+  def exists_many(file_names, container=None):
+    return RemoteStorageAWS._map(
+        lambda name: RemoteStorageAWS.file_exists(name, container),
+        file_names)
+
+  @staticmethod
+  def delete_many(file_names, container=None):
+    """Delete with S3 multi-object deletes, 1000 keys per request"""
+    file_names = list(file_names)
+    errors = {}
+
+    def delete(chunk):
+      with RemoteStorageAWS._bucket(container) as bucket:
+        return bucket.delete_keys(chunk, quiet=True)
+    for i in range(0, len(file_names), 1000):
+      chunk = file_names[i:i + 1000]
+      try:
+        result = RemoteStorageAWS._retry(lambda: delete(chunk), 'delete_many')
+      except S3ResponseError as e:
+        log.error("bad response from S3 on delete_many call")
+        errors.update((name, e) for name in chunk)
+        continue
+      for error in result.errors:
+        errors[error.key] = ValueError('%s: %s' % (error.code, error.message))
+    index = RemoteStorageAWS._index(container)
+    if index is not None:
+      index.discard_many([n for n in file_names if n not in errors])
+    return [BatchResult(name, name not in errors, None, errors.get(name))
+            for name in file_names]
+
+  @staticmethod
+  def store_from_url(url, container=None):
+    if url:
+      parsed_url = urlparse.urlparse(url)
+      # get the last part of the path
+      file_name = parsed_url.path.split('/')[-1]
+      exists = RemoteStorageAWS.file_exists(file_name, container)
+      if file_name and not exists:
+        # stream it to a temp file and upload that to aws.
+        resp = requests.get(url, stream=True,
+                            timeout=settings.filestorage.remote_aws.get(
+                                'timeout_sec', RACKSPACE_CONN_TIMEOUT_SEC))
+        try:
+          path, _, _ = spool_to_file(
+              resp.iter_content(settings.pipeline.chunk_size))
+        finally:
+          resp.close()
+        try:
+          return RemoteStorageAWS.upload_file(path, file_name, container)
+        finally:
+          os.unlink(path)
@@ -1,46 +1,234 @@
 # -*- coding: utf-8 -*-
+""" Storage backends. `LocalStorage` lives here; the others are in their own
+modules so their dependencies are only imported once they are selected (see
+`storage.registry`). `RemoteStorageAWS` can still be imported from here, it
+is loaded on first access.
 """
-"""
+from collections import namedtuple
 from cStringIO import StringIO
+import importlib
 import logging
-import mimetypes
 import os
-import urlparse
-
-import boto
-from boto.s3.key import Key
-from boto.exception import S3ResponseError
-import requests
+import posixpath
+import re
+import shutil
+import sys
+import tempfile
+import types
 
-import config as cfg
 from config import settings
+from lib import stats
 from lib.utils import random_str
+from . import compression
 
-
-RACKSPACE_CONN_TIMEOUT_SEC = 20
-RACKSPACE_NUM_UPLOAD_ATTEMPTS = 4
-RACKSPACE_UPLOAD_DELAY_SEC = 2
+try:
+  from os import scandir
+except ImportError:
+  try:
+    from scandir import scandir
+  except ImportError:
+    scandir = None
 
 
 log = logging.getLogger(__name__)
+# Path components starting with this many hex digits are hashes, and get
+# sharded by LocalStorage
+_hashed_re = re.compile(r'^[0-9a-f]{16,}')
+_FILE_MODE = 0o644
+
+
+# Outcome of one item of a store_many / exists_many / delete_many call. `value`
+# is the stored url, or whether the file exists; `error` is set when `ok` is
+# False.
+BatchResult = namedtuple('BatchResult', 'key ok value error')
+
+
+def _duplicates(items):
+  """Failed `BatchResult`s, by index, for the `(name, data)` pairs of a
+  store_many batch that repeat an earlier name; only the first is stored
+  """
+  seen = set()
+  failed = {}
+  for i, (name, _) in enumerate(items):
+    if name in seen:
+      failed[i] = BatchResult(name, False, None, ValueError(
+          '"%s" appears more than once in the batch' % name))
+    seen.add(name)
+  return failed
+
+
+def _ensure_dir(file_path):
+  """Create the parent directories of `file_path` if they are missing
+  """
+  dir_name = os.path.dirname(file_path)
+  if dir_name and not os.path.isdir(dir_name):
+    try:
+      os.makedirs(dir_name)
+    except OSError:
+      # Another worker may have created it in the meantime
+      if not os.path.isdir(dir_name):
+        raise
+
+
+def _atomic_write(file_path, data=None, source=None):
+  """Write `data` (or copy the file at `source`) to `file_path` through a
+  temp file in the same directory and a rename, so readers never see a
+  partial file.
+  """
+  _ensure_dir(file_path)
+  dir_name, base = os.path.split(file_path)
+  fd, tmp = tempfile.mkstemp(prefix='.%s.' % base, suffix='.tmp',
+                             dir=dir_name)
+  try:
+    with os.fdopen(fd, 'wb') as f:
+      if source is None:
+        f.write(data)
+      else:
+        with open(source, 'rb') as src:
+          shutil.copyfileobj(src, f)
+    os.chmod(tmp, _FILE_MODE)
+    os.rename(tmp, file_path)
+  except Exception:
+    os.unlink(tmp)
+    raise
+
+
+def _iter_files(root, rel=''):
+  """Recursively yield the paths of all files below `root`, relative to it.
+  Hidden (temp) files are skipped.
+  """
+  dir_name = os.path.join(root, rel)
+  if scandir is not None:
+    entries = ((e.name, e.is_dir()) for e in scandir(dir_name))
+  else:
+    entries = ((name, os.path.isdir(os.path.join(dir_name, name)))
+               for name in os.listdir(dir_name))
+  for name, is_dir in entries:
+    if name.startswith('.'):
+      continue
+    path = posixpath.join(rel, name)
+    if is_dir:
+      for sub in _iter_files(root, path):
+        yield sub
+    else:
+      yield path
 
 
 class LocalStorage(object):
-  """ Use local filesystem to store files
+  """ Use local filesystem to store files. File names may contain slashes,
+  in which case sub-directories are created as needed.
+
+  Compressible files are also written as a pre-compressed ".gz" (or ".br")
+  sibling when `filestorage.compression` is enabled; with `keep_original`
+  off only the sibling is kept. Reads decompress transparently.
+
+  Files are laid out in hash-prefix sub-directories so that no directory
+  grows huge: the first path component that looks like a hash gets
+  `shard_depth` levels of `shard_width` characters inserted in front of it,
+  e.g. "blobs/3f9a...e1.js" is kept at "blobs/3f/9a/3f9a...e1.js".
+  `resolve_key` gives that physical location; urls point at it. Writes go
+  through a temp file and a rename. Files from the old flat layout are still
+  found and can be moved with `migrate_layout`.
   """
   @staticmethod
+  def resolve_key(file_name):
+    """Where `file_name` lives, relative to the storage root"""
+    opts = settings.filestorage.local
+    depth, width = opts.shard_depth, opts.shard_width
+    if not depth:
+      return file_name
+    parts = file_name.split('/')
+    for i, part in enumerate(parts):
+      if _hashed_re.match(part):
+        shards = [part[j * width:(j + 1) * width] for j in range(depth)]
+        return '/'.join(parts[:i] + shards + parts[i:])
+    return file_name
+
+  @staticmethod
+  def logical_key(path):
+    """Inverse of `resolve_key`"""
+    opts = settings.filestorage.local
+    depth, width = opts.shard_depth, opts.shard_width
+    parts = path.split('/')
+    for i, part in enumerate(parts):
+      if i >= depth and _hashed_re.match(part):
+        shards = [part[j * width:(j + 1) * width] for j in range(depth)]
+        if parts[i - depth:i] == shards:
+          return '/'.join(parts[:i - depth] + parts[i:])
+        return path
+    return path
+
+  @staticmethod
+  def _path(file_name):
+    return os.path.join(settings.filestorage.local.local_path,
+                        LocalStorage.resolve_key(file_name))
+
+  @staticmethod
+  def _candidates(file_name):
+    """Every (path, encoding) `file_name` may be stored at: sharded before
+    flat layout (stores that weren't migrated yet), plain before compressed
+    """
+    flat = os.path.join(settings.filestorage.local.local_path, file_name)
+    for path in (LocalStorage._path(file_name), flat):
+      yield path, None
+      for encoding, suffix in sorted(compression.SUFFIXES.items()):
+        yield path + suffix, encoding
+
+  @staticmethod
+  def _find(file_name):
+    """(path, encoding) of the stored copy of `file_name`. If there is none,
+    the path it would have, so opening it fails the usual way.
+    """
+    for path, encoding in LocalStorage._candidates(file_name):
+      if os.path.exists(path):
+        return path, encoding
+    return LocalStorage._path(file_name), None
+
+  @staticmethod
+  def _write(file_name, data=None, source=None):
+    """Store `data` (or the file at `source`), plus or instead of a
+    pre-compressed sibling. Returns the number of bytes written.
+    """
+    path = LocalStorage._path(file_name)
+    written = 0
+    if source is None:
+      packed, encoding = compression.maybe_compress(file_name, data)
+      if encoding:
+        _atomic_write(path + compression.SUFFIXES[encoding], packed)
+        written += len(packed)
+    else:
+      packed, encoding = compression.maybe_compress_file(file_name, source)
+      if encoding:
+        try:
+          _atomic_write(path + compression.SUFFIXES[encoding], source=packed)
+          written += os.path.getsize(packed)
+        finally:
+          os.unlink(packed)
+    if not encoding or settings.filestorage.compression.keep_original:
+      _atomic_write(path, data, source)
+      written += len(data) if source is None else os.path.getsize(source)
+    return written
+
+  @staticmethod
+  @stats.timed('store_file', backend='local')
   def store_file(file_name, data):
-    file_path = os.path.join(settings.filestorage.local.local_path, file_name)
-    with open(file_path, 'wb') as f:
-      f.write(data)
+    written = LocalStorage._write(file_name, data)
+    stats.incr('store_bytes', written, backend='local')
+
+  @staticmethod
+  @stats.timed('store_file', backend='local')
+  def upload_file(local_file_name, file_name, container=None):
+    """Copy the file at `local_file_name` into storage as `file_name`"""
+    written = LocalStorage._write(file_name, source=local_file_name)
+    stats.incr('store_bytes', written, backend='local')
 
   @staticmethod
   def read_file(file_name):
-    file_path = os.path.join(settings.filestorage.local.local_path, file_name)
+    file_path, encoding = LocalStorage._find(file_name)
     data = None
     with open(file_path, 'rb') as f:
       data = f.read()
-    return data
+    return compression.decompress(data, encoding)
 
   @classmethod
   def copy_to_temp(cls, existing_file_name):
@@ -55,7 +243,11 @@ class LocalStorage(object):
   def get_file_object(hosted_path):
     """returns a string buffer of a local file"""
     file_name = hosted_path.replace(settings.filestorage.local.hosted_path, '')
-    file_path = os.path.join(settings.filestorage.local.local_path, file_name)
+    file_path, encoding = LocalStorage._find(
+        LocalStorage.logical_key(file_name))
+    if encoding:
+      return StringIO(LocalStorage.read_file(
+          LocalStorage.logical_key(file_name)))
     return open(file_path, 'rb')
 
   @staticmethod
@@ -65,173 +257,121 @@ class LocalStorage(object):
 
   @staticmethod
   def file_exists(file_name):
-    file_path = os.path.join(settings.filestorage.local.local_path, file_name)
-    return os.path.exists(file_path)
+    return os.path.exists(LocalStorage._find(file_name)[0])
 
   @staticmethod
   def delete_file(file_name):
-    file_path = os.path.join(settings.filestorage.local.local_path, file_name)
-    if os.path.exists(file_path):
-      os.unlink(file_path)
+    for file_path, _ in LocalStorage._candidates(file_name):
+      if os.path.exists(file_path):
+        os.unlink(file_path)
 
   @staticmethod
   def get_url_for_file(file_name):
-    return "%s%s" % (settings.filestorage.local.hosted_path, file_name)
-
-  @staticmethod
-  def list_files():
-    """returns a list/generator of files in storage.
-    """
-    p = settings.filestorage.local.hosted_path
-    all_files = os.listdir(p)
-    return [f for f in all_files if os.path.isfile(os.path.join(p, f))]
-
-
-class RemoteStorageAWS(LocalStorage):
-  """
-  Remote storage to the Rackspace cloud.  Their API docs:
-  http://docs.rackspacecloud.com/api/
-  """
-  # TODO: error handling
-
-  @staticmethod
-  def __get_conn():
-    """Get a connection.  For now, just init the connection every time.
-    """
-    # TODO: investigate reusing a connection.
-    return boto.boto.connect_s3(settings.filestorage.remote_aws.access_key,
-                                settings.filestorage.remote_aws.secret_key)
-
-  @staticmethod
-  def store_file(file_name, data, container=None):
-    """store a file to AWS, with the name and data provided.
-       ALSO WHAT KIND OF A VARIABLE NAME IS DATA
-    """
-    container = container or settings.filestorage.remote_aws.container
-    conn = RemoteStorageAWS.__get_conn()
-    bucket = conn.get_bucket(container, validate=False)
-    k = Key(bucket, file_name)
-    # guess the mimetype
-    content_type = mimetypes.guess_type(file_name)
-    if content_type[0]:
-      k.content_type = content_type[0]
-    try:
-      k.set_contents_from_string(data)
-    except S3ResponseError:
-      log.error("bad response from S3 on store_file call")
-      raise ValueError("Response not OK")
-    return RemoteStorageAWS.get_url_for_file(file_name)
-
-  @staticmethod
-  def read_file(file_name, container=None):
-    """return the contents of a file in storage as a string.
-    """
-    container = container or settings.filestorage.remote_aws.container
-    conn = RemoteStorageAWS.__get_conn()
-    bucket = conn.get_bucket(container, validate=False)
-    k = Key(bucket, file_name)
-    try:
-      return k.get_contents_as_string()
-    except S3ResponseError:
-      log.error("bad response from S3 on read_file call")
-      raise ValueError("Response not OK")
+    return "%s%s" % (settings.filestorage.local.hosted_path,
+                     LocalStorage.resolve_key(file_name))
 
   @staticmethod
-  def get_file_object(hosted_path, container=None):
-    """return the contents of a file in storage as file-like obj.
-    """
-    # first replace cdn_url with nothing, so we get the file name
-    file_name = hosted_path.replace(
-        "%s/" % settings.filestorage.remote_aws.container_cdn_url, '')
-    file_name.replace(container, "")
-    return StringIO(RemoteStorageAWS.read_file(file_name, container))
+  @stats.timed('store_many', backend='local')
+  def store_many(items):
+    """Store every `(file_name, data)` pair in `items`. Directories are
+    created once up front rather than per file. A name repeated in the
+    batch is only stored once, its later items fail.
 
-  @staticmethod
-  def file_exists(file_name, container=None):
-    """return whether or not a file exists on remote storage.
+    :returns: list of `BatchResult`s, in input order
     """
-    container = container or settings.filestorage.remote_aws.container
-    conn = RemoteStorageAWS.__get_conn()
-    bucket = conn.get_bucket(container, validate=False)
-    try:
-      return bool(bucket.get_key(file_name))
-    except S3ResponseError:
-      log.error("bad response from S3 on file_exists call")
-      # don't reraise here, just return that it doesn't.
-      return False
+    items = list(items)
+    duplicates = _duplicates(items)
+    for dir_name in set(os.path.dirname(LocalStorage._path(name))
+                        for name, _ in items):
+      _ensure_dir(os.path.join(dir_name, ''))
+    results = []
+    for i, (name, data) in enumerate(items):
+      if i in duplicates:
+        results.append(duplicates[i])
+        continue
+      try:
+        written = LocalStorage._write(name, data)
+      except (IOError, OSError) as e:
+        results.append(BatchResult(name, False, None, e))
+      else:
+        stats.incr('store_bytes', written, backend='local')
+        results.append(BatchResult(name, True,
+                                   LocalStorage.get_url_for_file(name), None))
+    return results
 
   @staticmethod
-  def delete_file(file_name, container=None):
-    """delete a file from the container
-    """
-    container = container or settings.filestorage.remote_aws.container
-    conn = RemoteStorageAWS.__get_conn()
-    bucket = conn.get_bucket(container, validate=False)
-    try:
-      bucket.delete_key(file_name)
-    except S3ResponseError:
-      log.error("bad response from S3 on delete_file call")
-      raise ValueError("Response not OK")
+  def exists_many(file_names):
+    return [BatchResult(name, True, LocalStorage.file_exists(name), None)
+            for name in file_names]
 
   @staticmethod
-  def get_url_for_file(file_name):
-    return '%s%s' % (settings.filestorage.remote_aws.container_cdn_url,
-                     file_name)
+  def delete_many(file_names):
+    results = []
+    for name in file_names:
+      try:
+        LocalStorage.delete_file(name)
+      except OSError as e:
+        results.append(BatchResult(name, False, None, e))
+      else:
+        results.append(BatchResult(name, True, None, None))
+    return results
 
   @staticmethod
-  def download_file(remote_file_name, container, local_file_name):
-    """download a file to local_file_name
+  def list_files():
+    """returns a generator of the names of all files in storage, walking the
+    tree lazily so even huge stores are never listed into memory at once.
     """
-    container = container or settings.filestorage.remote_aws.container
-    conn = RemoteStorageAWS.__get_conn()
-    bucket = conn.get_bucket(container, validate=False)
-    k = Key(bucket, remote_file_name)
-    try:
-      k.get_contents_to_filename(local_file_name)
-    except S3ResponseError:
-      log.error("bad response from S3 on download_file call")
-      raise ValueError("Response not OK")
+    root = settings.filestorage.local.local_path
+    suffixes = tuple(compression.SUFFIXES.values())
+    for path in _iter_files(root):
+      if path.endswith(suffixes):
+        # A compressed sibling stands for its original, unless that exists
+        original = os.path.splitext(path)[0]
+        if os.path.exists(os.path.join(root, original)):
+          continue
+        path = original
+      yield LocalStorage.logical_key(path)
 
   @staticmethod
-  def upload_file(local_file_name, cloud_file_name, container):
-    container = container or settings.filestorage.remote_aws.container
-    conn = RemoteStorageAWS.__get_conn()
-    bucket = conn.get_bucket(container, validate=False)
-    k = Key(bucket, cloud_file_name)
-    try:
-      k.set_contents_from_filename(local_file_name)
-    except S3ResponseError:
-      log.error("bad response from S3 on upload_file call")
-      raise ValueError("Response not OK")
+  def migrate_layout(dry_run=False):
+    """Move every file that isn't where `resolve_key` wants it (e.g. a store
+    written with the old flat layout, or with other shard settings).
 
-  @staticmethod
-  def list_files(container=None):
-    """returns a list/generator of files in storage.
-       NOTE: this may screw up a bit if you're adding items to the container as
-       you run this, so don't assume this is a 100 percent complete manifest.
+    :returns: number of files moved (or that would be moved)
     """
-    container = container or settings.filestorage.remote_aws.container
-    conn = RemoteStorageAWS.__get_conn()
-    bucket = conn.get_bucket(container, validate=False)
-    return bucket.list()
-
-  @staticmethod
-  def store_from_url(url, container=None):
-    if url:
-      parsed_url = urlparse.urlparse(url)
-      # get the last part of the path
-      file_name = parsed_url.path.split('/')[-1]
-      exists = RemoteStorageAWS.file_exists(file_name, container)
-      if file_name and not exists:
-        # download it to memory and upload to aws.
-        resp = requests.get(url)
-        return RemoteStorageAWS.store_file(file_name, resp.content, container)
-
-
-if settings.filestorage.use_remote_aws and not cfg.test_mode:
-  storage = RemoteStorageAWS
-else:
-  storage = LocalStorage
-
-
-log.debug("Using %s as Storage Manager", storage.__name__)
+    root = settings.filestorage.local.local_path
+    moved = 0
+    for path in list(_iter_files(root)):
+      target = LocalStorage.resolve_key(LocalStorage.logical_key(path))
+      if target == path:
+        continue
+      moved += 1
+      log.info('Moving "%s" to "%s"', path, target)
+      if not dry_run:
+        target_path = os.path.join(root, target)
+        _ensure_dir(target_path)
+        os.rename(os.path.join(root, path), target_path)
+    return moved
+
+
+class _Module(types.ModuleType):
+  """This module, with the backends that moved out of it (`_MOVED`) still
+  importable from here but only loaded when first asked for
+  """
+  _MOVED = {'RemoteStorageAWS': 'storage.aws'}
+
+  def __getattr__(self, attr):
+    module = self._MOVED.get(attr)
+    if module is None:
+      raise AttributeError(attr)
+    value = getattr(importlib.import_module(module), attr)
+    setattr(self, attr, value)
+    return value
+
+
+_module = _Module(__name__, __doc__)
+_module.__dict__.update(globals())
+# Python 2 clears a module's globals once it is collected, and the functions
+# above still use these ones: keep the original module alive
+_module._original = sys.modules[__name__]
+sys.modules[__name__] = _module
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+""" Optional pre-compression of text files (HTML, CSS, JS, hashmaps...)
+before they are stored.
+
+Whether a file gets compressed is decided from the mimetype guessed from its
+name, the same guess the backends use for Content-Type. The encoding comes
+from the `filestorage.compression` settings: 'gzip', or 'br' when the
+`brotli` module is installed (falling back to gzip otherwise). Data that
+doesn't shrink is stored as is.
+"""
+import gzip
+import logging
+import mimetypes
+import os
+import shutil
+import tempfile
+import zlib
+
+from config import settings
+
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+
+# Mimetypes worth compressing besides text/*
+COMPRESSIBLE_TYPES = frozenset([
+    'application/javascript',
+    'application/x-javascript',
+    'application/json',
+    'application/xml',
+    'application/xhtml+xml',
+    'application/rss+xml',
+    'application/atom+xml',
+    'image/svg+xml',
+    'image/x-icon',
+    'application/vnd.ms-fontobject',
+    'font/ttf',
+    'application/x-font-ttf',
+])
+# File name suffix used for each encoding by LocalStorage
+SUFFIXES = {'gzip': '.gz', 'br': '.br'}
+
+
+log = logging.getLogger(__name__)
+
+
+def is_compressible(file_name):
+  content_type = mimetypes.guess_type(file_name)[0]
+  if not content_type:
+    return False
+  return (content_type.startswith('text/') or
+          content_type in COMPRESSIBLE_TYPES)
+
+
+def encoding_for(file_name, size=None):
+  """The Content-Encoding to store `file_name` with, or None to store it
+  uncompressed
+  """
+  opts = settings.filestorage.compression
+  if not opts.enabled or not is_compressible(file_name):
+    return None
+  if size is not None and size < opts.min_bytes:
+    return None
+  if opts.encoding == 'br' and brotli is not None:
+    return 'br'
+  return 'gzip'
+
+
+def compress(data, encoding):
+  opts = settings.filestorage.compression
+  if encoding == 'br':
+    return brotli.compress(data, quality=opts.brotli_quality)
+  compressor = zlib.compressobj(opts.gzip_level, zlib.DEFLATED,
+                                16 + zlib.MAX_WBITS)
+  return compressor.compress(data) + compressor.flush()
+
+
+def decompress(data, encoding):
+  if encoding == 'br':
+    return brotli.decompress(data)
+  if encoding == 'gzip':
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+  return data
+
+
+def compress_file(path, encoding):
+  """Compress the file at `path` into a new temp file, which the caller owns.
+  Gzip is streamed; brotli has no streaming API in all its versions, so the
+  file is read whole (these are text assets, not videos).
+  """
+  opts = settings.filestorage.compression
+  fd, out_path = tempfile.mkstemp(suffix=SUFFIXES[encoding])
+  try:
+    with os.fdopen(fd, 'wb') as out, open(path, 'rb') as f:
+      if encoding == 'br':
+        out.write(brotli.compress(f.read(), quality=opts.brotli_quality))
+      else:
+        with gzip.GzipFile(fileobj=out, mode='wb', filename='',
+                           compresslevel=opts.gzip_level) as gz:
+          shutil.copyfileobj(f, gz)
+  except Exception:
+    os.unlink(out_path)
+    raise
+  return out_path
+
+
+def decompress_file(path, encoding):
+  """Decompress the file at `path` in place"""
+  fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+  try:
+    with os.fdopen(fd, 'wb') as out:
+      if encoding == 'br':
+        with open(path, 'rb') as f:
+          out.write(brotli.decompress(f.read()))
+      else:
+        with gzip.open(path, 'rb') as gz:
+          shutil.copyfileobj(gz, out)
+    os.rename(tmp, path)
+  except Exception:
+    os.unlink(tmp)
+    raise
+
+
+def maybe_compress(file_name, data):
+  """(data, encoding) to store for `file_name`: compressed if that is
+  enabled and worth it, else `data` unchanged and None
+  """
+  encoding = encoding_for(file_name, len(data))
+  if encoding is None:
+    return data, None
+  packed = compress(data, encoding)
+  if len(packed) >= len(data):
+    return data, None
+  return packed, encoding
+
+
+def maybe_compress_file(file_name, path):
+  """(path, encoding) to upload for `file_name` from the file at `path`. If
+  encoding isn't None, path is a new temp file the caller must delete.
+  """
+  encoding = encoding_for(file_name, os.path.getsize(path))
+  if encoding is None:
+    return path, None
+  packed = compress_file(path, encoding)
+  if os.path.getsize(packed) >= os.path.getsize(path):
+    os.unlink(packed)
+    return path, None
+  return packed, encoding
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+""" Thread safe pool of S3 connections with cached bucket handles.
+
+Each checked out connection is used by one thread at a time. Idle
+connections are closed after `max_idle_sec`, and connections that sat idle
+longer than `health_check_sec` are checked with a HEAD on the bucket before
+being handed out again.
+
+    pool = ConnectionPool(connect, max_size=10)
+    with pool.bucket('my-bucket') as bucket:
+      bucket.get_key('index.html')
+"""
+from contextlib import contextmanager
+import httplib
+import logging
+import socket
+import threading
+import time
+
+from boto.exception import BotoServerError
+
+
+log = logging.getLogger(__name__)
+# Errors after which a connection can't be trusted anymore. S3 error
+# responses (404s and the like) leave the connection perfectly usable.
+_BROKEN = (socket.error, httplib.HTTPException)
+
+
+class PooledConnection(object):
+  """A connection plus the bucket handles opened on it"""
+  def __init__(self, conn):
+    self.conn = conn
+    self.buckets = {}
+    self.last_used = time.time()
+
+  def bucket(self, name):
+    if name not in self.buckets:
+      self.buckets[name] = self.conn.get_bucket(name, validate=False)
+    return self.buckets[name]
+
+  def is_healthy(self):
+    """Cheap round trip on a bucket we already use, if any"""
+    for name in self.buckets:
+      try:
+        self.conn.head_bucket(name)
+      except _BROKEN + (BotoServerError,):
+        return False
+      break
+    return True
+
+  def close(self):
+    try:
+      self.conn.close()
+    except _BROKEN:
+      pass
+
+
+class ConnectionPool(object):
+  """Bounded pool of `PooledConnection`s created by `factory`
+  """
+  def __init__(self, factory, max_size=10, max_idle_sec=300,
+               health_check_sec=60):
+    self.factory = factory
+    self.max_size = max_size
+    self.max_idle_sec = max_idle_sec
+    self.health_check_sec = health_check_sec
+    self._idle = []
+    self._lock = threading.Lock()
+    self._slots = threading.BoundedSemaphore(max_size)
+
+  def _acquire(self):
+    self._slots.acquire()
+    try:
+      while True:
+        with self._lock:
+          pooled = self._idle.pop() if self._idle else None
+        if pooled is None:
+          return PooledConnection(self.factory())
+        idle = time.time() - pooled.last_used
+        if idle > self.max_idle_sec:
+          pooled.close()
+        elif idle > self.health_check_sec and not pooled.is_healthy():
+          log.info('Dropping unhealthy S3 connection')
+          pooled.close()
+        else:
+          return pooled
+    except Exception:
+      self._slots.release()
+      raise
+
+  def _release(self, pooled, broken=False):
+    try:
+      if broken:
+        pooled.close()
+        return
+      pooled.last_used = time.time()
+      with self._lock:
+        self._idle.append(pooled)
+    finally:
+      self._slots.release()
+    self.evict_idle()
+
+  @contextmanager
+  def connection(self):
+    """Check out a `PooledConnection`. Connections that raise network errors
+    are closed instead of going back into the pool.
+    """
+    pooled = self._acquire()
+    broken = False
+    try:
+      yield pooled
+    except _BROKEN:
+      broken = True
+      raise
+    finally:
+      self._release(pooled, broken)
+
+  @contextmanager
+  def bucket(self, name):
+    """Check out a connection and yield its (cached) handle on bucket `name`
+    """
+    with self.connection() as pooled:
+      yield pooled.bucket(name)
+
+  def evict_idle(self):
+    """Close connections idle for longer than `max_idle_sec`. Runs on every
+    check in; the idle list is ordered by `last_used`, so the stale ones are
+    at its start.
+    """
+    now = time.time()
+    with self._lock:
+      count = 0
+      for pooled in self._idle:
+        if now - pooled.last_used <= self.max_idle_sec:
+          break
+        count += 1
+      stale, self._idle = self._idle[:count], self._idle[count:]
+    for pooled in stale:
+      pooled.close()
+
+  def close(self):
+    with self._lock:
+      idle, self._idle = self._idle, []
+    for pooled in idle:
+      pooled.close()
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+""" Process wide index of content addressed blobs that are already stored.
+
+Assets are stored once under `blob_key(name)` no matter how many pages
+reference them. Before uploading, `store_page` asks the index whether the
+blob is already there; the index remembers every blob it has seen (stored or
+found in storage) so each key costs at most one `file_exists` round trip per
+process.
+"""
+import logging
+import posixpath
+import threading
+
+from .registry import storage
+
+
+BLOB_PREFIX = 'blobs'
+
+
+log = logging.getLogger(__name__)
+
+
+def blob_key(name):
+  """Storage key of a content addressed asset"""
+  return posixpath.join(BLOB_PREFIX, name)
+
+
+class DedupIndex(object):
+  """Tracks which blob keys exist in storage.
+
+      if index.claim(key):
+        try:
+          storage.store_file(key, data)
+        except Exception:
+          index.release(key)
+          raise
+        index.stored(key)
+
+  While a claimed key is being uploaded, other workers claiming it wait for
+  the outcome, so no page ends up pointing at a blob whose upload failed.
+  """
+  def __init__(self):
+    self._known = set()
+    # key: Event set once its claimed upload succeeded or failed
+    self._pending = {}
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  def claim(self, key):
+    """Return True if the caller should upload `key`, False if the blob is
+    already stored. Blocks while another worker is uploading `key`, and
+    hands the upload over if that one fails. A claimed key has to be
+    settled with `stored` or `release`.
+    """
+    while True:
+      with self._lock:
+        if key in self._known:
+          self.hits += 1
+          return False
+        pending = self._pending.get(key)
+        if pending is None:
+          self._pending[key] = threading.Event()
+          break
+      pending.wait()
+    try:
+      exists = storage.file_exists(key)
+    except Exception:
+      self.release(key)
+      raise
+    if exists:
+      self.stored(key)
+      with self._lock:
+        self.hits += 1
+      return False
+    with self._lock:
+      self.misses += 1
+    return True
+
+  def stored(self, key):
+    """Record that the upload of a claimed key succeeded"""
+    with self._lock:
+      self._known.add(key)
+      pending = self._pending.pop(key, None)
+    if pending is not None:
+      pending.set()
+
+  def release(self, key):
+    """Give up a claimed key whose upload failed, a waiting worker gets to
+    try instead
+    """
+    with self._lock:
+      self._known.discard(key)
+      pending = self._pending.pop(key, None)
+    if pending is not None:
+      pending.set()
+
+  def __contains__(self, key):
+    with self._lock:
+      return key in self._known
+
+
+dedup_index = DedupIndex()
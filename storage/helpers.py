@@ -1,12 +1,21 @@
 # -*- coding: utf-8 -*-
-""" Helper functions for the storage package. Once we use this in production,
-we should probably use some type of threading.
+""" Helper functions for the storage package. Asset downloads and uploads run
+through a bounded, two stage thread pipeline (see `lib.pipeline`).
 """
+import hashlib
 import logging
 import mimetypes
+import posixpath
 import urlparse
 
-from .backends import storage
+from config import settings
+from lib import stats
+from lib.pipeline import Pipeline
+from .dedup import blob_key, dedup_index
+from .manifest import build_manifest
+from .registry import storage
+from .snapshot import (HASH_MAP_NAME, MANIFEST_NAME, format_hash_map,
+                       load_snapshot as _load_snapshot, manifest_entry)
 
 
 ADDITIONAL_TYPES = (('text/javascript', '.js'),)
@@ -20,26 +29,133 @@ for mime, extension in ADDITIONAL_TYPES:
 log = logging.getLogger(__name__)
 
 
-def store_page(page):
+def page_prefix(url):
+  """Storage key prefix for a page, so that pages archived in the same run
+  don't overwrite each other's files: "<host>/<md5 of url>"
+  """
+  host = urlparse.urlparse(url).netloc or 'unknown'
+  if isinstance(url, unicode):
+    url = url.encode('utf8')
+  return posixpath.join(host, hashlib.md5(url).hexdigest())
+
+
+def load_snapshot(prefix):
+  """The assets of the page previously stored under `prefix`, as
+  `{url: manifest.ManifestEntry}`, or None if there is no snapshot
+  """
+  return _load_snapshot(storage, prefix)
+
+
+def store_page(page, prefix='', download_workers=None, upload_workers=None,
+               previous=None, diff=None):
   """ Takes a `page.Page` object and stores the rewritten static assets
+
+  The page's own files are stored under `prefix` (see `page_prefix`). Assets
+  are content addressed and shared between pages: each is stored once under
+  `dedup.blob_key(asset.name)` and the page only keeps a relative reference
+  to it. Assets are downloaded and uploaded concurrently; worker counts
+  default to the `pipeline` config section. Downloads go through the page's
+  session, which limits how hard any one host is hit (see `session`), except
+  for those the renderer already captured (`page.captured`).
+
+  Next to index.html (and raw.html) a binary manifest of the assets is
+  stored, plus the legacy text hashmap if `snapshot.legacy_hashmap` is set.
+
+  For a recrawl, `previous` is the last snapshot (see `load_snapshot`):
+  assets it lists are fetched with conditional requests, and those the
+  server reports as not modified reuse the stored blob without being
+  downloaded or uploaded again. A `snapshot.SnapshotDiff`
+  passed as `diff` is filled in with what changed.
+
+  :returns: the storage key of the rewritten index.html
   """
+  opts = settings.pipeline
+  # References are relative between where the files really end up
+  page_dir = posixpath.dirname(
+      storage.resolve_key(posixpath.join(prefix, 'index.html'))) or '.'
+
+  def download(asset):
+    last = previous.get(asset.asset_url) if previous else None
+    captured = page.captured.get(asset.asset_url)
+    try:
+      if captured is not None:
+        asset.load_captured(captured)
+        fetched = True
+      else:
+        fetched = asset.download(page.session, previous=last)
+      if fetched:
+        asset.rename()
+    except Exception:
+      asset.release()
+      raise
+    if diff is not None:
+      if last is None:
+        kind = 'new'
+      elif not fetched:
+        kind = 'not_modified'
+      else:
+        kind = 'unchanged' if asset.name == last.name else 'changed'
+      diff.record(kind, asset.size if fetched else 0)
+    key = storage.resolve_key(blob_key(asset.name))
+    asset.rewrite(posixpath.relpath(key, page_dir))
+    return asset
+
+  def upload(asset):
+    if asset.path is None:
+      # Not modified since the previous snapshot, its blob is stored already
+      return asset
+    key = blob_key(asset.name)
+    try:
+      if dedup_index.claim(key):
+        try:
+          storage.upload_file(asset.path, key, None)
+        except Exception:
+          dedup_index.release(key)
+          raise
+        dedup_index.stored(key)
+        if diff is not None:
+          diff.record_upload()
+    finally:
+      asset.release()
+    return asset
+
   # First write the assets
+  Pipeline([
+      ('download', download, download_workers or opts.download_workers),
+      ('upload', upload, upload_workers or opts.upload_workers),
+  ]).run(page.assets)
+  if diff is not None and previous:
+    diff.removed = len(set(previous) - set(a.asset_url for a in page.assets))
 
-  for asset in page.assets:
-    asset.download(page.session)
-    asset.rename()
-    storage.store_file(asset.name, asset.content)
+  # Then the page itself and its manifest, in one batch
+  index = posixpath.join(prefix, 'index.html')
+  files = [
+      (posixpath.join(prefix, 'raw.html'), page.raw),
+      (index, page.rewritten),
+      (posixpath.join(prefix, MANIFEST_NAME), _manifest(page.assets)),
+  ]
+  if settings.snapshot.legacy_hashmap:
+    files.append((posixpath.join(prefix, HASH_MAP_NAME),
+                  _hash_map(page.assets)))
+  with stats.timer('store_page_files'):
+    results = storage.store_many(files)
+  failed = [r for r in results if not r.ok]
+  for r in failed:
+    log.error('Failed to store "%s": %s', r.key, r.error)
+  if failed:
+    raise failed[0].error
+  return index
 
-  storage.store_file('raw.html', page.raw)
-  storage.store_file('index.html', page.rewritten)
-  _store_hash_map(page.assets)
 
+@stats.timed('manifest')
+def _manifest(assets):
+  """Binary manifest of the stored assets (see `storage.manifest`)"""
+  return build_manifest(manifest_entry(a) for a in assets)
 
-def _store_hash_map(assets, name=None):
-  """
+
+@stats.timed('hash_map')
+def _hash_map(assets):
+  """Text listing the hashed name, original url and validators of every
+  asset (see `snapshot.format_hash_map`)
   """
-  data = ['Hashed name, Original Asset URL']
-  data.extend(['%s, %s' % (a.name, a.asset_url) for a in assets])
-  if name is None:
-    name = 'hashmap.txt'
-  storage.store_file(name, '\n'.join(data))
+  return format_hash_map(assets)
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+""" Local index of the keys stored in the S3 bucket, so existence checks
+don't need a HEAD request per object.
+
+The exact set of keys lives in a small sqlite database; a bloom filter in
+front of it answers most "not stored" questions without touching the disk.
+The index is filled by a full `list_files` sweep (`RemoteStorageAWS.
+build_index`, or `python -m storage.index --rebuild`) and kept up to date by
+every store and delete going through `RemoteStorageAWS`. Until a sweep has
+been done it isn't `complete` and lookups still go to S3.
+
+Writers outside this process don't update the index; the
+`filestorage.remote_aws.index.confirm` setting decides which answers get
+double checked against S3 ('never', 'missing' or 'always').
+"""
+import argparse
+import atexit
+import hashlib
+import logging
+import math
+import os
+import sqlite3
+import struct
+import sys
+import threading
+import time
+
+from config import settings
+
+
+_BLOOM_HEADER = struct.Struct('<4sQIQ')
+_BLOOM_MAGIC = 'TBF2'
+_BATCH = 1000
+
+
+log = logging.getLogger(__name__)
+
+
+def _encode(key):
+  if isinstance(key, unicode):
+    return key.encode('utf8')
+  return key
+
+
+class BloomFilter(object):
+  """Fixed size bloom filter sized for `capacity` keys at `error_rate`
+  false positives. Keys can't be removed.
+  """
+  __slots__ = ('num_bits', 'num_hashes', 'bits')
+
+  def __init__(self, capacity, error_rate=0.001, num_bits=None,
+               num_hashes=None, bits=None):
+    capacity = max(capacity, 1)
+    if num_bits is None:
+      num_bits = int(math.ceil(-capacity * math.log(error_rate) /
+                               math.log(2) ** 2))
+      num_hashes = max(1, int(round(num_bits / float(capacity) *
+                                    math.log(2))))
+    self.num_bits = num_bits
+    self.num_hashes = num_hashes
+    self.bits = bits if bits is not None else bytearray((num_bits + 7) // 8)
+
+  def _positions(self, key):
+    # Double hashing: k positions out of the two halves of one digest
+    a, b = struct.unpack('<QQ', hashlib.md5(_encode(key)).digest())
+    for i in range(self.num_hashes):
+      yield (a + i * b) % self.num_bits
+
+  def add(self, key):
+    for pos in self._positions(key):
+      self.bits[pos >> 3] |= 1 << (pos & 7)
+
+  def __contains__(self, key):
+    return all(self.bits[pos >> 3] & (1 << (pos & 7))
+               for pos in self._positions(key))
+
+  def save(self, path, generation):
+    """Write the filter to `path`, tagged with the generation of the key set
+    it reflects
+    """
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+      f.write(_BLOOM_HEADER.pack(_BLOOM_MAGIC, self.num_bits,
+                                 self.num_hashes, generation))
+      f.write(self.bits)
+    os.rename(tmp, path)
+
+  @classmethod
+  def load(cls, path):
+    """(filter, generation) read from `path`, or (None, None) if it is
+    missing or unreadable
+    """
+    try:
+      with open(path, 'rb') as f:
+        magic, num_bits, num_hashes, generation = _BLOOM_HEADER.unpack(
+            f.read(_BLOOM_HEADER.size))
+        bits = bytearray(f.read())
+    except (IOError, struct.error):
+      return None, None
+    if magic != _BLOOM_MAGIC or len(bits) != (num_bits + 7) // 8:
+      return None, None
+    return (cls(0, num_bits=num_bits, num_hashes=num_hashes, bits=bits),
+            generation)
+
+
+class ExistenceIndex(object):
+  """Bloom filter plus exact on-disk set of the keys in one bucket, stored
+  under the directory `path`. Thread safe.
+
+  Every change to the key set bumps a generation number kept in the
+  database; the saved filter records the generation it was built at and is
+  only reused if that still matches, otherwise it is rebuilt from the keys.
+  """
+  def __init__(self, path, capacity=1000000, error_rate=0.001):
+    self.path = path
+    self.capacity = capacity
+    self.error_rate = error_rate
+    self._lock = threading.Lock()
+    if not os.path.isdir(path):
+      os.makedirs(path)
+    self._db = sqlite3.connect(os.path.join(path, 'keys.sqlite'),
+                               check_same_thread=False)
+    self._db.execute('PRAGMA journal_mode=WAL')
+    self._db.execute('PRAGMA synchronous=NORMAL')
+    self._db.execute('CREATE TABLE IF NOT EXISTS keys '
+                     '(key TEXT PRIMARY KEY)')
+    self._db.execute('CREATE TABLE IF NOT EXISTS meta '
+                     '(name TEXT PRIMARY KEY, value TEXT)')
+    self._db.commit()
+    self._bloom_path = os.path.join(path, 'keys.bloom')
+    self._bloom = self._load_bloom()
+
+  def _count(self):
+    return self._db.execute('SELECT COUNT(*) FROM keys').fetchone()[0]
+
+  def _generation(self):
+    row = self._db.execute(
+        "SELECT value FROM meta WHERE name = 'generation'").fetchone()
+    return int(row[0]) if row is not None else 0
+
+  def _bump(self):
+    """Record a change of the key set, inside the current transaction"""
+    self._db.execute("INSERT OR REPLACE INTO meta VALUES ('generation', ?)",
+                     (str(self._generation() + 1),))
+
+  def _load_bloom(self):
+    """The saved filter if it matches the database, else a fresh one"""
+    bloom, generation = BloomFilter.load(self._bloom_path)
+    if bloom is not None and generation == self._generation():
+      return bloom
+    return self._build_bloom(self._count())
+
+  def _build_bloom(self, count):
+    bloom = BloomFilter(max(self.capacity, count * 2), self.error_rate)
+    for (key,) in self._db.execute('SELECT key FROM keys'):
+      bloom.add(key)
+    return bloom
+
+  @property
+  def complete(self):
+    """True once a full sweep of the bucket has been recorded"""
+    with self._lock:
+      row = self._db.execute(
+          "SELECT value FROM meta WHERE name = 'swept_at'").fetchone()
+    return row is not None
+
+  def __contains__(self, key):
+    if key not in self._bloom:
+      return False
+    with self._lock:
+      return self._db.execute('SELECT 1 FROM keys WHERE key = ?',
+                              (_encode(key).decode('utf8'),)).fetchone() \
+          is not None
+
+  def add(self, key):
+    self.add_many([key])
+
+  def add_many(self, keys):
+    keys = [(_encode(k).decode('utf8'),) for k in keys]
+    with self._lock:
+      self._db.executemany('INSERT OR IGNORE INTO keys VALUES (?)', keys)
+      self._bump()
+      self._db.commit()
+      for (key,) in keys:
+        self._bloom.add(key)
+
+  def discard(self, key):
+    self.discard_many([key])
+
+  def discard_many(self, keys):
+    """Forget `keys`. They stay in the bloom filter (a false positive that
+    the exact set then rules out) until the next save and reload.
+    """
+    with self._lock:
+      self._db.executemany('DELETE FROM keys WHERE key = ?',
+                           [(_encode(k).decode('utf8'),) for k in keys])
+      self._bump()
+      self._db.commit()
+
+  def rebuild(self, keys):
+    """Replace the index with `keys`, the result of a full bucket listing,
+    and mark it complete.
+
+    :returns: number of keys indexed
+    """
+    keys = iter(keys)
+    with self._lock:
+      self._db.execute('DELETE FROM keys')
+      while True:
+        batch = [(_encode(k).decode('utf8'),)
+                 for _, k in zip(range(_BATCH), keys)]
+        if not batch:
+          break
+        self._db.executemany('INSERT OR IGNORE INTO keys VALUES (?)', batch)
+      self._db.execute("INSERT OR REPLACE INTO meta VALUES ('swept_at', ?)",
+                       (str(time.time()),))
+      self._bump()
+      self._db.commit()
+      count = self._count()
+      self._bloom = self._build_bloom(count)
+      self._bloom.save(self._bloom_path, self._generation())
+    log.info('Indexed %d keys', count)
+    return count
+
+  def save(self):
+    """Persist the bloom filter so the next process can skip rebuilding it"""
+    with self._lock:
+      self._bloom.save(self._bloom_path, self._generation())
+
+  def close(self):
+    with self._lock:
+      if self._db is None:
+        return
+    self.save()
+    with self._lock:
+      self._db.close()
+      self._db = None
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+  """The process wide `ExistenceIndex`, or None if it is disabled"""
+  global _index
+  opts = settings.filestorage.remote_aws.index
+  if not opts.enabled:
+    return None
+  if _index is None:
+    with _index_lock:
+      if _index is None:
+        _index = ExistenceIndex(opts.path, opts.capacity, opts.error_rate)
+        # Long running processes keep adding keys, save the filter on exit
+        # so the next process can reuse it
+        atexit.register(_index.close)
+  return _index
+
+
+parser = argparse.ArgumentParser(description='Manage the S3 key index.')
+parser.add_argument('--rebuild', action='store_true',
+                    help='Sweep the whole bucket and rebuild the index')
+
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.INFO)
+  args = parser.parse_args()
+  index = get_index()
+  if index is None:
+    sys.exit('filestorage.remote_aws.index is disabled')
+  if args.rebuild:
+    from .aws import RemoteStorageAWS
+    RemoteStorageAWS.build_index()
+  sys.stdout.write('complete: %s\n' % index.complete)
+  index.close()
@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+""" Binary, memory-mappable snapshot manifests.
+
+A manifest lists the assets of a page snapshot (or of many, merged) with
+their stored name, original url, size, content type, sha256 digest, fetch
+time and HTTP validators. Lookups by url and by name are binary searches
+over fixed width records, so even a manifest with millions of entries is
+queried in O(log n) without being loaded into memory:
+
+    with Manifest.open('manifest.tmf') as m:
+      m.by_url('http://example.com/site.js').name
+      m.by_name('3f9a...e1.js').url
+
+Layout (all integers little endian):
+
+    header    magic "TMF1", version, entry count and the offsets of the
+              sections below (`_HEADER`, padded to 64 bytes)
+    records   `count` fixed width records (`_RECORD`) sorted by url
+    names     `count` uint32 record numbers sorted by name
+    strings   utf-8 strings referenced by (offset, length) from the records
+
+`python -m storage.manifest` converts legacy `hashmap.txt` files and looks
+entries up from the command line.
+"""
+from array import array
+from collections import namedtuple
+import argparse
+import mmap
+import os
+import struct
+import sys
+
+
+MAGIC = 'TMF1'
+VERSION = 1
+# magic, version, flags, count, records, names, strings offsets, strings size
+_HEADER = struct.Struct('<4sHHQQQQQ')
+_HEADER_SIZE = 64
+# (offset, length) of url, name, content type, etag and last modified, then
+# size, fetched_at and the raw sha256 digest
+_RECORD = struct.Struct('<' + 'QI' * 5 + 'Qd32s')
+_NO_SIZE = 2 ** 64 - 1
+_NO_DIGEST = '\0' * 32
+
+
+# One asset of a snapshot. Fields other than `url` and `name` are None when
+# unknown (e.g. entries converted from a legacy hashmap).
+ManifestEntry = namedtuple('ManifestEntry', 'url name size content_type '
+                                            'digest fetched_at etag '
+                                            'last_modified')
+
+
+class ManifestError(ValueError):
+  pass
+
+
+def _utf8(value):
+  if isinstance(value, unicode):
+    return value.encode('utf8')
+  return value
+
+
+def build_manifest(entries):
+  """Serialize an iterable of `ManifestEntry` into manifest bytes. Entries
+  sharing a url are collapsed, the last one wins.
+  """
+  by_url = {}
+  for entry in entries:
+    by_url[_utf8(entry.url)] = entry
+  urls = sorted(by_url)
+
+  strings, interned = [], {}
+  size = [0]
+
+  def ref(value):
+    # Repeated strings (content types mostly) are stored once
+    if not value:
+      return 0, 0
+    value = _utf8(value)
+    if value not in interned:
+      interned[value] = size[0]
+      strings.append(value)
+      size[0] += len(value)
+    return interned[value], len(value)
+
+  records = []
+  names = []
+  for i, url in enumerate(urls):
+    e = by_url[url]
+    fields = []
+    for value in (url, e.name, e.content_type, e.etag, e.last_modified):
+      fields.extend(ref(value))
+    fields.append(_NO_SIZE if e.size is None else e.size)
+    fields.append(e.fetched_at or 0.0)
+    fields.append(e.digest.decode('hex') if e.digest else _NO_DIGEST)
+    records.append(_RECORD.pack(*fields))
+    names.append((_utf8(e.name), i))
+  name_index = array('I', [i for _, i in sorted(names)])
+
+  records_at = _HEADER_SIZE
+  names_at = records_at + len(records) * _RECORD.size
+  strings_at = names_at + len(name_index) * name_index.itemsize
+  header = _HEADER.pack(MAGIC, VERSION, 0, len(urls), records_at, names_at,
+                        strings_at, size[0])
+  return ''.join([header.ljust(_HEADER_SIZE, '\0')] + records +
+                 [name_index.tostring()] + strings)
+
+
+def write_manifest(entries, path):
+  """Write a manifest file, atomically"""
+  tmp = path + '.tmp'
+  with open(tmp, 'wb') as f:
+    f.write(build_manifest(entries))
+  os.rename(tmp, path)
+
+
+class Manifest(object):
+  """Read only view of a manifest held in `buf`, a string or an mmap"""
+  def __init__(self, buf, _file=None):
+    self._buf = buf
+    self._file = _file
+    if len(buf) < _HEADER_SIZE:
+      raise ManifestError('Truncated manifest')
+    (magic, version, _, self._count, self._records, self._names,
+     self._strings, strings_size) = _HEADER.unpack_from(buf, 0)
+    if magic != MAGIC or version != VERSION:
+      raise ManifestError('Not a version %d manifest' % VERSION)
+    if len(buf) < self._strings + strings_size:
+      raise ManifestError('Truncated manifest')
+
+  @classmethod
+  def open(cls, path):
+    """Memory map the manifest file at `path`"""
+    f = open(path, 'rb')
+    try:
+      buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except Exception:
+      f.close()
+      raise
+    return cls(buf, f)
+
+  def close(self):
+    if self._file is not None:
+      self._buf.close()
+      self._file.close()
+      self._file = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+    return False
+
+  def __len__(self):
+    return self._count
+
+  def __iter__(self):
+    """Entries in url order"""
+    for i in range(self._count):
+      yield self[i]
+
+  def _string(self, offset, length):
+    start = self._strings + offset
+    return self._buf[start:start + length]
+
+  def _record(self, i):
+    return _RECORD.unpack_from(self._buf, self._records + i * _RECORD.size)
+
+  def _url(self, i):
+    url_off, url_len = _RECORD.unpack_from(
+        self._buf, self._records + i * _RECORD.size)[:2]
+    return self._string(url_off, url_len)
+
+  def _name_record(self, j):
+    i, = struct.unpack_from('<I', self._buf, self._names + j * 4)
+    return i
+
+  def _name(self, i):
+    name_off, name_len = _RECORD.unpack_from(
+        self._buf, self._records + i * _RECORD.size)[2:4]
+    return self._string(name_off, name_len)
+
+  def __getitem__(self, i):
+    if not 0 <= i < self._count:
+      raise IndexError(i)
+    r = self._record(i)
+    url, name, content_type, etag, last_modified = [
+        self._string(r[k], r[k + 1]).decode('utf8') or None
+        for k in range(0, 10, 2)]
+    size, fetched_at, digest = r[10:]
+    return ManifestEntry(
+        url, name, None if size == _NO_SIZE else size, content_type,
+        None if digest == _NO_DIGEST else digest.encode('hex'),
+        fetched_at or None, etag, last_modified)
+
+  @staticmethod
+  def _bisect(count, key, target):
+    lo, hi = 0, count
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if key(mid) < target:
+        lo = mid + 1
+      else:
+        hi = mid
+    return lo
+
+  def by_url(self, url):
+    """The entry for `url`, or None"""
+    url = _utf8(url)
+    i = self._bisect(self._count, self._url, url)
+    if i < self._count and self._url(i) == url:
+      return self[i]
+    return None
+
+  def _records_named(self, name):
+    """Record numbers of the entries stored as `name`"""
+    name = _utf8(name)
+    j = self._bisect(self._count, lambda j: self._name(self._name_record(j)),
+                     name)
+    while j < self._count:
+      i = self._name_record(j)
+      if self._name(i) != name:
+        break
+      yield i
+      j += 1
+
+  def by_name(self, name):
+    """The first entry stored as `name` (several urls can share one), or
+    None
+    """
+    for i in self._records_named(name):
+      return self[i]
+    return None
+
+  def urls_for_name(self, name):
+    """Every url stored as `name`"""
+    return [self._url(i).decode('utf8') for i in self._records_named(name)]
+
+
+parser = argparse.ArgumentParser(description='Snapshot manifest tools.')
+commands = parser.add_subparsers(dest='command')
+convert_cmd = commands.add_parser(
+    'convert', help='Convert a legacy hashmap.txt into a manifest')
+convert_cmd.add_argument('hashmap')
+convert_cmd.add_argument('output')
+lookup_cmd = commands.add_parser('lookup', help='Look entries up')
+lookup_cmd.add_argument('manifest')
+lookup_cmd.add_argument('--url', action='append', default=[])
+lookup_cmd.add_argument('--name', action='append', default=[])
+dump_cmd = commands.add_parser('dump', help='List every entry')
+dump_cmd.add_argument('manifest')
+
+
+def _show(entry, out=sys.stdout):
+  if entry is None:
+    out.write('not found\n')
+    return
+  out.write('%s\n' % '\t'.join(
+      u'%s' % ('-' if v is None else v) for v in entry).encode('utf8'))
+
+
+if __name__ == '__main__':
+  from .snapshot import convert_hash_map
+  args = parser.parse_args()
+  if args.command == 'convert':
+    with open(args.hashmap, 'rb') as f:
+      data = convert_hash_map(f.read(), os.path.getmtime(args.hashmap))
+    with open(args.output, 'wb') as f:
+      f.write(data)
+  else:
+    with Manifest.open(args.manifest) as m:
+      if args.command == 'dump':
+        for entry in m:
+          _show(entry)
+      for url in args.url:
+        _show(m.by_url(url))
+      for name in args.name:
+        _show(m.by_name(name))
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+""" Move a local store into the layout `LocalStorage` currently uses, e.g.
+after upgrading from the flat layout or changing the shard settings.
+
+    python -m storage.migrate --dry-run
+    python -m storage.migrate
+"""
+import argparse
+import logging
+import sys
+
+from .backends import LocalStorage
+
+
+parser = argparse.ArgumentParser(
+    description='Move local storage files into the sharded layout.')
+parser.add_argument('--dry-run', action='store_true',
+                    help='Only report how many files would move')
+
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.INFO)
+  args = parser.parse_args()
+  moved = LocalStorage.migrate_layout(dry_run=args.dry_run)
+  sys.stdout.write('%d file(s) %s\n' % (
+      moved, 'to move' if args.dry_run else 'moved'))
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+""" Registry of storage backends, resolved lazily.
+
+Backends are registered by name as a class or as a "module:attribute"
+string, and only imported the first time they are used, so a local run
+never loads boto. The backend in use comes from `use_backend(name)` (e.g.
+crawl.py's `--storage` flag), else the `filestorage.backend` setting, else
+"aws" if `filestorage.use_remote_aws` is set outside of test mode, else
+"local".
+
+Third-party backends either call `register_backend` themselves or declare a
+setuptools entry point in the "tessen.storage" group, which is only looked
+up when a name isn't registered:
+
+    entry_points={'tessen.storage': ['gcs = tessen_gcs:GCSStorage']}
+
+`storage` is a stand-in for the selected backend, usable wherever the
+backend class itself was (`storage.store_file(...)`).
+"""
+import importlib
+import logging
+import threading
+
+import config as cfg
+from config import settings
+
+
+ENTRY_POINT_GROUP = 'tessen.storage'
+
+
+log = logging.getLogger(__name__)
+
+
+_backends = {
+    'local': 'storage.backends:LocalStorage',
+    'aws': 'storage.aws:RemoteStorageAWS',
+}
+_lock = threading.RLock()
+_selected = None
+_current = None
+
+
+def register_backend(name, backend):
+  """Make `backend` (a class, or a "module:attribute" string naming one)
+  available as `name`
+  """
+  global _current
+  with _lock:
+    _backends[name] = backend
+    if _current is not None and _name() == name:
+      _current = None
+
+
+def available_backends():
+  return sorted(_backends)
+
+
+def use_backend(name):
+  """Select the backend `name` for the rest of the process"""
+  global _selected, _current
+  with _lock:
+    _selected = name
+    _current = None
+
+
+def _name():
+  if _selected is not None:
+    return _selected
+  opts = settings.filestorage
+  if opts.get('backend'):
+    return opts.backend
+  if opts.use_remote_aws and not cfg.test_mode:
+    return 'aws'
+  return 'local'
+
+
+def _load(spec):
+  if not isinstance(spec, basestring):
+    return spec
+  module, _, attr = spec.partition(':')
+  return getattr(importlib.import_module(module), attr)
+
+
+def _from_entry_point(name):
+  try:
+    import pkg_resources
+  except ImportError:
+    return None
+  for entry_point in pkg_resources.iter_entry_points(ENTRY_POINT_GROUP, name):
+    return entry_point.load()
+  return None
+
+
+def get_backend():
+  """The selected backend class, imported on first use"""
+  global _current
+  backend = _current
+  if backend is not None:
+    return backend
+  with _lock:
+    if _current is None:
+      name = _name()
+      if name in _backends:
+        _current = _load(_backends[name])
+      else:
+        _current = _from_entry_point(name)
+        if _current is None:
+          raise ValueError('Unknown storage backend "%s" (known: %s)' % (
+              name, ', '.join(available_backends())))
+        _backends[name] = _current
+      log.debug("Using %s as Storage Manager", _current.__name__)
+    return _current
+
+
+class _Backend(object):
+  """Forwards everything to the backend `get_backend` returns"""
+  __slots__ = ()
+
+  def __getattr__(self, attr):
+    return getattr(get_backend(), attr)
+
+  def __repr__(self):
+    return '<storage backend %s>' % _name()
+
+
+storage = _Backend()
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+""" Reading and writing a page snapshot's manifest, and what changed between
+two snapshots of the same page.
+
+Every stored page gets a binary `manifest.tmf` (see `storage.manifest`)
+describing its assets. Pages stored before that have a text hashmap
+instead, which can be converted with `convert_hash_map` and is still read
+when there is no manifest. The hashmap lists the hashed name of each asset, its
+original url and the validators (ETag, Last-Modified) the server sent for
+it:
+
+    Hashed name, Original Asset URL, ETag, Last-Modified
+    3f9a...e1.js, http://example.com/site.js, %22abc%22, 1420070400
+
+The ETag is url quoted and Last-Modified is a unix timestamp so neither can
+contain the ", " separator ("-" when missing). Hashmaps written before the
+validator columns existed have only the first two columns and still parse.
+
+A recrawl uses the previous snapshot to make conditional requests and reuse
+unchanged assets by name (see `storage.store_page`).
+"""
+from email.utils import formatdate, mktime_tz, parsedate_tz
+import logging
+import threading
+import urllib
+
+from .manifest import Manifest, ManifestEntry, build_manifest
+
+
+MANIFEST_NAME = 'manifest.tmf'
+HASH_MAP_NAME = 'hashmap.txt'
+HEADER = 'Hashed name, Original Asset URL'
+HEADER_VALIDATORS = HEADER + ', ETag, Last-Modified'
+_MISSING = '-'
+
+
+log = logging.getLogger(__name__)
+
+
+def _pack_etag(etag):
+  return urllib.quote(etag, safe='') if etag else _MISSING
+
+
+def _unpack_etag(value):
+  return urllib.unquote(value) if value != _MISSING else None
+
+
+def _pack_date(value):
+  parsed = parsedate_tz(value) if value else None
+  return str(mktime_tz(parsed)) if parsed else _MISSING
+
+
+def _unpack_date(value):
+  if value == _MISSING or not value.isdigit():
+    return None
+  return formatdate(int(value), usegmt=True)
+
+
+def format_hash_map(assets):
+  """Text listing the hashed name, original url and validators of every
+  asset (anything with `name`, `asset_url`, `etag` and `last_modified`)
+  """
+  data = [HEADER_VALIDATORS]
+  data.extend(['%s, %s, %s, %s' % (a.name, a.asset_url, _pack_etag(a.etag),
+                                   _pack_date(a.last_modified))
+               for a in assets])
+  return '\n'.join(data)
+
+
+def parse_hash_map(text):
+  """`{url: ManifestEntry}` from the contents of a hashmap"""
+  lines = text.splitlines()
+  if not lines:
+    return {}
+  validators = lines[0].strip() == HEADER_VALIDATORS
+  entries = {}
+  for line in lines[1:]:
+    if ', ' not in line:
+      continue
+    name, rest = line.split(', ', 1)
+    etag = last_modified = None
+    if validators:
+      url, etag, last_modified = rest.rsplit(', ', 2)
+      etag, last_modified = _unpack_etag(etag), _unpack_date(last_modified)
+    else:
+      url = rest
+    entries[url] = ManifestEntry(url, name, None, None, None, None, etag,
+                                 last_modified)
+  return entries
+
+
+def convert_hash_map(text, fetched_at=None):
+  """Manifest bytes from the contents of a legacy hashmap. The digest is
+  recovered from the hashed name; sizes and content types are unknown.
+  """
+  entries = []
+  for entry in parse_hash_map(text).values():
+    digest = entry.name.split('.', 1)[0]
+    if len(digest) != 64:
+      digest = None
+    entries.append(entry._replace(digest=digest, fetched_at=fetched_at))
+  return build_manifest(entries)
+
+
+def manifest_entry(asset):
+  """`ManifestEntry` of a stored `page.Asset`"""
+  return ManifestEntry(asset.asset_url, asset.name, asset.size,
+                       asset.content_type, asset.hash, asset.fetched_at,
+                       asset.etag, asset.last_modified)
+
+
+def load_snapshot(storage, prefix):
+  """`{url: ManifestEntry}` of the snapshot stored under `prefix`, read from
+  its manifest or else its legacy hashmap, or None if there is neither
+  """
+  for name, parse in ((MANIFEST_NAME, _parse_manifest),
+                      (HASH_MAP_NAME, parse_hash_map)):
+    key = '%s/%s' % (prefix, name) if prefix else name
+    if not storage.file_exists(key):
+      continue
+    try:
+      return parse(storage.read_file(key))
+    except (IOError, ValueError):
+      log.warn('Could not read previous snapshot "%s"', key)
+  return None
+
+
+def _parse_manifest(data):
+  return dict((entry.url, entry) for entry in Manifest(data))
+
+
+class SnapshotDiff(object):
+  """What changed since the previous snapshot of a page. Every asset of the
+  new snapshot is counted as exactly one of:
+
+  - `new`: its url wasn't in the previous snapshot
+  - `not_modified`: the server answered 304, the old copy is reused
+  - `unchanged`: downloaded again, but the content is the same
+  - `changed`: downloaded again, with new content
+
+  `removed` counts urls of the previous snapshot no longer referenced, and
+  `downloaded_bytes` / `uploaded` what the recrawl actually transferred.
+  """
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.new = self.not_modified = self.unchanged = self.changed = 0
+    self.removed = 0
+    self.downloaded_bytes = 0
+    self.uploaded = 0
+
+  def record(self, kind, downloaded_bytes=0):
+    with self._lock:
+      setattr(self, kind, getattr(self, kind) + 1)
+      self.downloaded_bytes += downloaded_bytes
+
+  def record_upload(self):
+    with self._lock:
+      self.uploaded += 1
+
+  def to_dict(self):
+    return dict(new=self.new, not_modified=self.not_modified,
+                unchanged=self.unchanged, changed=self.changed,
+                removed=self.removed, downloaded_bytes=self.downloaded_bytes,
+                uploaded=self.uploaded)
+
+  def __str__(self):
+    return ('%(new)d new, %(changed)d changed, %(unchanged)d unchanged, '
+            '%(not_modified)d not modified, %(removed)d removed; '
+            '%(uploaded)d uploaded, %(downloaded_bytes)d bytes downloaded'
+            % self.to_dict())
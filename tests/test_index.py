@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from storage.index import BloomFilter, ExistenceIndex
+
+
+class ExistenceIndexTest(unittest.TestCase):
+  def setUp(self):
+    self.path = tempfile.mkdtemp(prefix='tessen-test-')
+
+  def tearDown(self):
+    shutil.rmtree(self.path)
+
+  def _index(self):
+    return ExistenceIndex(self.path, capacity=1000)
+
+  def test_add_and_discard(self):
+    index = self._index()
+    index.add_many(['a', 'b'])
+    index.discard('a')
+    self.assertNotIn('a', index)
+    self.assertIn('b', index)
+    self.assertNotIn('c', index)
+    index.close()
+
+  def test_reload_after_save(self):
+    index = self._index()
+    index.add_many(['a', 'b'])
+    index.close()
+    index = self._index()
+    self.assertIn('a', index)
+    self.assertIn('b', index)
+    index.close()
+
+  def test_stale_filter_is_not_reused(self):
+    index = self._index()
+    index.add('a')
+    index.save()
+    # Same number of keys as when the filter was saved, but not the same
+    # keys: the saved filter doesn't know 'b'
+    index.add('b')
+    index.discard('a')
+    index._db.close()
+    index = self._index()
+    self.assertIn('b', index)
+    self.assertNotIn('a', index)
+    index.close()
+
+  def test_rebuild_marks_complete(self):
+    index = self._index()
+    self.assertFalse(index.complete)
+    self.assertEqual(index.rebuild(['a', 'b', 'c']), 3)
+    self.assertTrue(index.complete)
+    self.assertIn('c', index)
+    index.close()
+
+
+class BloomFilterTest(unittest.TestCase):
+  def test_save_and_load(self):
+    path = tempfile.mktemp(prefix='tessen-test-')
+    bloom = BloomFilter(100)
+    bloom.add('a')
+    bloom.save(path, 7)
+    try:
+      loaded, generation = BloomFilter.load(path)
+    finally:
+      os.unlink(path)
+    self.assertEqual(generation, 7)
+    self.assertIn('a', loaded)
+
+  def test_load_missing(self):
+    self.assertEqual(BloomFilter.load('/nonexistent/bloom'), (None, None))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from storage.manifest import (Manifest, ManifestEntry, ManifestError,
+                              build_manifest, write_manifest)
+from storage.snapshot import (HASH_MAP_NAME, MANIFEST_NAME, convert_hash_map,
+                              load_snapshot, parse_hash_map)
+
+
+DIGEST = 'ab' * 32
+ENTRIES = [
+    ManifestEntry(u'http://example.com/site.js', DIGEST + '.js', 1024,
+                  u'application/javascript', DIGEST, 1420070400.5,
+                  u'"abc"', u'Thu, 01 Jan 2015 00:00:00 GMT'),
+    ManifestEntry(u'http://example.com/a.png', 'cd' * 32 + '.png', 10,
+                  u'image/png', 'cd' * 32, 1420070401.0, None, None),
+    # Same blob as site.js, served from another url
+    ManifestEntry(u'http://cdn.example.com/site.js', DIGEST + '.js', 1024,
+                  u'application/javascript', DIGEST, 1420070402.0, None,
+                  None),
+    ManifestEntry(u'http://example.com/\xe9t\xe9.css', 'ef' * 32 + '.css',
+                  None, None, None, None, None, None),
+]
+LEGACY = ('Hashed name, Original Asset URL\n'
+          '%s.js, http://example.com/site.js\n' % DIGEST)
+LEGACY_VALIDATORS = (
+    'Hashed name, Original Asset URL, ETag, Last-Modified\n'
+    '%s.js, http://example.com/site.js, %%22abc%%22, 1420070400\n'
+    'short.png, http://example.com/a.png, -, -\n' % DIGEST)
+
+
+class FakeStorage(object):
+  def __init__(self, files):
+    self.files = files
+
+  def file_exists(self, key):
+    return key in self.files
+
+  def read_file(self, key):
+    return self.files[key]
+
+
+class ManifestTest(unittest.TestCase):
+  def setUp(self):
+    self.manifest = Manifest(build_manifest(ENTRIES))
+
+  def test_round_trip(self):
+    self.assertEqual(len(self.manifest), len(ENTRIES))
+    self.assertEqual(sorted(self.manifest), sorted(ENTRIES))
+
+  def test_iterates_in_url_order(self):
+    urls = [entry.url for entry in self.manifest]
+    self.assertEqual(urls, sorted(urls, key=lambda u: u.encode('utf8')))
+
+  def test_by_url(self):
+    for entry in ENTRIES:
+      self.assertEqual(self.manifest.by_url(entry.url), entry)
+    self.assertIsNone(self.manifest.by_url('http://example.com/missing'))
+
+  def test_by_name(self):
+    entry = self.manifest.by_name('cd' * 32 + '.png')
+    self.assertEqual(entry.url, u'http://example.com/a.png')
+    self.assertIsNone(self.manifest.by_name('missing.js'))
+    self.assertEqual(sorted(self.manifest.urls_for_name(DIGEST + '.js')),
+                     [u'http://cdn.example.com/site.js',
+                      u'http://example.com/site.js'])
+
+  def test_last_duplicate_url_wins(self):
+    replaced = ENTRIES[0]._replace(size=1)
+    manifest = Manifest(build_manifest(ENTRIES + [replaced]))
+    self.assertEqual(len(manifest), len(ENTRIES))
+    self.assertEqual(manifest.by_url(replaced.url).size, 1)
+
+  def test_empty(self):
+    manifest = Manifest(build_manifest([]))
+    self.assertEqual(len(manifest), 0)
+    self.assertIsNone(manifest.by_url('http://example.com/'))
+
+  def test_open_mapped_file(self):
+    root = tempfile.mkdtemp(prefix='tessen-test-')
+    try:
+      path = os.path.join(root, MANIFEST_NAME)
+      write_manifest(ENTRIES, path)
+      with Manifest.open(path) as manifest:
+        self.assertEqual(manifest.by_url(ENTRIES[1].url), ENTRIES[1])
+    finally:
+      shutil.rmtree(root)
+
+  def test_rejects_garbage(self):
+    data = build_manifest(ENTRIES)
+    self.assertRaises(ManifestError, Manifest, data[:10])
+    self.assertRaises(ManifestError, Manifest, data[:-1])
+    self.assertRaises(ManifestError, Manifest, 'XXXX' + data[4:])
+
+
+class LegacyHashMapTest(unittest.TestCase):
+  def test_parse_two_columns(self):
+    entry = parse_hash_map(LEGACY)['http://example.com/site.js']
+    self.assertEqual(entry.name, DIGEST + '.js')
+    self.assertIsNone(entry.etag)
+
+  def test_parse_validators(self):
+    entries = parse_hash_map(LEGACY_VALIDATORS)
+    entry = entries['http://example.com/site.js']
+    self.assertEqual(entry.etag, '"abc"')
+    self.assertEqual(entry.last_modified, 'Thu, 01 Jan 2015 00:00:00 GMT')
+    self.assertIsNone(entries['http://example.com/a.png'].etag)
+
+  def test_convert(self):
+    manifest = Manifest(convert_hash_map(LEGACY_VALIDATORS, 1420070400.0))
+    entry = manifest.by_url('http://example.com/site.js')
+    self.assertEqual(entry.digest, DIGEST)
+    self.assertEqual(entry.etag, '"abc"')
+    self.assertEqual(entry.fetched_at, 1420070400.0)
+    # Names that aren't a sha256 don't give a digest
+    self.assertIsNone(manifest.by_url('http://example.com/a.png').digest)
+
+  def test_load_snapshot_prefers_manifest(self):
+    storage = FakeStorage({
+        'page/' + MANIFEST_NAME: build_manifest(ENTRIES[:1]),
+        'page/' + HASH_MAP_NAME: LEGACY_VALIDATORS,
+    })
+    snapshot = load_snapshot(storage, 'page')
+    self.assertEqual(snapshot, {ENTRIES[0].url: ENTRIES[0]})
+
+  def test_load_snapshot_falls_back_to_hashmap(self):
+    storage = FakeStorage({'page/' + HASH_MAP_NAME: LEGACY})
+    snapshot = load_snapshot(storage, 'page')
+    self.assertEqual(snapshot['http://example.com/site.js'].name,
+                     DIGEST + '.js')
+
+  def test_load_snapshot_missing(self):
+    self.assertIsNone(load_snapshot(FakeStorage({}), 'page'))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+import unittest
+
+from lib.retry import (CircuitBreakers, CircuitOpenError, backoff_delay,
+                       hedged, retry)
+
+
+class Flaky(object):
+  """Raises `error` for the first `failures` calls, then returns 'ok'"""
+  def __init__(self, failures, error=IOError):
+    self.failures = failures
+    self.error = error
+    self.calls = 0
+
+  def __call__(self):
+    self.calls += 1
+    if self.calls <= self.failures:
+      raise self.error('failure %d' % self.calls)
+    return 'ok'
+
+
+class RetryTest(unittest.TestCase):
+  def test_succeeds_after_failures(self):
+    func = Flaky(2)
+    self.assertEqual(retry(func, attempts=3, base_delay=0), 'ok')
+    self.assertEqual(func.calls, 3)
+
+  def test_gives_up_after_attempts(self):
+    func = Flaky(5)
+    self.assertRaises(IOError, retry, func, attempts=3, base_delay=0)
+    self.assertEqual(func.calls, 3)
+
+  def test_only_retries_listed_errors(self):
+    func = Flaky(1, KeyError)
+    self.assertRaises(KeyError, retry, func, attempts=3, base_delay=0,
+                      retry_on=(IOError,))
+    self.assertEqual(func.calls, 1)
+
+  def test_should_retry(self):
+    func = Flaky(1)
+    self.assertRaises(IOError, retry, func, attempts=3, base_delay=0,
+                      should_retry=lambda e: False)
+    self.assertEqual(func.calls, 1)
+
+  def test_backoff_delay_is_capped(self):
+    for attempt in range(10):
+      delay = backoff_delay(attempt, 0.5, 4.0)
+      self.assertTrue(0 <= delay <= min(4.0, 0.5 * 2 ** attempt))
+
+
+class CircuitBreakersTest(unittest.TestCase):
+  def fail(self, breakers, key='host'):
+    try:
+      with breakers.guard(key):
+        raise IOError('down')
+    except IOError:
+      pass
+
+  def test_opens_after_consecutive_failures(self):
+    breakers = CircuitBreakers(failures=2, reset_sec=60)
+    self.fail(breakers)
+    self.assertTrue(breakers.allow('host'))
+    self.fail(breakers)
+    self.assertFalse(breakers.allow('host'))
+    self.assertRaises(CircuitOpenError, breakers.guard('host').__enter__)
+    # Other keys are unaffected
+    self.assertTrue(breakers.allow('other'))
+
+  def test_success_resets_the_count(self):
+    breakers = CircuitBreakers(failures=2, reset_sec=60)
+    self.fail(breakers)
+    with breakers.guard('host'):
+      pass
+    self.fail(breakers)
+    self.assertTrue(breakers.allow('host'))
+
+  def test_half_open(self):
+    breakers = CircuitBreakers(failures=1, reset_sec=0.05)
+    self.fail(breakers)
+    self.assertFalse(breakers.allow('host'))
+    time.sleep(0.06)
+    # One trial call goes through, the others are held off
+    self.assertTrue(breakers.allow('host'))
+    self.assertFalse(breakers.allow('host'))
+    # A failed trial opens the circuit again
+    breakers.failure('host')
+    self.assertFalse(breakers.allow('host'))
+    time.sleep(0.06)
+    self.assertTrue(breakers.allow('host'))
+    breakers.success('host')
+    self.assertTrue(breakers.allow('host'))
+    self.assertTrue(breakers.allow('host'))
+
+  def test_disabled(self):
+    breakers = CircuitBreakers(failures=0)
+    for _ in range(10):
+      self.fail(breakers)
+    self.assertTrue(breakers.allow('host'))
+
+
+class HedgedTest(unittest.TestCase):
+  def test_fast_call_is_not_hedged(self):
+    calls = []
+
+    def func():
+      calls.append(1)
+      return len(calls)
+    self.assertEqual(hedged(func, after=1.0), 1)
+    self.assertEqual(len(calls), 1)
+
+  def test_slow_call_is_hedged_and_loser_discarded(self):
+    lock = threading.Lock()
+    calls = []
+    discarded = []
+    done = threading.Event()
+
+    def func():
+      with lock:
+        calls.append(1)
+        n = len(calls)
+      # The first call is slow, the hedge is fast
+      time.sleep(0.3 if n == 1 else 0)
+      return n
+
+    def discard(value):
+      discarded.append(value)
+      done.set()
+    self.assertEqual(hedged(func, after=0.05, discard=discard), 2)
+    done.wait(2)
+    self.assertEqual(discarded, [1])
+
+  def test_failure_falls_back_to_other_call(self):
+    lock = threading.Lock()
+    calls = []
+
+    def func():
+      with lock:
+        calls.append(1)
+        n = len(calls)
+      if n == 1:
+        time.sleep(0.1)
+        raise IOError('first')
+      time.sleep(0.2)
+      return n
+    self.assertEqual(hedged(func, after=0.05), 2)
+
+  def test_raises_when_every_call_fails(self):
+    def func():
+      time.sleep(0.05)
+      raise IOError('down')
+    self.assertRaises(IOError, hedged, func, after=0.01, hedges=2)
+
+
+if __name__ == '__main__':
+  unittest.main()
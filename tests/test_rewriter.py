@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+import bs4
+
+from page import Page
+from rewriter import StreamRewriter
+
+
+PAGE_URL = 'http://example.com/dir/page.html'
+# UTF-8, with non-ASCII text and entities in and around asset attributes
+FIXTURE = '''<!DOCTYPE html>
+<html><head><meta charset="utf-8">
+<title>Caf\xc3\xa9 &amp; bar</title>
+<link title="caf\xc3\xa9 &amp; bar" rel="stylesheet"
+      href="/css/caf\xc3\xa9.css">
+<script src="//cdn.example.com/app.js?a=1&amp;b=2"></script>
+</head><body class="\xc3\xa9t\xc3\xa9">
+<p data-x="&lt;&#233;&gt;">Cr\xc3\xa8me br\xc3\xbbl\xc3\xa9e &mdash; &copy;</p>
+<img alt="\xc3\xa9 &quot;quoted&quot;" src="img/a.png"
+     srcset="img/a.png 1x, img/a%402x.png 2x">
+<div style="background: url('bg/fond\xc3\xa9.jpg') no-repeat">x</div>
+<a title="caf\xc3\xa9 &amp; bar" href="x.css">link</a>
+<video poster="poster.jpg?x=1&amp;y=\xc3\xa9"></video>
+</body></html>
+'''
+
+
+def _tags(html):
+  """(name, attrs) of every tag of `html` as BeautifulSoup parses it"""
+  soup = bs4.BeautifulSoup(html)
+  return [(tag.name, tag.attrs) for tag in soup.find_all(True)]
+
+
+class RewriterParityTest(unittest.TestCase):
+  def _page(self, rewriter):
+    return Page(PAGE_URL, html=FIXTURE, rewriter=rewriter)
+
+  def test_same_assets(self):
+    soup, stream = self._page('soup'), self._page('stream')
+    urls = [asset.asset_url for asset in soup.assets]
+    self.assertEqual([asset.asset_url for asset in stream.assets], urls)
+    self.assertIn(u'http://example.com/css/caf\xe9.css', urls)
+    self.assertIn(u'http://cdn.example.com/app.js?a=1&b=2', urls)
+    self.assertIn(u'http://example.com/dir/bg/fond\xe9.jpg', urls)
+    self.assertIn(u'http://example.com/dir/poster.jpg?x=1&y=\xe9', urls)
+
+  def test_same_rewritten_document(self):
+    pages = self._page('soup'), self._page('stream')
+    for page in pages:
+      for i, asset in enumerate(page.assets):
+        asset.rewrite(u'r\xe9%d.bin?a=1&b=%d' % (i, i))
+    soup_html, stream_html = [page.rewritten for page in pages]
+    self.assertEqual(_tags(stream_html), _tags(soup_html))
+
+  def test_untouched_document_is_unchanged(self):
+    self.assertEqual(self._page('stream').rewritten, FIXTURE)
+
+
+class StreamRewriterTest(unittest.TestCase):
+  def test_keeps_the_page_charset(self):
+    html = ('<meta charset="iso-8859-1">'
+            '<link title="caf\xe9 &amp; bar" href="caf\xe9.css">')
+    rewriter = StreamRewriter(html, lambda tag: ('href',))
+    self.assertEqual(rewriter.tags[0]['href'], u'caf\xe9.css')
+    rewriter.tags[0]['href'] = u'中\xe9.css'
+    self.assertEqual(rewriter.rewritten(),
+                     '<meta charset="iso-8859-1">'
+                     '<link title="caf\xe9 &amp; bar" href="&#20013;\xe9.css">')
+
+  def test_undecodable_bytes_survive(self):
+    html = '<link title="\xff\xfe" href="a.css">'
+    rewriter = StreamRewriter(html, lambda tag: ('href',))
+    rewriter.tags[0]['href'] = 'b.css'
+    self.assertEqual(rewriter.rewritten(),
+                     '<link title="\xff\xfe" href="b.css">')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+import threading
+import unittest
+
+import session
+
+
+class GetSessionTest(unittest.TestCase):
+  def test_returns_one_shared_session(self):
+    sessions = []
+    thread = threading.Thread(
+        target=lambda: sessions.extend([session.get_session(),
+                                        session.get_session()]))
+    thread.daemon = True
+    thread.start()
+    thread.join(10)
+    self.assertFalse(thread.is_alive(), 'get_session() deadlocked')
+    first, second = sessions
+    self.assertIs(first, second)
+    self.assertIs(first.get_adapter('http://example.com/'),
+                  session.get_adapter())
+
+
+if __name__ == '__main__':
+  unittest.main()